@@ -46,6 +46,18 @@ class AccessLists(object):
     else:
       return False
 
+  def difference_by_aclid(self, aclid, tree2):
+    """Return the prefixes ACL aclid covers that tree2 does not."""
+    difference = self.acls[aclid].Difference(tree2)
+    return list(difference.IterateNodes(top_used = True))
+
+  def classify_by_aclid(self, aclid, addresses, default = None):
+    """Return, as a NumPy object array, the action ACL aclid takes on
+    each of addresses (integers, e.g. a uint32 array of syslog sources),
+    or default where no entry matches. Needs numpy."""
+    table = tree.IntervalTable(self.acls[aclid])
+    return table.ClassifyData(addresses, default = default)
+
   def iterate_by_aclid(self, aclid=None):
     if aclid is None:
       for aclid in self.acls:
@@ -130,10 +142,26 @@ class NetworkDevice(object):
   strict pythonic style. Perhaps I will revisit that decision."""
   def __init__(self):
     self.parsed_config = None # Parsed configuration object.
+    self.config_index = None # Its config_parse.ConfigIndex, once built.
     self._path = None # Pathname that we read the config from.
     self._interfaces = {}
     self._os_version = None
 
+  def __getattr__(self, name):
+    """Only called for attributes that aren't set. On a device whose config
+    is being parsed lazily (see config_parse.ConfigObject), that may be
+    because the parsing method that sets name hasn't been run yet: if so,
+    run it now, once, and look again."""
+    pending = self.__dict__.get('_pending_parsers')
+    if not pending or name not in pending:
+      raise AttributeError(name)
+    parse, attributes, defaults = pending[name]
+    for attribute in attributes:
+      pending.pop(attribute, None)
+    self.__dict__.update(defaults)
+    parse()
+    return object.__getattribute__(self, name)
+
   def describe(self):
     """Return a (hopefully) unique description of the device.
 
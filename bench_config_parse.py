@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_config_parse.py
+
+Rough timings for config parsing. Not part of the test suite; run it by
+hand, e.g. 'python bench_config_parse.py 50' to parse each example config
+50 times over.
+"""
+
+import abstract_network_device
+import ciscoconfparse
+import config_parse
+import constants
+import gc
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+_DEFAULT_REPEATS = 20
+_EXAMPLE_DIR = "example"
+
+
+def Timed(label, count, func):
+  """Run func, print how long it took and the rate, return the time.
+  Garbage is collected first, so func doesn't pay for its predecessors."""
+  gc.collect()
+  start = time.time()
+  func()
+  elapsed = time.time() - start
+  print "%-34s %8.3fs %10.1f configs/sec" % (label, elapsed, count / elapsed)
+  return elapsed
+
+
+class LegacyIndex(object):
+  """The pre-ConfigIndex lookups: every one a search of the whole config
+  by CiscoConfParse. Kept here only as a baseline to measure against."""
+
+  def __init__(self, parsed_config):
+    self.parsed_config = parsed_config
+
+  def find_lines(self, linespec):
+    return self.parsed_config.find_lines(linespec)
+
+  def find_parents_w_child(self, parentspec, childspec):
+    return self.parsed_config.find_parents_w_child(parentspec, childspec)
+
+  def find_all_children(self, parent):
+    return self.parsed_config.find_all_children(parent, True)
+
+
+def ParsedExamples():
+  """CiscoConfParse each of the example configs."""
+  parsed = []
+  for name in sorted(os.listdir(_EXAMPLE_DIR)):
+    parsed.append(ciscoconfparse.CiscoConfParse(
+      os.path.join(_EXAMPLE_DIR, name)))
+  return parsed
+
+
+def CallParsingMethods(reader, parsed, repeats, index_class):
+  """Run every parsing method over each of parsed, repeats times, with
+  lookups through index_class."""
+  for repeat in xrange(repeats):
+    for parsed_config in parsed:
+      router = abstract_network_device.CiscoRouter()
+      router.parsed_config = parsed_config
+      router.config_index = index_class(parsed_config)
+      reader.call_parsing_methods(router)
+
+
+def BenchParsingMethods(repeats):
+  """call_parsing_methods alone, with the configs already through
+  CiscoConfParse, and then the whole of process_dir for scale."""
+  parsed = ParsedExamples()
+  count = repeats * len(parsed)
+  reader = config_parse.ConfigObject(root_dir = _EXAMPLE_DIR)
+  reader.discover_parsing_methods()
+  Timed("Parsing methods (legacy scans)", count,
+        lambda: CallParsingMethods(reader, parsed, repeats, LegacyIndex))
+  Timed("Parsing methods (ConfigIndex)", count,
+        lambda: CallParsingMethods(reader, parsed, repeats,
+                                   config_parse.ConfigIndex))
+  Timed("CiscoConfParse alone", count,
+        lambda: [ParsedExamples() for repeat in xrange(repeats)])
+
+
+def CopyExamples(repeats):
+  """Make a directory holding repeats copies of each example config, as a
+  stand-in for a fleet; the caller removes it. Each copy gets a comment
+  of its own, so that no two have the same contents."""
+  directory = tempfile.mkdtemp()
+  for repeat in xrange(repeats):
+    for name in sorted(os.listdir(_EXAMPLE_DIR)):
+      copy = os.path.join(directory, "%s-%d" % (name, repeat))
+      shutil.copy(os.path.join(_EXAMPLE_DIR, name), copy)
+      config = open(copy, "a")
+      config.write("! copy %d\n" % repeat)
+      config.close()
+  return directory
+
+
+def ProcessDir(directory, workers, cache_dir = None, lazy = False):
+  configs = config_parse.BulkConfigs(root_dir = directory,
+                                     cache_dir = cache_dir, lazy = lazy)
+  configs.process_dir(spec = ".*", type = constants.Types.DEFAULT_CISCO,
+                      workers = workers)
+  return configs
+
+
+def BenchProcessDir(repeats):
+  """process_dir over a directory of copies of the examples, serially and
+  with a worker per CPU (at least two)."""
+  directory = CopyExamples(repeats)
+  try:
+    count = len(os.listdir(directory))
+    workers = max(2, multiprocessing.cpu_count())
+    Timed("process_dir (serial)", count,
+          lambda: ProcessDir(directory, None))
+    Timed("process_dir (%d workers)" % workers, count,
+          lambda: ProcessDir(directory, workers))
+  finally:
+    shutil.rmtree(directory)
+
+
+def BenchCache(repeats):
+  """process_dir with an empty cache, then a full one, then after a tenth
+  of the configs have changed."""
+  directory = CopyExamples(repeats)
+  cache_dir = tempfile.mkdtemp()
+  try:
+    names = sorted(os.listdir(directory))
+    count = len(names)
+    Timed("process_dir (cold cache)", count,
+          lambda: ProcessDir(directory, None, cache_dir))
+    Timed("process_dir (warm cache)", count,
+          lambda: ProcessDir(directory, None, cache_dir))
+    for name in names[::10]:
+      config = open(os.path.join(directory, name), "a")
+      config.write("! changed\n")
+      config.close()
+    Timed("process_dir (10% changed)", count,
+          lambda: ProcessDir(directory, None, cache_dir))
+  finally:
+    shutil.rmtree(directory)
+    shutil.rmtree(cache_dir)
+
+
+def BenchRefresh(repeats):
+  """refresh after process_dir, with nothing changed, then with a tenth of
+  the configs changed."""
+  directory = CopyExamples(repeats)
+  try:
+    names = sorted(os.listdir(directory))
+    count = len(names)
+    configs = config_parse.BulkConfigs(root_dir = directory)
+    Timed("process_dir", count,
+          lambda: configs.process_dir(spec = ".*",
+                                      type = constants.Types.DEFAULT_CISCO))
+    Timed("refresh (nothing changed)", count, configs.refresh)
+    for name in names[::10]:
+      config = open(os.path.join(directory, name), "a")
+      config.write("! changed\n")
+      config.close()
+    Timed("refresh (10% changed)", count, configs.refresh)
+  finally:
+    shutil.rmtree(directory)
+
+
+def ReadNames(directory, lazy):
+  """process_dir, then read only what a naming test would."""
+  for router in ProcessDir(directory, None, lazy = lazy).routers:
+    router.hostname
+    router.domain_name
+
+
+def BenchLazy(repeats):
+  """process_dir followed by reading the hostname and domain name of each
+  router, with every attribute parsed up front and then lazily."""
+  directory = CopyExamples(repeats)
+  try:
+    count = len(os.listdir(directory))
+    Timed("names only (eager)", count, lambda: ReadNames(directory, False))
+    Timed("names only (lazy)", count, lambda: ReadNames(directory, True))
+  finally:
+    shutil.rmtree(directory)
+
+
+def RunBenchmarks(repeats):
+  print "Config parsing benchmarks, %d passes over %s" % (repeats,
+                                                         _EXAMPLE_DIR)
+  BenchParsingMethods(repeats)
+  BenchProcessDir(repeats)
+  BenchCache(repeats)
+  BenchRefresh(repeats)
+  BenchLazy(repeats)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) > 1:
+    RunBenchmarks(int(sys.argv[1]))
+  else:
+    RunBenchmarks(_DEFAULT_REPEATS)
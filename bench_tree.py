@@ -0,0 +1,901 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_tree.py
+
+Rough timings for the tree (gap-production) object. Not part of the test
+suite; run it by hand, e.g. 'python bench_tree.py 100000'.
+
+'python bench_tree.py --suite' instead runs the core operations at a range
+of sizes and layouts, for catching regressions: save the results with
+--save, and compare a later run against them with --baseline, e.g.
+
+  python bench_tree.py --suite --save baseline.json
+  (change the tree)
+  python bench_tree.py --suite --baseline baseline.json
+
+which exits non-zero if anything got more than --threshold slower.
+"""
+
+import gc
+import IPy
+import json
+import optparse
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import traceback
+import tree
+
+_DEFAULT_COUNT = 100000
+_SEED = 20111102
+_SUITE_SIZES = (1000, 10000, 100000, 1000000)
+_SUITE_LAYOUTS = ('random', 'sequential', 'fragmented')
+# How many gaps the suite's FindGap and FindGapFrom runs allocate.
+_SUITE_ALLOCATIONS = 1000
+
+
+def RandomPrefixes(count, seed = _SEED):
+  """Return a list of count distinct (integer address, prefix length)
+  pairs, with lengths spread between /16 and /30."""
+  rng = random.Random(seed)
+  seen = set()
+  prefixes = []
+  while len(prefixes) < count:
+    netlen = rng.randint(16, 30)
+    addr = int(rng.getrandbits(32) & ~((1 << (32 - netlen)) - 1) & 0xffffffff)
+    if (addr, netlen) in seen:
+      continue
+    seen.add((addr, netlen))
+    prefixes.append((addr, netlen))
+  return prefixes
+
+
+def AsStrings(prefixes):
+  """Format (integer address, prefix length) pairs in CIDR notation."""
+  return ["%d.%d.%d.%d/%d" % (addr >> 24, (addr >> 16) & 255,
+                               (addr >> 8) & 255, addr & 255, netlen)
+          for addr, netlen in prefixes]
+
+
+def Timed(label, count, func):
+  """Run func, print how long it took and the rate, return the time.
+  Garbage is collected first, so func doesn't pay for its predecessors."""
+  gc.collect()
+  start = time.time()
+  func()
+  elapsed = time.time() - start
+  print "%-28s %8.3fs %12.0f ops/sec" % (label, elapsed, count / elapsed)
+  return elapsed
+
+
+def LegacyInsert(t, route, supplied_data):
+  """The pre-InsertInt insertion path: IPy, strBin() and a walk over the
+  resulting string. Kept here only as a baseline to measure against."""
+  ip = IPy.IP(route)
+  current = t.root
+  for x in ip.strBin()[:ip.prefixlen()]:
+    if x == '0':
+      if current.GetLeft() == None:
+        current.SetLeft(tree.Node(current))
+        current.GetLeft().SetData("CREATED BY INSERT")
+      current = current.GetLeft()
+    else:
+      if current.GetRight() == None:
+        current.SetRight(tree.Node(current))
+        current.GetRight().SetData("CREATED BY INSERT")
+      current = current.GetRight()
+  current.used = True
+  current.SetData(supplied_data)
+  return current
+
+
+def LegacyLookup(t, route):
+  """The pre-LookupInt lookup path, as a baseline."""
+  ip = IPy.IP(route)
+  current = t.root
+  for x in ip.strBin()[:ip.prefixlen()]:
+    if x == '0':
+      current = current.GetLeft()
+    else:
+      current = current.GetRight()
+    if current == None:
+      return None
+  return current
+
+
+def BenchInsertLookup(count):
+  prefixes = RandomPrefixes(count)
+  routes = AsStrings(prefixes)
+
+  def InsertLegacy():
+    t = tree.Tree()
+    for route in routes:
+      LegacyInsert(t, route, "bench")
+    return t
+
+  def InsertStrings():
+    t = tree.Tree()
+    for route in routes:
+      t.Insert(route, "bench")
+    return t
+
+  def InsertInts():
+    t = tree.Tree()
+    for addr, netlen in prefixes:
+      t.InsertInt(addr, netlen, "bench")
+    return t
+
+  legacy = Timed("Insert (legacy strBin walk)", count, InsertLegacy)
+  Timed("Insert (strings)", count, InsertStrings)
+  by_int = Timed("InsertInt", count, InsertInts)
+  print "%-28s %8.1fx" % ("InsertInt speedup", legacy / by_int)
+  t = InsertInts()
+  legacy = Timed("Lookup (legacy strBin walk)", count,
+                 lambda: [LegacyLookup(t, route) for route in routes])
+  Timed("Lookup (strings)", count,
+        lambda: [t.Lookup(route) for route in routes])
+  by_int = Timed("LookupInt", count,
+                 lambda: [t.LookupInt(addr, netlen)
+                          for addr, netlen in prefixes])
+  print "%-28s %8.1fx" % ("LookupInt speedup", legacy / by_int)
+
+
+def BenchBulkInsert(count):
+  """Loading a sorted table: InsertInt per prefix against BulkInsertInt.
+  CompactNode keeps the million-prefix case within reach of a laptop."""
+  prefixes = sorted(RandomPrefixes(count))
+  for propagate_used in (False, True):
+
+    def InsertEach():
+      t = tree.Tree(node_class = tree.CompactNode)
+      for addr, netlen in prefixes:
+        t.InsertInt(addr, netlen, "bench", propagate_used = propagate_used)
+
+    def InsertBulk():
+      t = tree.Tree(node_class = tree.CompactNode)
+      t.BulkInsertInt(prefixes, "bench", propagate_used = propagate_used)
+
+    if propagate_used:
+      suffix = " +propagate"
+    else:
+      suffix = ""
+    each = Timed("InsertInt (sorted)" + suffix, count, InsertEach)
+    bulk = Timed("BulkInsertInt" + suffix, count, InsertBulk)
+    print "%-28s %8.1fx" % ("BulkInsertInt speedup", each / bulk)
+
+
+def BenchLongestMatch(count, lookups = 100000):
+  prefixes = RandomPrefixes(count)
+  rng = random.Random(_SEED)
+  addresses = [int(rng.getrandbits(32)) for i in xrange(lookups)]
+  t = tree.Tree()
+  p = tree.PatriciaTree()
+  for addr, netlen in prefixes:
+    t.InsertInt(addr, netlen, "bench")
+    p.InsertInt(addr, netlen, "bench")
+  Timed("LongestMatch (Tree)", lookups,
+        lambda: [t.LongestMatchInt(addr) for addr in addresses])
+  Timed("LongestMatch (PatriciaTree)", lookups,
+        lambda: [p.LongestMatchInt(addr) for addr in addresses])
+
+
+def BenchClassify(count, addresses = 1000000):
+  if tree.numpy is None:
+    print "%-28s skipped (numpy is not installed)" % "IntervalTable"
+    return
+  t = tree.Tree()
+  t.BulkInsertInt(sorted(RandomPrefixes(count)), "bench")
+  rng = tree.numpy.random.RandomState(_SEED)
+  batch = rng.randint(0, 1 << 32, size = addresses).astype(tree.numpy.uint32)
+  sample = [int(addr) for addr in batch[:100000]]
+  Timed("LongestMatchInt (per addr)", len(sample),
+        lambda: [t.LongestMatchInt(addr) for addr in sample])
+  tables = []
+  Timed("IntervalTable build", count,
+        lambda: tables.append(tree.IntervalTable(t)))
+  table = tables[0]
+  Timed("IntervalTable.Classify", addresses, lambda: table.Classify(batch))
+  Timed("IntervalTable.ClassifyData", addresses,
+        lambda: table.ClassifyData(batch))
+
+
+def LegacyGenerateForPrefix(count):
+  """The pre-GenerateForPrefixInt GenerateForPrefix (without variance,
+  which never worked): a hex string and an IPy.IP per prefix."""
+  total_span = 2 ** 32
+  for x in range(0, total_span, total_span / 2 ** count):
+    yield IPy.IP(hex(x) + "/" + str(count)).strNormal(1)
+
+
+def BenchGenerate(netlen = 20):
+  t = tree.Tree()
+  count = 1 << netlen
+  Timed("GenerateForPrefix (legacy)", count,
+        lambda: sum(1 for route in LegacyGenerateForPrefix(netlen)))
+  Timed("GenerateForPrefix", count,
+        lambda: sum(1 for route in t.GenerateForPrefix(netlen)))
+  Timed("GenerateForPrefixInt", count,
+        lambda: sum(1 for pair in t.GenerateForPrefixInt(netlen)))
+  Timed("GenerateForPrefixInt (var.)", count,
+        lambda: sum(1 for pair in t.GenerateForPrefixInt(netlen, 2, _SEED)))
+  if tree.numpy is not None:
+    Timed("GenerateForPrefixArrays", count,
+          lambda: t.GenerateForPrefixArrays(netlen))
+
+
+def BenchCover(count, queries = 10000):
+  prefixes = RandomPrefixes(count)
+  rng = random.Random(_SEED)
+  addresses = [int(rng.getrandbits(32)) for i in xrange(queries)]
+  t = tree.Tree()
+  for addr, netlen in prefixes:
+    t.InsertInt(addr, netlen, "bench")
+
+  def RepeatedLookup():
+    # What "what covers this address" took before CoveringInt.
+    for addr in addresses:
+      for netlen in xrange(33):
+        node = t.LookupInt(addr, netlen)
+        if node is None:
+          break
+
+  Timed("Covering (LookupInt per len)", queries, RepeatedLookup)
+  Timed("CoveringInt", queries,
+        lambda: [list(t.CoveringInt(addr)) for addr in addresses])
+  Timed("CoveredInt /16", queries,
+        lambda: [list(t.CoveredInt(addr, 16)) for addr in addresses])
+
+
+def LegacyPathToDotQuad(binstr, depth):
+  """The pre-IterateNodesInt PathToDotQuad, which went through IPy."""
+  binstr = binstr + "0" * (32 - len(binstr))
+  return IPy.IP(hex(int(binstr, 2)) + "/" + str(depth)).strNormal(1)
+
+
+def LegacyIterateNodes(t):
+  """The pre-IterateNodesInt walk (without prefix, return_data or
+  top_used): parent pointers, and GetPath for every used node. It yields
+  a used node again whenever it climbs back up through it."""
+  original = current = next_node = previous = t.root
+  while current != None:
+    if current.used == True:
+      yield LegacyPathToDotQuad(current.GetPath(), current.GetLevel())
+    if previous == current.GetParent() or (previous == original and
+                                           current == original):
+      if current.GetLeft() == None:
+        if current.GetRight() == None:
+          next_node = current.GetParent()
+        else:
+          next_node = current.GetRight()
+      else:
+        next_node = current.GetLeft()
+    elif previous == current.GetLeft():
+      if current.GetRight() == None:
+        next_node = current.GetParent()
+      else:
+        next_node = current.GetRight()
+    elif previous == current.GetRight():
+      next_node = current.GetParent()
+    if next_node == original.GetParent():
+      return
+    previous = current
+    current = next_node
+
+
+def BenchIterate(count):
+  t = tree.Tree()
+  t.BulkInsertInt(sorted(RandomPrefixes(count)), "bench")
+  legacy = Timed("IterateNodes (legacy)", count,
+                 lambda: list(LegacyIterateNodes(t)))
+  Timed("IterateNodes", count, lambda: list(t.IterateNodes()))
+  by_int = Timed("IterateNodesInt", count, lambda: list(t.IterateNodesInt()))
+  print "%-28s %8.1fx" % ("IterateNodesInt speedup", legacy / by_int)
+
+
+def LegacyEqual(t1, t2):
+  """The pre-lockstep Tree.__eq__: compare sets of prefix strings."""
+  return (set(t1.IterateNodes(top_used = True)) ==
+          set(t2.IterateNodes(top_used = True)))
+
+
+def UpdateHashes(trees):
+  """Bring the hashes of each of trees up to date, as repeated comparisons
+  would (see Tree._HashesWanted)."""
+  for t in trees:
+    t._UpdateHashes()
+
+
+def BenchSetOperations(count):
+  """Two trees sharing half their prefixes. Rates are in prefixes per
+  operand per second. The first == walks the trees, as it did before
+  they had hashes; once the hashes are up to date, == compares roots."""
+  prefixes = sorted(RandomPrefixes(count))
+  others = sorted(RandomPrefixes(count, seed = _SEED + 1))
+  t1 = tree.Tree()
+  t1.BulkInsertInt(prefixes, "one")
+  t2 = tree.Tree()
+  t2.BulkInsertInt(sorted(prefixes[::2] + others[1::2]), "two")
+  t3 = tree.Tree()
+  t3.BulkInsertInt(prefixes, "three")
+  Timed("== (legacy string sets)", count, lambda: LegacyEqual(t1, t3))
+  Timed("== (first walk)", count, lambda: t1 == t3)
+  Timed("Hashing both trees", count, lambda: UpdateHashes([t1, t3]))
+  Timed("== (hashed)", count, lambda: t1 == t3)
+  Timed("Union", count, lambda: t1.Union(t2))
+  Timed("Intersection", count, lambda: t1.Intersection(t2))
+  Timed("Difference", count, lambda: t1.Difference(t2))
+  Timed("IsSubset", count, lambda: t1.IsSubset(t3))
+
+
+def BenchFleetCompare(routers = 2000, entries = 50):
+  """An ACL of entries prefixes on each of routers routers, compared
+  against a golden copy; one router in a hundred has one entry wrong.
+  CompactNode keeps the fleet within memory."""
+  prefixes = sorted(RandomPrefixes(entries))
+  golden = tree.Tree(node_class = tree.CompactNode)
+  golden.BulkInsertInt(prefixes, "permit")
+  fleet = []
+  for i in xrange(routers):
+    acl = tree.Tree(node_class = tree.CompactNode)
+    acl.BulkInsertInt(prefixes, "permit")
+    if i % 100 == 0:
+      acl.InsertInt(0x0a000000 + i, 32, "permit", test_dup = False)
+    fleet.append(acl)
+  Timed("Fleet == (legacy sets)", routers,
+        lambda: [LegacyEqual(acl, golden) for acl in fleet])
+  Timed("Fleet == (first walk)", routers,
+        lambda: [acl == golden for acl in fleet])
+  Timed("Fleet hashing", routers, lambda: UpdateHashes(fleet + [golden]))
+  Timed("Fleet == (hashed)", routers,
+        lambda: [acl == golden for acl in fleet])
+  Timed("Fleet Diff (hashed)", routers,
+        lambda: [list(acl.DiffInt(golden)) for acl in fleet])
+
+
+def BenchSaveLoad(count, lookups = 100000):
+  """Rebuilding a tree against loading or mapping a saved copy. As with
+  BenchBulkInsert, CompactNode keeps a million prefixes within reach."""
+  prefixes = sorted(RandomPrefixes(count))
+  path = tempfile.mktemp(suffix = ".tree")
+
+  def Rebuild():
+    t = tree.Tree(node_class = tree.CompactNode)
+    t.BulkInsertInt(prefixes, "bench")
+    return t
+
+  t = Rebuild()
+  try:
+    Timed("Rebuild (BulkInsertInt)", count, Rebuild)
+    Timed("Save", count, lambda: t.Save(path))
+    print "%-28s %8.1f MB %6.1f bytes/node" % (
+      "Saved size", os.path.getsize(path) / 1048576.0,
+      os.path.getsize(path) / float(CountNodes(t)))
+    Timed("Load", count,
+          lambda: tree.Tree.Load(path, node_class = tree.CompactNode))
+    Timed("MappedTree (open)", count, lambda: tree.MappedTree(path).Close())
+    rng = random.Random(_SEED)
+    addresses = [int(rng.getrandbits(32)) for i in xrange(lookups)]
+    mapped = tree.MappedTree(path)
+    Timed("LongestMatch (MappedTree)", lookups,
+          lambda: [mapped.LongestMatchInt(addr) for addr in addresses])
+    mapped.Close()
+  finally:
+    if os.path.exists(path):
+      os.unlink(path)
+
+
+def BenchSnapshot(count, changes = 1000):
+  """Versioning a table: snapshot, change a little, find what changed."""
+  prefixes = sorted(RandomPrefixes(count))
+  extra = RandomPrefixes(changes, seed = _SEED + 1)
+  t = tree.Tree()
+  t.BulkInsertInt(prefixes, "bench")
+  snapshots = []
+  Timed("Snapshot", 1000, lambda: [snapshots.append(t.Snapshot())
+                                   for i in xrange(1000)])
+  old = t.Snapshot()
+
+  def Change():
+    for addr, netlen in extra:
+      t.InsertInt(addr, netlen, "changed", test_dup = False)
+
+  Timed("InsertInt after Snapshot", changes, Change)
+  Timed("Diff", changes, lambda: list(t.Diff(old)))
+  Timed("== (shares all but changes)", changes, lambda: t == old)
+
+  def Rebuild():
+    before = tree.Tree()
+    before.BulkInsertInt(prefixes, "bench")
+    after = tree.Tree()
+    after.BulkInsertInt(sorted(prefixes + extra), "bench", test_dup = False)
+    return before == after
+
+  Timed("Rebuild both and ==", changes, Rebuild)
+
+
+def BenchSummarize(count):
+  t = tree.Tree()
+  t.BulkInsertInt(sorted(RandomPrefixes(count)), "bench")
+  for max_extra in (0, 256, 65536):
+    Timed("Summarize(max_extra=%d)" % max_extra, count,
+          lambda: t.SummarizeInt(max_extra))
+    print "%-28s %8d prefixes" % ("", len(t.SummarizeInt(max_extra)))
+
+
+def BenchUtilization(count, queries = 1000):
+  prefixes = RandomPrefixes(count)
+  t = tree.Tree()
+  t.BulkInsertInt(sorted(prefixes), "bench")
+  rng = random.Random(_SEED)
+  aggregates = [(int(rng.getrandbits(32)) & 0xff000000, 8)
+                for i in xrange(queries)]
+
+  def ByIterating():
+    # What a utilization figure took before the per-node counts.
+    for addr, netlen in aggregates:
+      used = 0
+      for covered, length in t.CoveredInt(addr, netlen, top_used = True):
+        used += 1 << (32 - length)
+
+  Timed("Utilization (iterating)", queries, ByIterating)
+  Timed("Utilization (first, counts)", 1, lambda: t.UtilizationInt(0, 0))
+  Timed("UtilizationInt", queries,
+        lambda: [t.UtilizationInt(addr, netlen) for addr, netlen in aggregates])
+  Timed("UtilizationHistogram /16", 1, lambda: t.UtilizationHistogram(16))
+
+
+def FragmentedTree(count):
+  """A tree with count /30s in use, one in every /29, from 0.0.0.0 up:
+  the worst case for anything that has to hunt for its gap."""
+  t = tree.Tree()
+  for i in xrange(count):
+    t.InsertInt(i * 8, 30, "fragmented")
+  return t
+
+
+def BenchFindGap(count, allocations = 1000):
+  t = FragmentedTree(count)
+
+  def Allocate():
+    for i in xrange(allocations):
+      addr, netlen = t.FindGapInt(29)
+      t.InsertInt(addr, netlen, "allocated")
+
+  Timed("FindGap+Insert /29 (frag.)", allocations, Allocate)
+  t = FragmentedTree(count)
+  Timed("FindGaps(mark_used) /29", allocations,
+        lambda: list(t.FindGapsInt(29, count = allocations, mark_used = True)))
+
+
+def BenchAllocator(count, operations = 20000):
+  """Day-to-day IPAM churn in a fragmented /8: link /30s and /31s and
+  loopback /32s, allocated and released, by FindGapFrom and Remove and by
+  PrefixAllocator."""
+  sizes = [30, 31, 32]
+
+  def PoolTree():
+    t = tree.Tree()
+    t.Insert('10.0.0.0/8', 'pool', mark_used = False)
+    for i in xrange(count):
+      t.InsertInt(0x0a000000 + i * 8, 30, "fragmented")
+    return t
+
+  def Churn(allocate, release):
+    rng = random.Random(_SEED)
+    allocated = []
+    for i in xrange(operations):
+      if allocated and rng.random() < 0.45:
+        release(allocated.pop(rng.randrange(len(allocated))))
+      else:
+        allocated.append(allocate(rng.choice(sizes)))
+
+  t = PoolTree()
+
+  def FindGapAllocate(size):
+    gap = t.FindGapFrom('10.0.0.0/8', size)
+    t.Insert(gap, "allocated")
+    return gap
+
+  Timed("FindGapFrom+Insert/Remove", operations,
+        lambda: Churn(FindGapAllocate, t.Remove))
+  for policy in (tree.PrefixAllocator.BEST_FIT,
+                 tree.PrefixAllocator.FIRST_FIT):
+    t = PoolTree()
+    allocators = []
+    Timed("PrefixAllocator setup", count, lambda: allocators.append(
+      t.Allocator('10.0.0.0/8', policy)))
+    allocator = allocators[0]
+    Timed("PrefixAllocator (%s)" % policy, operations,
+          lambda: Churn(allocator.Allocate, allocator.Release))
+    print "%-28s %8d free blocks" % ("", len(allocator.FreeBlocksInt()))
+
+
+def CountNodes(t):
+  """How many nodes (used or not) make up tree t?"""
+  count = 0
+  stack = [t.GetRoot()]
+  while stack:
+    node = stack.pop()
+    count += 1
+    if node.left is not None:
+      stack.append(node.left)
+    if node.right is not None:
+      stack.append(node.right)
+  return count
+
+
+def BenchChurn(count, rounds = 5):
+  """An allocation tree that frees as much as it allocates: Remove should
+  keep it from growing round on round."""
+  prefixes = RandomPrefixes(count)
+  t = tree.Tree()
+
+  def Insert():
+    for addr, netlen in prefixes:
+      t.InsertInt(addr, netlen, "bench", test_dup = False)
+
+  def Remove():
+    for addr, netlen in prefixes:
+      if t.LookupInt(addr, netlen) is not None:
+        try:
+          t.RemoveInt(addr, netlen)
+        except ValueError:
+          pass
+
+  for i in xrange(rounds):
+    Timed("Insert (churn round %d)" % i, count, Insert)
+    peak = CountNodes(t)
+    Timed("Remove (churn round %d)" % i, count, Remove)
+    print "%-28s %8d nodes at peak, %d after" % ("", peak, CountNodes(t))
+
+
+# The exit status of a RunInChild child that ran out of memory.
+_OUT_OF_MEMORY = 3
+
+
+def RunInChild(func):
+  """Run func in a child process and return the string it returns. If
+  the child runs out of memory, whether it gets a MemoryError or is
+  killed (most likely by the OOM killer), return None. If func raises
+  anything else, the child prints the traceback and we raise
+  RuntimeError."""
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    status = 0
+    try:
+      os.write(write_fd, func())
+    except MemoryError:
+      status = _OUT_OF_MEMORY
+    except:
+      traceback.print_exc()
+      status = 1
+    os._exit(status)
+  os.close(write_fd)
+  chunks = []
+  while True:
+    chunk = os.read(read_fd, 65536)
+    if not chunk:
+      break
+    chunks.append(chunk)
+  os.close(read_fd)
+  pid, status = os.waitpid(pid, 0)
+  if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) == _OUT_OF_MEMORY:
+    return None
+  if os.WEXITSTATUS(status) != 0:
+    raise RuntimeError("the child process failed; see its traceback above")
+  return "".join(chunks)
+
+
+def MeasureTree(node_class, prefixes):
+  """Build a tree of node_class from prefixes in a child process, so the
+  parent's heap doesn't muddy the figures. Returns (node count, growth in
+  peak RSS in bytes), or (None, None) if the child ran out of memory."""
+  def Build():
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = tree.Tree(node_class = node_class)
+    for addr, netlen in prefixes:
+      t.InsertInt(addr, netlen, "bench")
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return "%d %d" % (CountNodes(t), (after - before) * 1024)
+
+  result = RunInChild(Build)
+  if result is None:
+    return None, None
+  nodes, rss = result.split()
+  return int(nodes), int(rss)
+
+
+def BenchMemory(count):
+  prefixes = RandomPrefixes(count)
+  results = {}
+  for node_class in (tree.Node, tree.CompactNode):
+    try:
+      nodes, rss = MeasureTree(node_class, prefixes)
+    except RuntimeError, e:
+      print "%-28s failed: %s" % ("Memory (%s)" % node_class.__name__, e)
+      return
+    if nodes is None:
+      print "%-28s ran out of memory" % ("Memory (%s)" % node_class.__name__)
+      return
+    results[node_class] = rss
+    print "%-28s %8d nodes %8.1f MB %6d bytes/node" % (
+      "Memory (%s)" % node_class.__name__, nodes, rss / 1048576.0,
+      rss / nodes)
+  saved = results[tree.Node] - results[tree.CompactNode]
+  print "%-28s %8.1f MB (%.0f%%)" % ("CompactNode saves", saved / 1048576.0,
+                                     100.0 * saved / results[tree.Node])
+
+
+def LayoutPrefixes(layout, count):
+  """count (integer address, prefix length) pairs laid out as layout says:
+  'random' (see RandomPrefixes), 'sequential' (consecutive /24s from
+  10.0.0.0 up) or 'fragmented' (a /30 in every /29 from 0.0.0.0 up, as for
+  FragmentedTree)."""
+  if layout == 'random':
+    return RandomPrefixes(count)
+  if layout == 'sequential':
+    return [(0x0a000000 + (i << 8), 24) for i in xrange(count)]
+  if layout == 'fragmented':
+    return [(i << 3, 30) for i in xrange(count)]
+  raise ValueError("Unknown layout %s" % layout)
+
+
+def Rate(count, func, repeat = False):
+  """Run func, which does count operations, and return how many it
+  managed a second. Like Timed, but quiet. With repeat (for funcs that
+  change nothing), func is run again until a tenth of a second has gone,
+  so that small counts are not lost in the timer's noise.
+
+  If count is None, func returns how many operations it managed, which
+  may be none at all (a FindGap with no gaps left to find, say); then
+  there is no rate to speak of, and we return None."""
+  gc.collect()
+  done = 0
+  start = time.time()
+  while True:
+    if count is None:
+      done += func()
+    else:
+      func()
+      done += count
+    elapsed = time.time() - start
+    if not repeat or elapsed >= 0.1:
+      break
+  if not done:
+    return None
+  return done / max(elapsed, 1e-9)
+
+
+def MeasureSuiteCase(layout, count, node_class = None):
+  """Run the suite's operations over count prefixes laid out as layout,
+  in trees of node_class. Returns a dictionary of operation name to
+  ops/sec, plus 'peak_rss_mb', how much the peak RSS grew over the run.
+  An operation that did nothing, such as FindGap in a tree with no gaps,
+  has a rate of None.
+
+  Insert, Lookup, IterateNodes, FindGap and FindGapFrom are timed through
+  the string methods callers use, and the first three through their *Int
+  variants too. 'eq' is a first comparison of two trees, which walks
+  them; 'eq_hashed' is == once both trees' hashes are up to date."""
+  prefixes = LayoutPrefixes(layout, count)
+  routes = AsStrings(prefixes)
+  allocations = min(count, _SUITE_ALLOCATIONS)
+  before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  result = {}
+  t = tree.Tree(node_class = node_class)
+
+  # InsertInt builds a tree of its own, which is thrown away before
+  # Insert builds t.
+  def InsertInt():
+    fresh = tree.Tree(node_class = node_class)
+    for addr, netlen in prefixes:
+      fresh.InsertInt(addr, netlen, "bench", test_dup = False)
+
+  def Insert():
+    for route in routes:
+      t.Insert(route, "bench", test_dup = False)
+
+  result['insert_int'] = Rate(count, InsertInt)
+  result['insert'] = Rate(count, Insert)
+  result['lookup'] = Rate(count, lambda: [t.Lookup(route) for route in routes],
+                          repeat = True)
+  result['lookup_int'] = Rate(count, lambda: [t.LookupInt(addr, netlen)
+                                              for addr, netlen in prefixes],
+                              repeat = True)
+  result['iterate_nodes'] = Rate(count, lambda: list(t.IterateNodes()),
+                                 repeat = True)
+  result['iterate_nodes_int'] = Rate(count, lambda: list(t.IterateNodesInt()),
+                                     repeat = True)
+  other = tree.Tree(node_class = node_class)
+  other.BulkInsertInt(sorted(prefixes), "bench", test_dup = False)
+  result['eq'] = Rate(count, lambda: t == other)
+  UpdateHashes([t, other])
+  result['eq_hashed'] = Rate(count, lambda: t == other, repeat = True)
+  other = None
+
+  # Each allocation run gets its own snapshot, so they all start from the
+  # same tree. Only the gaps found count: a run that finds none at all
+  # has no rate.
+  def Allocate(find):
+    copy = t.Snapshot()
+    for i in xrange(allocations):
+      gap = find(copy)
+      if gap is None:
+        return i
+      copy.Insert(gap, "allocated")
+    return allocations
+
+  result['find_gap'] = Rate(None, lambda: Allocate(lambda c: c.FindGap(30)))
+  result['find_gap_from'] = Rate(None, lambda: Allocate(
+    lambda c: c.FindGapFrom('0.0.0.0/1', 30)))
+  after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  result['peak_rss_mb'] = (after - before) / 1024.0
+  return result
+
+
+def RunSuiteCase(layout, count, node_class = None):
+  """MeasureSuiteCase in a child process, so that each case's peak RSS is
+  its own. Returns None if the child ran out of memory; raises
+  RuntimeError if it failed any other way."""
+  result = RunInChild(lambda: json.dumps(MeasureSuiteCase(layout, count,
+                                                          node_class)))
+  if result is None:
+    return None
+  return json.loads(result)
+
+
+def FormatRate(rate):
+  """A rate from Rate, or n/a if there was none."""
+  if rate is None:
+    return "n/a"
+  return "%.0f" % rate
+
+
+def RunSuite(sizes, layouts, node_class = None):
+  """Run the suite for each of layouts at each of sizes, printing results
+  as they come. Returns them, with a note of what they were run on, and
+  the cases in a dictionary keyed by 'layout/size'."""
+  cases = {}
+  for layout in layouts:
+    for count in sizes:
+      key = "%s/%d" % (layout, count)
+      try:
+        case = RunSuiteCase(layout, count, node_class)
+      except RuntimeError, e:
+        print "%-20s failed: %s" % (key, e)
+        cases[key] = None
+        continue
+      cases[key] = case
+      if case is None:
+        print "%-20s ran out of memory" % key
+        continue
+      print "%-20s %s %8.1f MB" % (key, " ".join(
+        "%s=%s" % (name, FormatRate(case[name])) for name in sorted(case)
+        if name != 'peak_rss_mb'), case['peak_rss_mb'])
+  return {'python': platform.python_version(),
+          'platform': platform.platform(),
+          'node_class': (node_class or tree.Node).__name__,
+          'cases': cases}
+
+
+def CompareToBaseline(results, baseline, threshold):
+  """Print how results compare to baseline (both as from RunSuite), and
+  return the list of (case, operation) pairs that got more than threshold
+  (a fraction) slower. Peak RSS growing by more than threshold counts
+  too."""
+  if results.get('node_class') != baseline.get('node_class'):
+    print "Warning: comparing %s trees against a baseline of %s trees" % (
+      results.get('node_class'), baseline.get('node_class'))
+  regressions = []
+  for key in sorted(results['cases']):
+    case = results['cases'][key]
+    old = baseline['cases'].get(key)
+    if case is None or old is None:
+      continue
+    for name in sorted(case):
+      if name not in old or not old[name]:
+        continue
+      if case[name] is None:
+        # Nothing to time this run, where there was last time.
+        print "%-20s %-16s %7s" % (key, name, "n/a")
+        continue
+      ratio = case[name] / old[name]
+      if name == 'peak_rss_mb':
+        worse = ratio > 1 + threshold
+      else:
+        worse = ratio < 1 - threshold
+      if worse:
+        regressions.append((key, name))
+      print "%-20s %-16s %6.2fx%s" % (key, name, ratio,
+                                      worse and "  REGRESSION" or "")
+  return regressions
+
+
+def ParseSizes(option, opt, value, parser):
+  setattr(parser.values, option.dest, [int(size) for size in value.split(",")])
+
+
+def ParseLayouts(option, opt, value, parser):
+  setattr(parser.values, option.dest, value.split(","))
+
+
+def Main(argv):
+  parser = optparse.OptionParser(usage = "%prog [options] [count]")
+  parser.add_option("--suite", action = "store_true", default = False,
+                    help = "run the scaling suite rather than the one-off "
+                    "benchmarks")
+  parser.add_option("--sizes", type = "string", action = "callback",
+                    callback = ParseSizes, default = list(_SUITE_SIZES),
+                    help = "comma-separated prefix counts for --suite")
+  parser.add_option("--layouts", type = "string", action = "callback",
+                    callback = ParseLayouts, default = list(_SUITE_LAYOUTS),
+                    help = "comma-separated layouts for --suite, from %s" %
+                    ", ".join(_SUITE_LAYOUTS))
+  parser.add_option("--compact", action = "store_true", default = False,
+                    help = "build --suite trees of CompactNode, which lets "
+                    "bigger sizes fit in memory")
+  parser.add_option("--save", help = "write --suite results to this JSON file")
+  parser.add_option("--baseline",
+                    help = "compare --suite results to this JSON file")
+  parser.add_option("--threshold", type = "float", default = 0.2,
+                    help = "slowdown (as a fraction) that counts as a "
+                    "regression against --baseline [default: %default]")
+  options, args = parser.parse_args(argv)
+  if not options.suite:
+    if args:
+      count = int(args[0])
+    else:
+      count = _DEFAULT_COUNT
+    RunBenchmarks(count)
+    return 0
+  for layout in options.layouts:
+    if layout not in _SUITE_LAYOUTS:
+      parser.error("unknown layout %s" % layout)
+  node_class = None
+  if options.compact:
+    node_class = tree.CompactNode
+  results = RunSuite(options.sizes, options.layouts, node_class)
+  if options.save:
+    out = open(options.save, "w")
+    json.dump(results, out, indent = 2, sort_keys = True)
+    out.close()
+  if options.baseline:
+    baseline = json.load(open(options.baseline))
+    regressions = CompareToBaseline(results, baseline, options.threshold)
+    if regressions:
+      print "%d regression(s) against %s" % (len(regressions),
+                                            options.baseline)
+      return 1
+  return 0
+
+
+def RunBenchmarks(count):
+  print "Tree benchmarks with %d prefixes" % count
+  BenchInsertLookup(count)
+  BenchBulkInsert(count)
+  BenchLongestMatch(count)
+  BenchGenerate()
+  BenchClassify(count)
+  BenchCover(count)
+  BenchIterate(count)
+  BenchSetOperations(count)
+  BenchFleetCompare()
+  BenchSaveLoad(count)
+  BenchSnapshot(count)
+  BenchSummarize(count)
+  BenchUtilization(count)
+  BenchFindGap(count)
+  BenchAllocator(count)
+  BenchChurn(count)
+  BenchMemory(count)
+
+
+if __name__ == '__main__':
+  sys.exit(Main(sys.argv[1:]))
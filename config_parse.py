@@ -9,21 +9,216 @@ Created by Niall Richard Murphy on 2011-05-25.
 import abstract_network_device
 import ciscoconfparse
 import constants
+import cPickle
+import functools
+import hashlib
 import inspect
+import multiprocessing
 import os
 import pprint
 import re
 import sys
+import traceback
 import tree
 
+# Part of the key routers are cached under (see BulkConfigs): bump it
+# whenever a change to the parsing methods or to the router model would
+# make routers cached by an earlier version wrong. Changes to their source
+# get new keys anyway (see _ParserDigest); this is for anything else.
+PARSER_VERSION = 1
+# The digest _ParserDigest works out, once it has.
+_parser_digest = None
+
+# The first word of a config line, which ConfigIndex files it under.
+_FIRST_WORD = re.compile(r"\S+")
+# The start of a regexp alternative anchored to a literal first word, or
+# to a group of them: '^hostname ...', '^(ip|domain) ...', '^(?P<x>ntp)'.
+_LEADING_WORDS = re.compile(r"\^(\((?:\?P<\w+>)?)?([\w-]+(?:\|[\w-]+)*)(\)?)")
+# What ConfigIndex has worked out about each regexp it has seen; see
+# _LeadingWords.
+_leading_words = {}
+
+
+def _SplitAlternatives(regexp):
+  """Split regexp at the |s that are not inside a group or a character
+  class."""
+  branches = []
+  depth = 0
+  start = 0
+  position = 0
+  while position < len(regexp):
+    char = regexp[position]
+    if char == '\\':
+      position += 1
+    elif char == '[':
+      # Skip the class; a ] straight after the [ (or [^) is part of it.
+      position += 1
+      if regexp[position:position + 1] == '^':
+        position += 1
+      if regexp[position:position + 1] == ']':
+        position += 1
+      while position < len(regexp) and regexp[position] != ']':
+        if regexp[position] == '\\':
+          position += 1
+        position += 1
+    elif char == '(':
+      depth += 1
+    elif char == ')':
+      depth -= 1
+    elif char == '|' and depth == 0:
+      branches.append(regexp[start:position])
+      start = position + 1
+    position += 1
+  branches.append(regexp[start:])
+  return branches
+
+
+def _LeadingWords(regexp):
+  """Return the first words a line must start with to match regexp, as a
+  list of (word, whole) pairs, where whole is False if the word may go on
+  to be a longer one; or None if regexp could match a line starting any
+  which way."""
+  if regexp in _leading_words:
+    return _leading_words[regexp]
+  words = []
+  for branch in _SplitAlternatives(regexp):
+    match = _LEADING_WORDS.match(branch)
+    if match is None:
+      words = None
+      break
+    opened, alternatives, closed = match.groups()
+    if bool(opened) != bool(closed):
+      words = None
+      break
+    rest = branch[match.end():match.end() + 1]
+    if rest not in ('', ' ', '$'):
+      words = None
+      break
+    for word in alternatives.split('|'):
+      words.append((word, rest != ''))
+  _leading_words[regexp] = words
+  return words
+
+
+class ConfigIndex(object):
+  """The lines of a parsed config, read through once and filed by their
+  first word, so that each ReadConfig method looks only at the lines it
+  could be interested in rather than searching the whole config again.
+
+  A regexp each of whose alternatives is anchored to a literal first word
+  ('^snmp-server host ...', '^(ip|domain) name[ -]server ...') is tried
+  only against the lines filed under those words. Any other regexp is
+  tried against every line, as CiscoConfParse would. Either way the
+  answers are the same as CiscoConfParse's."""
+
+  def __init__(self, parsed_config):
+    self.parsed_config = parsed_config
+    self.objs = list(parsed_config.ConfigObjs)
+    # Positions in objs of the unindented lines, by first word.
+    self.by_word = {}
+    for position, obj in enumerate(self.objs):
+      text = obj.text
+      if text[:1].isspace():
+        continue
+      word = _FIRST_WORD.match(text)
+      if word is not None:
+        self.by_word.setdefault(word.group(), []).append(position)
+
+  @classmethod
+  def For(cls, router):
+    """Return the index of router's parsed config, building it the first
+    time it is asked for."""
+    index = getattr(router, 'config_index', None)
+    if index is None or index.parsed_config is not router.parsed_config:
+      index = cls(router.parsed_config)
+      router.config_index = index
+    return index
+
+  def _Candidates(self, regexp):
+    """The config line objects regexp might match, in config order."""
+    words = _LeadingWords(regexp)
+    if words is None:
+      return self.objs
+    positions = set()
+    for word, whole in words:
+      if whole:
+        positions.update(self.by_word.get(word, ()))
+      else:
+        for key in self.by_word:
+          if key.startswith(word):
+            positions.update(self.by_word[key])
+    return [self.objs[position] for position in sorted(positions)]
+
+  def find_lines(self, linespec):
+    """As CiscoConfParse.find_lines."""
+    search = re.compile(linespec).search
+    return [obj.text for obj in self._Candidates(linespec)
+            if search(obj.text)]
+
+  def find_parents_w_child(self, parentspec, childspec):
+    """As CiscoConfParse.find_parents_w_child: the lines matching
+    parentspec with a descendant matching childspec."""
+    parent_search = re.compile(parentspec).search
+    child_search = re.compile(childspec).search
+    parents = []
+    for obj in self._Candidates(parentspec):
+      if not parent_search(obj.text):
+        continue
+      descendants = list(obj.children)
+      while descendants:
+        descendant = descendants.pop()
+        if child_search(descendant.text):
+          parents.append(obj.text)
+          break
+        descendants.extend(descendant.children)
+    return parents
+
+  def find_all_children(self, parent):
+    """As CiscoConfParse.find_all_children(^parent$): every line whose text
+    is parent, followed by their children and grandchildren, in config
+    order."""
+    word = _FIRST_WORD.match(parent)
+    if word is None or parent[:1].isspace():
+      candidates = self.objs
+    else:
+      candidates = [self.objs[position]
+                    for position in self.by_word.get(word.group(), ())]
+    family = set()
+    for obj in candidates:
+      if obj.text != parent:
+        continue
+      family.add(obj)
+      for child in obj.children:
+        family.add(child)
+        family.update(child.children)
+    return [obj.text for obj in sorted(family, key = lambda obj: obj.linenum)]
+
+
+def parses(*attributes):
+  """Mark a parsing method as setting the named attributes of the router,
+  as they are stored on it (so '_hostname', behind the hostname property).
+  This is what lets lazy parsing know to run the method the first time
+  one of them is read."""
+  def mark(method):
+    method.parses = attributes
+    return method
+  return mark
+
+
 class ConfigObject(object):
   """A configuration object is created to read either one config or
-  tree of configs."""
-  def __init__(self, root_dir):
+  tree of configs.
+
+  If lazy, each parsing method is only run on a router the first time
+  one of the attributes it sets (see parses) is read, so a run that looks
+  at only a few attributes only pays for parsing those. Lazily parsed
+  routers keep their parsed_config, since they still need it."""
+  def __init__(self, root_dir, lazy=False):
     # Root directory is the directory where the router configs are, er, rooted.
     self.root_dir = root_dir
     self.router = None
     self.parsing_methods = {}
+    self.lazy = lazy
 
   # TODO(niallm): Consider name 'build_single_router'
   def process_single_file(self, path, type):
@@ -37,7 +232,10 @@ class ConfigObject(object):
       self.router.path = full_path
     # Magically discover via introspection appropriate config parsing methods.
     self.discover_parsing_methods()
-    self.call_parsing_methods(self.router)
+    if self.lazy:
+      self.call_parsing_methods_lazily(self.router)
+    else:
+      self.call_parsing_methods(self.router)
 
   def discover_parsing_methods(self):
     """A slightly magic way of discovering parsing methods.
@@ -61,30 +259,306 @@ class ConfigObject(object):
       for method in subclass_methods:
         result = getattr(subclass, method)()
 
+  def call_parsing_methods_lazily(self, router):
+    """Arrange for each discovered parsing method to be called on the
+    supplied router when one of the attributes it parses is first read.
+    Those attributes are taken off the router until then. Methods that
+    don't say what they parse are called straight away."""
+    pending = {}
+    for callables in self.parsing_methods:
+      for method in self.parsing_methods[callables]:
+        attributes = getattr(getattr(callables, method), 'parses', None)
+        if attributes is None:
+          self.call_parsing_method(router, callables, method)
+          continue
+        defaults = {}
+        for attribute in attributes:
+          if attribute in router.__dict__:
+            defaults[attribute] = router.__dict__.pop(attribute)
+        parse = functools.partial(self.call_parsing_method, router,
+                                  callables, method)
+        for attribute in attributes:
+          pending[attribute] = (parse, attributes, defaults)
+    router._pending_parsers = pending
 
-class BulkConfigs(ConfigObject):
-  """A configuration reader intended for processing in bulk."""
-  def __init__(self, root_dir):
-    super(BulkConfigs, self).__init__(root_dir)
-    self.routers = []
+  def call_parsing_method(self, router, callables, method):
+    """Call one parsing method on the supplied router."""
+    return getattr(callables(router), method)()
 
-  def process_dir(self, spec, type):
-    """Process a subtree of configs.
 
-    All of them must be of the supplied type, and match the 'spec' regex."""
-    self.discover_parsing_methods()
+class BulkConfigs(ConfigObject):
+  """A configuration reader intended for processing in bulk.
+
+  Given a cache_dir, each router parsed is also saved there (pickled,
+  without its parsed_config), keyed by a hash of the config's contents,
+  its type and the version of the parser (see cache_key). A config seen
+  before, by any BulkConfigs using that cache_dir, is then loaded from
+  there instead of being parsed again. Only point cache_dir at a directory you trust. Lazily parsed
+  routers are not cached, as they haven't been parsed yet."""
+  def __init__(self, root_dir, cache_dir=None, lazy=False):
+    super(BulkConfigs, self).__init__(root_dir, lazy)
+    self.routers = []
+    # (filename, traceback) for each config that failed to parse.
+    self.failures = []
+    # What process_dir was last asked for, and what it found; see refresh.
+    self.spec = None
+    self.type = None
+    self.workers = None
+    self.file_states = {}
+    self.routers_by_file = {}
+    self.cache_dir = cache_dir
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def find_files(self, spec):
+    """The files under root_dir matching the 'spec' regex, in a fixed
+    (sorted) order."""
+    filenames = []
     for top, dirs, files in os.walk(self.root_dir):
-      for nm in files:
+      dirs.sort()
+      for nm in sorted(files):
         total_filename = os.path.join(top, nm)
-        if not re.match(spec, total_filename):
-          continue
-        if type == constants.Types.DEFAULT_CISCO:
-          router = abstract_network_device.CiscoRouter()
-        parsed = ciscoconfparse.CiscoConfParse(total_filename)
-        router.parsed_config = parsed
+        if re.match(spec, total_filename):
+          filenames.append(total_filename)
+    return filenames
+
+  def process_file(self, total_filename, type):
+    """Parse a single config, run the parsing methods over it and return
+    the router; or, if it is in the cache, return the cached router."""
+    if self.cache_dir is not None:
+      config = open(total_filename, 'rb')
+      try:
+        key = self.cache_key(config.read(), type)
+      finally:
+        config.close()
+      router = self.load_cached(key)
+      if router is not None:
         router.path = total_filename
-        self.call_parsing_methods(router)
+        return router
+    if type == constants.Types.DEFAULT_CISCO:
+      router = abstract_network_device.CiscoRouter()
+    parsed = ciscoconfparse.CiscoConfParse(total_filename)
+    router.parsed_config = parsed
+    router.path = total_filename
+    if self.lazy:
+      self.call_parsing_methods_lazily(router)
+      return router
+    self.call_parsing_methods(router)
+    if self.cache_dir is not None:
+      self.save_cached(key, router)
+    return router
+
+  def cache_key(self, contents, type):
+    """The key a router parsed from contents, a config of the given type,
+    is cached under."""
+    digest = hashlib.sha1("%d:%s:%d:" % (PARSER_VERSION, _ParserDigest(),
+                                         type))
+    digest.update(contents)
+    return digest.hexdigest()
+
+  def load_cached(self, key):
+    """Return the router cached under key, or None if there isn't one (or
+    it can't be read)."""
+    try:
+      cached = open(os.path.join(self.cache_dir, key), 'rb')
+    except IOError:
+      return None
+    try:
+      try:
+        return cPickle.load(cached)
+      except Exception:
+        # Truncated, or from an incompatible model: parse again, and
+        # overwrite it.
+        return None
+    finally:
+      cached.close()
+
+  def save_cached(self, key, router):
+    """Cache router, without its parsed config, under key. The file is
+    written under a temporary name and renamed into place, so neither
+    process_dir workers nor concurrent runs see it half-written."""
+    parsed_config, config_index = router.parsed_config, router.config_index
+    router.parsed_config = None
+    router.config_index = None
+    try:
+      path = os.path.join(self.cache_dir, key)
+      temporary = "%s.%d" % (path, os.getpid())
+      output = open(temporary, 'wb')
+      try:
+        cPickle.dump(router, output, cPickle.HIGHEST_PROTOCOL)
+      finally:
+        output.close()
+      os.rename(temporary, path)
+    finally:
+      router.parsed_config = parsed_config
+      router.config_index = config_index
+
+  def process_dir(self, spec, type, workers=None):
+    """Process a subtree of configs.
+
+    All of them must be of the supplied type, and match the 'spec' regex.
+
+    If workers is more than one, the configs are parsed in a pool of that
+    many processes. The routers come back without their parsed_config,
+    which is large and slow to send between processes, but otherwise as
+    parsed, and in the same order either way. Either way, a config that
+    fails to parse is recorded in self.failures, with its traceback,
+    rather than stopping the rest. Workers can't parse lazily, since their
+    routers leave their parsed_config behind.
+
+    See refresh for bringing the routers up to date afterwards."""
+    if self.lazy and workers is not None and workers > 1:
+      raise ValueError("Lazy parsing can't use workers")
+    self.spec = spec
+    self.type = type
+    self.workers = workers
+    filenames = self.find_files(spec)
+    for total_filename in filenames:
+      self.file_states[total_filename] = self.file_state(total_filename)
+    for total_filename, router, error in self.process_files(filenames, type,
+                                                           workers):
+      if router is None:
+        self.failures.append((total_filename, error))
+      else:
         self.routers.append(router)
+        self.routers_by_file[total_filename] = router
+
+  def process_files(self, filenames, type, workers):
+    """Yield (filename, router, traceback) for each of filenames, in
+    order, as process_dir describes."""
+    if workers is None or workers <= 1:
+      if not self.parsing_methods:
+        self.discover_parsing_methods()
+      for total_filename in filenames:
+        try:
+          router = self.process_file(total_filename, type)
+        except Exception:
+          yield (total_filename, None, traceback.format_exc())
+        else:
+          yield (total_filename, router, None)
+      return
+    pool = multiprocessing.Pool(workers, _InitWorker, (self.cache_dir,))
+    try:
+      # Small chunks, so one slow config doesn't hold up the rest.
+      results = pool.imap(_ProcessFileInWorker,
+                          [(total_filename, type)
+                           for total_filename in filenames],
+                          chunksize=4)
+      for result in results:
+        yield result
+    finally:
+      pool.close()
+      pool.join()
+
+  def file_state(self, total_filename, previous=None):
+    """Return (mtime, size, SHA-1 of the contents) for a config. If the
+    mtime and size match those of previous, an earlier state of the same
+    file, it is taken to be unchanged, and its SHA-1 is not recomputed."""
+    stat = os.stat(total_filename)
+    if previous is not None and previous[:2] == (stat.st_mtime,
+                                                 stat.st_size):
+      return previous
+    config = open(total_filename, 'rb')
+    try:
+      digest = hashlib.sha1(config.read()).hexdigest()
+    finally:
+      config.close()
+    return (stat.st_mtime, stat.st_size, digest)
+
+  def refresh(self):
+    """Bring the routers up to date with the configs under root_dir, as
+    matched by the spec last given to process_dir: parse just the configs
+    added or changed since, and drop the routers of any removed.
+
+    A config counts as changed if its contents are: one only touched is
+    not parsed again. Returns (added, modified, removed), lists of the
+    filenames concerned."""
+    if self.spec is None:
+      raise ValueError("refresh() needs an earlier process_dir()")
+    filenames = self.find_files(self.spec)
+    added = []
+    modified = []
+    # The states of changed configs are only recorded once they have been
+    # parsed, so that any left unparsed by an exception are tried again.
+    new_states = {}
+    for total_filename in filenames:
+      previous = self.file_states.get(total_filename)
+      state = self.file_state(total_filename, previous)
+      if previous is None:
+        added.append(total_filename)
+        new_states[total_filename] = state
+      elif state[2] != previous[2]:
+        modified.append(total_filename)
+        new_states[total_filename] = state
+      else:
+        self.file_states[total_filename] = state
+    current = set(filenames)
+    removed = sorted(total_filename for total_filename in self.file_states
+                     if total_filename not in current)
+    for total_filename in removed:
+      del self.file_states[total_filename]
+    stale = set(modified).union(removed)
+    for total_filename in stale:
+      self.routers_by_file.pop(total_filename, None)
+    self.failures = [failure for failure in self.failures
+                     if failure[0] not in stale]
+    changed = sorted(added + modified)
+    for total_filename, router, error in self.process_files(changed,
+                                                           self.type,
+                                                           self.workers):
+      self.file_states[total_filename] = new_states[total_filename]
+      if router is None:
+        self.failures.append((total_filename, error))
+      else:
+        self.routers_by_file[total_filename] = router
+    self.failures.sort()
+    self.routers = [self.routers_by_file[total_filename]
+                    for total_filename in filenames
+                    if total_filename in self.routers_by_file]
+    return (added, modified, removed)
+
+
+# The BulkConfigs each process_dir worker process parses with.
+_worker_configs = None
+
+def _ParserDigest():
+  """A digest of the source of the parsing methods (wherever their
+  ReadConfig subclasses are) and the router model, and of the version of ciscoconfparse, so that routers cached before any
+  of them changed are not loaded after."""
+  global _parser_digest
+  if _parser_digest is None:
+    digest = hashlib.sha1(getattr(ciscoconfparse, "__version__", ""))
+    modules = set([sys.modules[__name__], abstract_network_device])
+    for subclass in ReadConfig.__subclasses__():
+      modules.add(sys.modules[subclass.__module__])
+    for module in sorted(modules, key=lambda module: module.__name__):
+      try:
+        digest.update(inspect.getsource(module))
+      except (IOError, TypeError):
+        # No source to be had; PARSER_VERSION will have to do.
+        digest.update(module.__name__)
+    _parser_digest = digest.hexdigest()
+  return _parser_digest
+
+def _InitWorker(cache_dir):
+  """Set up a process_dir worker, discovering the parsing methods once
+  rather than for every config."""
+  global _worker_configs
+  _worker_configs = BulkConfigs(root_dir=None, cache_dir=cache_dir)
+  _worker_configs.discover_parsing_methods()
+
+def _ProcessFileInWorker(args):
+  """process_file, in a worker. Returns (filename, router, None), with the
+  router's parsed config dropped, or (filename, None, traceback) if
+  anything went wrong."""
+  total_filename, type = args
+  try:
+    router = _worker_configs.process_file(total_filename, type)
+  except Exception:
+    return (total_filename, None, traceback.format_exc())
+  router.parsed_config = None
+  router.config_index = None
+  return (total_filename, router, None)
 
 
 class ReadConfig(object):
@@ -94,6 +568,7 @@ class ReadConfig(object):
   abstract router model in abstract_network_device."""
   def __init__(self, router):
     self.router = router
+    self.config_index = ConfigIndex.For(router)
 
   def find_lines_regexp(self, regexp, named=None):
     """Find a regular expression in the config.
@@ -101,7 +576,7 @@ class ReadConfig(object):
     Returns: either all of it, or the specific named
       variable matches."""
     total_results = []
-    result = self.router.parsed_config.find_lines(regexp)
+    result = self.config_index.find_lines(regexp)
     find_obj = re.compile(regexp)
     matches = []
     for items in result:
@@ -127,16 +602,14 @@ class ReadConfig(object):
     parent_matches = []
     orphan_matches = []
     # Find all parents matching parentspec.
-    parents = self.router.parsed_config.find_parents_w_child(parent,
-                                                             child)
+    parents = self.config_index.find_parents_w_child(parent, child)
     find_obj = re.compile(parent)
     find_obj2 = re.compile(child)
     for parent in parents:
       if debug:
         print "PARENT", parent
       parent_match = find_obj.search(parent).groups(named_parent)
-      children = self.router.parsed_config.find_all_children(parent,
-                                                             child)
+      children = self.config_index.find_all_children(parent)
       # API always returns parent, even though you care only about children,
       # so remove it from consideration.
       orphans = children[1:]
@@ -177,6 +650,7 @@ class ReadCiscoConfig(ReadConfig):
 
 class Versioning(ReadConfig):
 
+  @parses('_os_version')
   def os_version(self):
     """What is the router's OS version?"""
     find_string = ("^version (?P<ver>%s)$" % (constants.Regex.SINGLE_STRING))
@@ -189,6 +663,7 @@ class Versioning(ReadConfig):
 
 class NetworkManagement(ReadConfig):
 
+  @parses('_snmp_servers', 'snmp_version')
   def snmp_servers(self):
     """What are the router's SNMP servers?"""
     # snmp-server host 10.241.64.92 version 2c public
@@ -207,6 +682,7 @@ class NetworkManagement(ReadConfig):
       self.router.snmp_version = versions[0] # Ugh.
       return snmp_data
 
+  @parses('snmp_community')
   def snmp_community(self):
     """What's the SNMP community string?"""
     find_string = "^snmp-server community public R[OW] (?P<comm>%s)$" % (
@@ -218,6 +694,7 @@ class NetworkManagement(ReadConfig):
       self.router.snmp_community = None
     return comm
 
+  @parses('trap_source')
   def snmp_trap_source(self):
     """Where does the router send SNMP traps from?"""
     # snmp-server trap-source <int>
@@ -230,17 +707,19 @@ class NetworkManagement(ReadConfig):
 
 class Security(ReadConfig):
 
+  @parses('_password_encryption')
   def password_encryption(self):
     """Does the router have password encryption turned on?"""
     # service password-encryption
     find_string = "^service password-encryption"
-    password_encryption = self.router.parsed_config.find_lines(find_string)
+    password_encryption = self.config_index.find_lines(find_string)
     if password_encryption:
       self.router.password_encryption = True
     else:
       self.router.password_encryption = False
     return password_encryption
 
+  @parses('_ssh_server')
   def ssh_server(self):
     """Does the router have an SSH server turned on?
 
@@ -256,6 +735,7 @@ class Security(ReadConfig):
       self.router.ssh_server = None
     return ssh_version
 
+  @parses('_acls')
   def standard_acls(self):
     """Does the router have 'standard' ACLs? Assemble them."""
     access_list_data = self.find_lines_regexp(constants.Regex.STANDARD_ACL,
@@ -277,6 +757,7 @@ class Security(ReadConfig):
     # {'action': 'permit', 'src': '172.16.16.0'}
     return acldict
 
+  @parses()
   def extended_acls(self):
     parent = "^ip access-list (standard|extended) (?P<id>%s)" % (
       constants.Regex.SINGLE_STRING)
@@ -289,16 +770,18 @@ class Security(ReadConfig):
     # print "ACCESS_LIST_DATA", access_list_data
     return access_list_data
 
+  @parses('aaa_newmodel')
   def aaa_newmodel(self):
     """Does the router have AAA new-model turned on?"""
     find_string = constants.Regex.AAA_NEWMODEL
-    aaa_newmodel = self.router.parsed_config.find_lines(find_string)
+    aaa_newmodel = self.config_index.find_lines(find_string)
     if aaa_newmodel:
       self.router.aaa_newmodel = True
     else:
       self.router.aaa_newmodel = False
     return aaa_newmodel
 
+  @parses('_tacacs_servers')
   def tacacs_servers(self):
     """Does the router have any TACACS servers?"""
     find_string = constants.Regex.TACACS_SERVERS
@@ -310,6 +793,7 @@ class Security(ReadConfig):
       self.router.tacacs_servers = tacacs_servers
       return tacacs_servers
 
+  @parses('_tacacs_key')
   def tacacs_key(self):
     """Does the router have a TACACS server key set?"""
     find_string = constants.Regex.TACACS_KEY
@@ -322,11 +806,12 @@ class Security(ReadConfig):
   
 class AntiDoS(ReadConfig):
 
+  @parses('_source_routing')
   def source_route(self):
     """IP source routing is deprecated."""
     # no ip source-route
     find_string = "^no ip source-route"
-    source_route = self.router.parsed_config.find_lines(find_string)
+    source_route = self.config_index.find_lines(find_string)
     if source_route:
       self.router.source_routing = False
     else:
@@ -335,6 +820,7 @@ class AntiDoS(ReadConfig):
 
 class Naming(ReadConfig):
 
+  @parses('_hostname')
   def has_hostname(self):
     """What's the router's hostname?"""
     find_string = "^hostname (?P<host>%s)$" % (constants.Regex.SINGLE_STRING)
@@ -342,6 +828,7 @@ class Naming(ReadConfig):
     self.router.hostname = hostname[0]
     return hostname
 
+  @parses('_domain_name')
   def has_domain_name(self):
     """Does the router have a domain name configured?"""
     find_string = "^(ip|domain) domain[ -]name (?P<dom>%s)$" % (constants.Regex.SINGLE_STRING)
@@ -352,6 +839,7 @@ class Naming(ReadConfig):
       self.router.domain_name = domain_name[0]
     return domain_name
 
+  @parses('_resolvers')
   def has_resolvers(self):
     """Does the router have DNS resolvers configured?"""
     find_string = "^(ip|domain) name[ -]server (?P<res>%s)$" % (constants.Regex.ANY_ADDR)
@@ -364,6 +852,7 @@ class Naming(ReadConfig):
 
 class Timing(ReadConfig):
 
+  @parses('_timezone')
   def has_timezone(self):
     """What timezone is the router operating on?"""
     find_string = "^clock timezone (?P<tz>%s) (?P<offset>%s)$" % (
@@ -372,6 +861,7 @@ class Timing(ReadConfig):
     self.router.timezone = timezone
     return timezone
 
+  @parses('_ntp_servers')
   def has_ntp_servers(self):
     """Does the router have NTP servers?"""
     find_string = "^ntp server (?P<host>%s)$" % (
@@ -398,6 +888,7 @@ class Timing(ReadConfig):
       self.router.ntp_servers = ntp_server_data
       return ntp_server_data
 
+  @parses('_ntp_source')
   def has_ntp_source_int(self):
     """Does the router set a source interface for its NTP communications?"""
     find_string = "^ntp server (?P<srv>%s) source (?P<int>%s)|^ntp source (?P<int2>%s)" % (
@@ -413,6 +904,7 @@ class Timing(ReadConfig):
 
 class Routing(ReadConfig):
 
+  @parses('static_routes', '_static_routes')
   def has_static_routes(self):
     find_string = "^ip route (?P<netw1>%s) (?P<netm1>%s) (?P<intf>%s)|" \
                   "^ip route (?P<netw2>%s) (?P<netm2>%s) (?P<destaddr>%s) (?P<metric>%s)|" \
@@ -464,6 +956,8 @@ class Routing(ReadConfig):
 class Access(ReadConfig):
   """Access to the router - consoles, vtys, etc."""
 
+  @parses('_console_config', '_console_password',
+          'console_timeouts')
   def line_console(self):
     """Does the router control console access?"""
     parent = "^line con (?P<id>.*$)"
@@ -486,6 +980,7 @@ class Access(ReadConfig):
           self.router.console_timeouts = console_spec['timeo']
     return con_transport
 
+  @parses('_vty_configs')
   def line_vty(self):
     """Does the router control vty access?"""
     parent = "^line vty (?P<id>%s$)" % (constants.Regex.GREEDY_STRING)
@@ -508,6 +1003,7 @@ class Access(ReadConfig):
 class Interfaces(ReadConfig):
   """Interfaces and addresses."""
 
+  @parses('_interfaces')
   def interfaces(self):
     """What interfaces are on the machine, in what state, with what
     addresses?"""
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_parsing.py
+
+Checks that every config was parsed, so that none is left out of the
+other tests unnoticed.
+"""
+
+import config_parse
+import constants
+import test_infrastructure as ti
+# Perhaps unittest2 is available. Try to import it, for
+# those cases where we are running python 2.7.
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+def suite():
+  tests = ['testAllConfigsParsed']
+  return unittest.TestSuite(map(TestBulkParsing, tests))
+
+
+class TestBulkParsing(ti.defaultTestConfiguration):
+
+  def testAllConfigsParsed(self):
+    results = ["%s:\n%s" % (filename, error)
+               for filename, error in self.cp.failures]
+    self.assertEqual(results, [],
+      "These configs could not be parsed, so are in no other test:\n%s" %
+        "\n".join(results))
+
+if __name__ == '__main__':
+  suite = suite()
+  unittest.TextTestRunner(verbosity=2).run(suite)
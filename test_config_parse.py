@@ -10,7 +10,11 @@ import abstract_network_device
 import ciscoconfparse
 import config_parse
 import constants
+import os
 import pprint
+import shutil
+import tempfile
+import tree
 # Perhaps unittest2 is available. Try to import it, for
 # those cases where we are running python 2.7.
 try:
@@ -109,6 +113,60 @@ class TestConfigurationParsingInfrastructure(unittest.TestCase):
     self.assertEqual(result['bgp-15169-neighbors-filter'][0],
                      {'rem': 'PERMITS normal bgp neighbors in 15169 addressing blocks'})
 
+
+class TestConfigIndex(unittest.TestCase):
+
+  def setUp(self):
+    self.parsed = ciscoconfparse.CiscoConfParse("example/sr05.syd01")
+    self.index = config_parse.ConfigIndex(self.parsed)
+
+  def testLeadingWords(self):
+    self.assertEqual(config_parse._LeadingWords("^hostname (?P<h>\S+)$"),
+                     [('hostname', True)])
+    self.assertEqual(config_parse._LeadingWords("^(ip|domain) name[ -]server"),
+                     [('ip', True), ('domain', True)])
+    self.assertEqual(config_parse._LeadingWords("^ntp server (\S+)|^ntp source"),
+                     [('ntp', True), ('ntp', True)])
+    self.assertEqual(config_parse._LeadingWords("^(?P<fake>ntp)"),
+                     [('ntp', False)])
+    self.assertEqual(config_parse._LeadingWords("^aaa new-model"),
+                     [('aaa', True)])
+    for regexp in ["tacacs-server host (\S+)", "^ip\s+route", "^ntps? server",
+                   "^(ip|domain)? name", "^hostname|domain"]:
+      self.assertEqual(config_parse._LeadingWords(regexp), None, regexp)
+
+  def testSplitAlternatives(self):
+    self.assertEqual(config_parse._SplitAlternatives("^a (b|c)|^d [|]\\|e"),
+                     ["^a (b|c)", "^d [|]\\|e"])
+    self.assertEqual(config_parse._SplitAlternatives("^a []|]|^b"),
+                     ["^a []|]", "^b"])
+
+  def testFindLinesAgrees(self):
+    for regexp in ["^version (\S+)$", "^snmp-server", "^(ip|domain) name[ -]server",
+                   "^ntp server (\S+)|^ntp source", "^(?P<fake>ntp)",
+                   "server", "^ip route", "^interface", "^nothing here", "^!"]:
+      self.assertEqual(self.index.find_lines(regexp),
+                       self.parsed.find_lines(regexp), regexp)
+
+  def testFindParentsAgrees(self):
+    for parent, child in [("^line vty (?P<id>.*$)", "transport input"),
+                          ("^interface (?P<int>\S+)", "description (?P<d>.*)"),
+                          ("ip access-list extended (?P<aclid>\S+)", "permit tcp"),
+                          ("^(?P<fake>ntp)", "server")]:
+      parents = self.index.find_parents_w_child(parent, child)
+      self.assertEqual(parents, self.parsed.find_parents_w_child(parent, child))
+      for parent_line in parents:
+        self.assertEqual(self.index.find_all_children(parent_line),
+                         self.parsed.find_all_children(parent_line, True))
+
+  def testIndexFollowsRouter(self):
+    router = abstract_network_device.CiscoRouter()
+    router.parsed_config = self.parsed
+    index = config_parse.ConfigIndex.For(router)
+    self.assertTrue(config_parse.ConfigIndex.For(router) is index)
+    router.parsed_config = ciscoconfparse.CiscoConfParse("example/br-tra-1")
+    self.assertFalse(config_parse.ConfigIndex.For(router) is index)
+
     
 class TestIsolatedConfigurationParsing(unittest.TestCase):
 
@@ -160,6 +218,28 @@ class TestACLs(unittest.TestCase):
     """It's an outrage this has to be here."""
     acl = abstract_network_device.AccessLists()
     self.assertEqual(acl.de_ciscoise("0.0.0.63"), "255.255.255.192")
+
+  def testCompareACLs(self):
+    acl = abstract_network_device.AccessLists()
+    acl.create_and_add_acl({
+      '1': [{'action': 'permit', 'src': '10.0.0.0', 'netm': '0.255.255.255'},
+            {'action': 'deny', 'src': '192.0.2.0', 'netm': '0.0.0.255'}],
+      '2': [{'action': 'permit', 'src': '10.0.0.0', 'netm': '0.127.255.255'},
+            {'action': 'permit', 'src': '10.128.0.0', 'netm': '0.127.255.255'}]})
+    self.assertFalse(acl.compare_by_aclid('1', acl.acls['2']))
+    self.assertEqual(acl.difference_by_aclid('1', acl.acls['2']),
+                     ['192.0.2.0/24'])
+    self.assertEqual(acl.difference_by_aclid('2', acl.acls['1']), [])
+
+  @unittest.skipIf(tree.numpy is None, "numpy is not installed")
+  def testClassifyByACL(self):
+    acl = abstract_network_device.AccessLists()
+    acl.create_and_add_acl({
+      '1': [{'action': 'permit', 'src': '10.0.0.0', 'netm': '0.255.255.255'},
+            {'action': 'deny', 'src': '10.1.0.0', 'netm': '0.0.255.255'}]})
+    self.assertEqual(list(acl.classify_by_aclid(
+                       '1', [0x0a000001, 0x0a010203, 0x0b000001], 'none')),
+                     ['permit in acl 1', 'deny in acl 1', 'none'])
     
   def testInstantiateACLs(self):
     # TODO: fix this
@@ -344,6 +424,213 @@ class TestBulkConfigurationParsing(unittest.TestCase):
       self.assertTrue(entity.hostname in ['acc-sw-10-43-22', 'dub3-br-tra-r1', 'sr05.syd01'])
       self.assertTrue(entity.domain_name in ['amazon.com', 'net.google.com'])
 
+class TestParallelBulkParsing(unittest.TestCase):
+
+  def setUp(self):
+    self.serial = config_parse.BulkConfigs(root_dir="example")
+    self.serial.process_dir(type=constants.Types.DEFAULT_CISCO, spec=".*1$")
+
+  def testSameAsSerial(self):
+    cp = config_parse.BulkConfigs(root_dir="example")
+    cp.process_dir(type=constants.Types.DEFAULT_CISCO, spec=".*1$",
+                   workers=2)
+    self.assertEqual(cp.failures, [])
+    self.assertEqual([r.hostname for r in cp.routers],
+                     [r.hostname for r in self.serial.routers])
+    for parallel, serial in zip(cp.routers, self.serial.routers):
+      self.assertEqual(parallel.parsed_config, None)
+      self.assertEqual(parallel.interfaces, serial.interfaces)
+      self.assertEqual(parallel.vty_configs, serial.vty_configs)
+
+  def testFailureDoesNotStopTheRest(self):
+    self.failureDoesNotStopTheRest(2)
+
+  def testFailureDoesNotStopTheRestSerially(self):
+    self.failureDoesNotStopTheRest(1)
+
+  def failureDoesNotStopTheRest(self, workers):
+    directory = tempfile.mkdtemp()
+    try:
+      shutil.copy("example/sr05.syd01", os.path.join(directory, "a1"))
+      open(os.path.join(directory, "b1"), "w").close()
+      shutil.copy("example/br-tra-1", os.path.join(directory, "c1"))
+      cp = config_parse.BulkConfigs(root_dir=directory)
+      cp.process_dir(type=constants.Types.DEFAULT_CISCO, spec=".*1$",
+                     workers=workers)
+      self.assertEqual([r.hostname for r in cp.routers],
+                       ['sr05.syd01', 'dub3-br-tra-r1'])
+      self.assertEqual([failure[0] for failure in cp.failures],
+                       [os.path.join(directory, "b1")])
+      self.assertIn("IndexError", cp.failures[0][1])
+    finally:
+      shutil.rmtree(directory)
+
+class TestLazyBulkParsing(unittest.TestCase):
+
+  def setUp(self):
+    self.eager = config_parse.BulkConfigs(root_dir="example")
+    self.eager.process_dir(type=constants.Types.DEFAULT_CISCO, spec=".*1$")
+    self.cp = config_parse.BulkConfigs(root_dir="example", lazy=True)
+    self.cp.process_dir(type=constants.Types.DEFAULT_CISCO, spec=".*1$")
+
+  def testSameAsEager(self):
+    self.assertEqual([r.hostname for r in self.cp.routers],
+                     [r.hostname for r in self.eager.routers])
+    for lazy, eager in zip(self.cp.routers, self.eager.routers):
+      self.assertEqual(lazy.domain_name, eager.domain_name)
+      self.assertEqual(lazy.interfaces, eager.interfaces)
+      self.assertEqual(lazy.vty_configs, eager.vty_configs)
+      self.assertEqual(lazy.static_routes, eager.static_routes)
+      self.assertEqual(list(lazy.acls), list(eager.acls))
+      self.assertEqual(lazy.ntp_servers, eager.ntp_servers)
+      self.assertEqual(lazy.console_timeouts, eager.console_timeouts)
+
+  def testParsedOnFirstRead(self):
+    router = self.cp.routers[0]
+    self.assertIn('_hostname', router._pending_parsers)
+    self.assertNotIn('_hostname', vars(router))
+    router.hostname
+    self.assertNotIn('_hostname', router._pending_parsers)
+    self.assertIn('_interfaces', router._pending_parsers)
+
+  def testSettingTheWholeGroup(self):
+    router = self.cp.routers[0]
+    router.console_timeouts
+    for attribute in ['_console_config', '_console_password']:
+      self.assertNotIn(attribute, router._pending_parsers)
+      self.assertIn(attribute, vars(router))
+
+  def testMissingAttribute(self):
+    router = self.cp.routers[0]
+    self.assertRaises(AttributeError, getattr, router, 'no_such_attribute')
+    self.assertFalse(hasattr(router, 'no_such_attribute'))
+
+  def testNoWorkers(self):
+    self.assertRaises(ValueError, self.cp.process_dir,
+                      type=constants.Types.DEFAULT_CISCO, spec=".*1$",
+                      workers=2)
+
+class TestCachedBulkParsing(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.configs = os.path.join(self.directory, "configs")
+    self.cache = os.path.join(self.directory, "cache")
+    os.mkdir(self.configs)
+    for name in ["sr05.syd01", "br-tra-1"]:
+      shutil.copy(os.path.join("example", name), self.configs)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def process(self, workers=None):
+    cp = config_parse.BulkConfigs(root_dir=self.configs, cache_dir=self.cache)
+    cp.process_dir(type=constants.Types.DEFAULT_CISCO, spec=".*1$",
+                   workers=workers)
+    return cp.routers
+
+  def testHit(self):
+    first = self.process()
+    self.assertEqual(len(os.listdir(self.cache)), 2)
+    for workers in [None, 2]:
+      second = self.process(workers)
+      self.assertEqual([r.parsed_config for r in second], [None, None])
+      self.assertEqual([r.path for r in second], [r.path for r in first])
+      for cached, parsed in zip(second, first):
+        self.assertEqual(cached.hostname, parsed.hostname)
+        self.assertEqual(cached.interfaces, parsed.interfaces)
+        self.assertEqual(cached.vty_configs, parsed.vty_configs)
+    # The routers handed back on a miss still have their parsed config.
+    self.assertNotEqual(first[0].parsed_config, None)
+
+  def testChangedConfig(self):
+    self.process()
+    config = open(os.path.join(self.configs, "sr05.syd01"), "a")
+    config.write("ntp server 192.0.2.123\n")
+    config.close()
+    routers = self.process()
+    self.assertNotEqual(routers[1].parsed_config, None)
+    self.assertIn('192.0.2.123', routers[1].ntp_servers)
+    self.assertEqual(routers[0].parsed_config, None)
+    self.assertEqual(len(os.listdir(self.cache)), 3)
+
+  def testChangedParser(self):
+    self.process()
+    digest = config_parse._ParserDigest()
+    # As if the parsing methods had been edited since.
+    config_parse._parser_digest = "edited"
+    try:
+      routers = self.process()
+    finally:
+      config_parse._parser_digest = digest
+    self.assertNotEqual(routers[0].parsed_config, None)
+    self.assertEqual(len(os.listdir(self.cache)), 4)
+
+  def testCorruptCacheEntry(self):
+    self.process()
+    for name in os.listdir(self.cache):
+      open(os.path.join(self.cache, name), "w").write("not a pickle")
+    routers = self.process()
+    self.assertNotEqual(routers[0].parsed_config, None)
+    self.assertEqual(self.process()[0].parsed_config, None)
+
+class TestRefresh(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    for name in ["sr05.syd01", "br-tra-1"]:
+      shutil.copy(os.path.join("example", name), self.directory)
+    self.cp = config_parse.BulkConfigs(root_dir=self.directory)
+    self.cp.process_dir(type=constants.Types.DEFAULT_CISCO, spec=".*1$")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def path(self, name):
+    return os.path.join(self.directory, name)
+
+  def testNothingChanged(self):
+    routers = list(self.cp.routers)
+    self.assertEqual(self.cp.refresh(), ([], [], []))
+    self.assertEqual(self.cp.routers, routers)
+    # Touching a config without changing it doesn't count.
+    os.utime(self.path("sr05.syd01"), (0, 0))
+    self.assertEqual(self.cp.refresh(), ([], [], []))
+    self.assertEqual(self.cp.routers, routers)
+
+  def testDelta(self):
+    br_tra = self.cp.routers[0]
+    config = open(self.path("sr05.syd01"), "a")
+    config.write("ntp server 192.0.2.123\n")
+    config.close()
+    shutil.copy(self.path("br-tra-1"), self.path("another-1"))
+    os.remove(self.path("br-tra-1"))
+    self.assertEqual(self.cp.refresh(),
+                     ([self.path("another-1")], [self.path("sr05.syd01")],
+                      [self.path("br-tra-1")]))
+    self.assertEqual([r.path for r in self.cp.routers],
+                     [self.path("another-1"), self.path("sr05.syd01")])
+    self.assertFalse(br_tra in self.cp.routers)
+    self.assertIn('192.0.2.123', self.cp.routers[1].ntp_servers)
+    self.assertEqual(self.cp.refresh(), ([], [], []))
+
+  def testFailuresAreRetried(self):
+    cp = config_parse.BulkConfigs(root_dir=self.directory)
+    cp.process_dir(type=constants.Types.DEFAULT_CISCO, spec=".*1$",
+                   workers=2)
+    open(self.path("broken-1"), "w").close()
+    self.assertEqual(cp.refresh(), ([self.path("broken-1")], [], []))
+    self.assertEqual([failure[0] for failure in cp.failures],
+                     [self.path("broken-1")])
+    shutil.copy(self.path("sr05.syd01"), self.path("broken-1"))
+    self.assertEqual(cp.refresh(), ([], [self.path("broken-1")], []))
+    self.assertEqual(cp.failures, [])
+    self.assertEqual(len(cp.routers), 3)
+
+  def testNeedsProcessDir(self):
+    cp = config_parse.BulkConfigs(root_dir=self.directory)
+    self.assertRaises(ValueError, cp.refresh)
+
 class TestBulkSecurity(unittest.TestCase):
 
   def setUp(self):
@@ -28,7 +28,15 @@ class defaultTestConfiguration(unittest.TestCase):
       pattern = os.environ['SPEC']
     except KeyError:
       pattern = '1$'
-    sc = SingletonConfigCaching(directory, pattern)
+    try:
+      workers = int(os.environ['WORKERS'])
+    except KeyError:
+      workers = None
+    # An empty CACHE, as from the Makefile, means no cache.
+    cache_dir = os.environ.get('CACHE') or None
+    # Likewise an empty LAZY means parse everything up front.
+    lazy = bool(os.environ.get('LAZY'))
+    sc = SingletonConfigCaching(directory, pattern, workers, cache_dir, lazy)
     cls.cp = sc._cached['cp']
 
   maxDiff = None
@@ -83,12 +91,15 @@ class SingletonConfigCaching(object):
   _cached = {}
   _cached['cp'] = None
   
-  def __init__(self, directory, pattern):
+  def __init__(self, directory, pattern, workers=None, cache_dir=None,
+               lazy=False):
     if self._cached['cp'] is None:
-      x = config_parse.BulkConfigs(root_dir=directory)
+      x = config_parse.BulkConfigs(root_dir=directory, cache_dir=cache_dir,
+                                   lazy=lazy)
       self._cached['cp'] = x
       self._cached['cp'].process_dir(spec=pattern,
-                                     type=constants.Types.DEFAULT_CISCO)
+                                     type=constants.Types.DEFAULT_CISCO,
+                                     workers=workers)
 
 def skipUnlessHasattr(obj, attr):
   if hasattr(obj, attr):
@@ -6,7 +6,11 @@
 
 import sys
 import constants
+import copy
+import os
 import random
+import shutil
+import tempfile
 import tree
 # Perhaps unittest2 is available. Try to import it, for
 # those cases where we are running python 2.7.
@@ -150,6 +154,42 @@ class TreeTest(unittest.TestCase):
       self.failUnless(x in ['0.0.0.0/2', '64.0.0.0/2', 
                             '128.0.0.0/2', '192.0.0.0/2'])
 
+  def test_tree_generate_for_prefix_int(self):
+    self.assertEqual(list(self.t.GenerateForPrefixInt(2)),
+                     [(0, 2), (0x40000000, 2), (0x80000000, 2),
+                      (0xc0000000, 2)])
+    self.assertEqual(list(self.t.GenerateForPrefixInt(0)), [(0, 0)])
+
+  def test_tree_generate_for_prefix_variance(self):
+    for count, variance in [(0, 1), (1, 2), (8, 1), (10, 3)]:
+      routes = list(self.t.GenerateForPrefixInt(count, variance, seed = 16))
+      self.assertEqual(routes, list(self.t.GenerateForPrefixInt(
+                                      count, variance, seed = 16)))
+      # In order, without overlaps or holes, and no more than variance
+      # prefixlengths away.
+      next_addr = 0
+      for addr, netlen in routes:
+        self.assertEqual(addr, next_addr)
+        self.failUnless(abs(netlen - count) <= variance)
+        next_addr = addr + (1 << (32 - netlen))
+      self.assertEqual(next_addr, 1 << 32)
+    lengths = set(netlen for addr, netlen in
+                  self.t.GenerateForPrefixInt(8, 2, seed = 16))
+    self.assertEqual(lengths, set([6, 7, 8, 9, 10]))
+    self.assertEqual(list(self.t.GenerateForPrefix(8, 1, seed = 3))[:3],
+                     ['0.0.0.0/7', '2.0.0.0/8', '3.0.0.0/8'])
+
+  @unittest.skipIf(tree.numpy is None, "numpy is not installed")
+  def test_tree_generate_for_prefix_arrays(self):
+    addresses, netlens = self.t.GenerateForPrefixArrays(16)
+    self.assertEqual(len(addresses), 65536)
+    self.assertEqual(list(addresses[:2]), [0, 65536])
+    self.assertEqual(int(addresses[-1]), 0xffff0000)
+    self.assertEqual(set(netlens), set([16]))
+    addresses, netlens = self.t.GenerateForPrefixArrays(8, 2, seed = 16)
+    self.assertEqual(zip(addresses, netlens),
+                     list(self.t.GenerateForPrefixInt(8, 2, seed = 16)))
+
   def test_tree_insert_default_route(self):
     obj = self.t.Insert('0.0.0.0/0', "test03point5", test_dup = False)
     self.assertEqual(obj, self.t.GetRoot())
@@ -298,6 +338,29 @@ class TreeTest(unittest.TestCase):
                            "Non-picks lookup get [%s] not none" % 
                            self.t.Lookup(item))
 
+  def test_tree_route_to_int(self):
+    self.assertEqual(self.t.RouteToInt('10.0.0.0/8'), (167772160, 8))
+    self.assertEqual(self.t.RouteToInt('127.0.0.1'), (2130706433, 32))
+    self.assertEqual(self.t.RouteToInt('10.0.0.0/255.0.0.0'), (167772160, 8))
+    self.assertEqual(self.t.RouteToInt('0.0.0.0/0'), (0, 0))
+
+  def test_tree_insert_int_matches_insert(self):
+    obj = self.t.InsertInt(0x892b0000, 16, "testInsertInt")
+    self.assertEqual(obj.GetPath(), "1000100100101011")
+    self.assertEqual(obj.GetLevel(), 16)
+    self.assertEqual(self.t.Lookup('137.43.0.0/16'), obj)
+    self.assertEqual(self.t.LookupInt(0x892b0000, 16), obj)
+    # Host bits past the prefix length are ignored.
+    self.assertEqual(self.t.LookupInt(0x892b1234, 16), obj)
+    self.assertEqual(self.t.LookupInt(0x89200000, 12).used, False)
+    self.assertEqual(self.t.LookupInt(0x89200000, 24), None)
+    self.assertEqual(False, self.t.InsertInt(0x892b0000, 16, "testInsertDup"))
+
+  def test_tree_lookup_int_used_check(self):
+    obj = self.t.Insert('10.0.0.0/8', "testLookupUsedCheck")
+    self.assertEqual(self.t.LookupInt(0x0a010000, 16), None)
+    self.assertEqual(self.t.LookupInt(0x0a010000, 16, used_check = True), obj)
+
   def test_insert_duplicate_fails(self):
     #self.t.debug=30
     obj1 = self.t.Insert('137.43.0.0/16', 'testInsertDup')
@@ -324,6 +387,89 @@ class TreeTest(unittest.TestCase):
     self.assertEqual(level1, 8)
     self.assertEqual(level2, 8)
 
+class TreeBulkInsertTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+
+  def test_tree_from_sorted(self):
+    routes = ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.2.0.0/16',
+              '192.168.0.0/16']
+    t = tree.Tree.FromSorted(routes, 'bulk')
+    self.assertEqual(list(t.IterateNodes(top_used = True)),
+                     ['10.0.0.0/8', '192.168.0.0/16'])
+    for route in routes:
+      self.assertEqual(t.Lookup(route).GetData(), 'bulk')
+    self.assertEqual(t.Lookup('10.1.2.0/24').GetLevel(), 24)
+    self.assertEqual(t.FindGap(8), '0.0.0.0/8')
+
+  def test_tree_bulk_insert_data(self):
+    count = self.t.BulkInsert([('10.0.0.0/8', 'a'), '10.1.0.0/16',
+                               ('11.0.0.0/8', 'b')], 'default')
+    self.assertEqual(count, 3)
+    self.assertEqual(self.t.Lookup('10.0.0.0/8').GetData(), 'a')
+    self.assertEqual(self.t.Lookup('10.1.0.0/16').GetData(), 'default')
+    self.assertEqual(self.t.Lookup('11.0.0.0/8').GetData(), 'b')
+
+  def test_tree_bulk_insert_duplicates(self):
+    self.t.Insert('10.1.0.0/16', 'existing')
+    count = self.t.BulkInsert(['10.0.0.0/16', '10.1.0.0/16', '10.1.0.0/16',
+                               '10.2.0.0/16'], 'bulk')
+    self.assertEqual(count, 2)
+    self.assertEqual(self.t.Lookup('10.1.0.0/16').GetData(), 'existing')
+    self.assertEqual(self.t.BulkInsert(['10.1.0.0/16'], 'again',
+                                       test_dup = False), 1)
+    self.assertEqual(self.t.Lookup('10.1.0.0/16').GetData(), 'again')
+
+  def test_tree_bulk_insert_unsorted(self):
+    self.assertRaises(ValueError, self.t.BulkInsert,
+                      ['10.1.0.0/16', '10.0.0.0/16'], 'bulk')
+    self.assertEqual(self.t.Lookup('10.1.0.0/16').GetData(), 'bulk')
+    # A covering route must come first.
+    self.assertRaises(ValueError, self.t.BulkInsert,
+                      ['10.0.0.0/16', '10.0.0.0/8'], 'bulk')
+
+  def test_tree_bulk_insert_propagate_used(self):
+    self.t.BulkInsert(self.t.GenerateForPrefix(2), 'quarter',
+                      propagate_used = True)
+    self.failUnless(self.t.GetRoot().used)
+    self.assertEqual(self.t.FindGap(8), None)
+    self.t = tree.Tree()
+    self.t.BulkInsert(['10.0.0.0/9', '10.128.0.0/9', '11.0.0.0/8'], 'half',
+                      propagate_used = True)
+    self.failUnless(self.t.Lookup('10.0.0.0/8').used)
+    self.failUnless(self.t.Lookup('10.0.0.0/7').used)
+    self.assertEqual(self.t.Lookup('10.0.0.0/7').GetData(),
+                     "Set by CheckRecursivelyUsed")
+    self.failIf(self.t.Lookup('8.0.0.0/6').used)
+
+  def test_tree_bulk_insert_matches_insert(self):
+    rng = random.Random(7)
+    prefixes = set()
+    for i in range(1000):
+      netlen = rng.randint(4, 20)
+      prefixes.add((rng.getrandbits(32) & tree._Mask(netlen), netlen))
+    prefixes = sorted(prefixes)
+    t2 = tree.Tree()
+    for addr, netlen in prefixes:
+      self.t.InsertInt(addr, netlen, (addr, netlen), propagate_used = True)
+    t2.BulkInsertInt([(addr, netlen, (addr, netlen))
+                      for addr, netlen in prefixes], propagate_used = True)
+    for addr, netlen in prefixes:
+      node = t2.LookupInt(addr, netlen)
+      self.assertEqual(node.GetData(),
+                       self.t.LookupInt(addr, netlen).GetData())
+      self.assertEqual(node.used, True)
+    self.assertEqual(list(t2.IterateNodes(top_used = True)),
+                     list(self.t.IterateNodes(top_used = True)))
+    self.assertEqual(t2.FindGap(24), self.t.FindGap(24))
+
+  def test_tree6_from_sorted(self):
+    t = tree.Tree.FromSorted(['2001:db8::/64', '2001:db8:0:1::/64'], 'lan',
+                             address_family = 6)
+    self.assertEqual(t.Lookup('2001:db8:0:1::/64').GetData(), 'lan')
+    self.assertEqual(t.FindGapFrom('::/0', 64), '::/64')
+
 class TreeTestGaps(unittest.TestCase):
 
   def setUp(self):
@@ -438,6 +584,93 @@ class TreeTestGaps(unittest.TestCase):
          else:
            print "??????"
 
+  def test_tree_find_gap_not_strict(self):
+    self.t.Insert('0.0.0.0/1', 'reason1')
+    self.assertEqual(self.t.FindGap(8, strict = False), '128.0.0.0/1')
+    self.t.Insert('128.0.0.0/8', 'reason2')
+    self.assertEqual(self.t.FindGap(8, strict = False), '129.0.0.0/8')
+    self.assertEqual(self.t.FindGap(16, strict = False), '129.0.0.0/8')
+    self.assertEqual(self.t.FindGap(16), '129.0.0.0/16')
+
+  def test_tree_find_gap_int(self):
+    self.t.Insert('0.0.0.0/8', 'reason1')
+    self.assertEqual(self.t.FindGapInt(8), (0x01000000, 8))
+    self.assertEqual(self.t.FindGapInt(0), None)
+
+  def test_tree_find_gap_fragmented(self):
+    # Use every other /24 in 10.0.0.0/16; the first free /23 is past it.
+    for x in range(0, 256, 2):
+      self.t.Insert('10.0.%d.0/24' % x, 'fragmented')
+    self.t.Insert('0.0.0.0/5', 'fragmented')
+    self.t.Insert('8.0.0.0/7', 'fragmented')
+    self.assertEqual(self.t.FindGap(24), '10.0.1.0/24')
+    self.assertEqual(self.t.FindGap(23), '10.1.0.0/23')
+    self.assertEqual(self.t.FindGapFrom('10.0.0.0/16', 23), None)
+    self.assertEqual(self.t.FindGapFrom('10.0.0.0/16', 25), '10.0.1.0/25')
+
+  def test_tree_find_gap_follows_used_flags(self):
+    node = self.t.Insert('0.0.0.0/1', 'reason1', mark_used = False)
+    self.t.Insert('128.0.0.0/1', 'reason2')
+    self.assertEqual(self.t.FindGap(1), '0.0.0.0/1')
+    node.used = True
+    self.assertEqual(self.t.FindGap(1), None)
+    node.used = False
+    self.assertEqual(self.t.FindGap(2), '0.0.0.0/2')
+
+  def test_tree_find_gap_after_recursive_marking(self):
+    self.t.Insert('10.0.0.0/9', 'reason1', mark_used = False)
+    self.t.Insert('10.0.0.0/10', 'reason1', propagate_used = True)
+    self.assertEqual(self.t.FindGapFrom('10.0.0.0/9', 10), '10.64.0.0/10')
+    self.t.Insert('10.64.0.0/10', 'reason2', propagate_used = True)
+    self.assertEqual(self.t.Lookup('10.0.0.0/9').used, True)
+    self.assertEqual(self.t.FindGapFrom('10.0.0.0/9', 10), None)
+
+  def test_tree_find_gap_from_under_used_supernet(self):
+    self.t.Insert('10.0.0.0/8', 'reason1')
+    self.t.Insert('10.1.0.0/16', 'reason2', mark_used = False)
+    self.assertEqual(self.t.FindGapFrom('10.1.0.0/16', 24), None)
+
+  def test_tree_find_gaps(self):
+    self.t.Insert('10.0.0.0/30', 'link')
+    self.t.Insert('10.0.0.8/29', 'link')
+    gaps = list(self.t.FindGapsFrom('10.0.0.0/27', 30))
+    self.assertEqual(gaps, ['10.0.0.4/30', '10.0.0.16/30', '10.0.0.20/30',
+                            '10.0.0.24/30', '10.0.0.28/30'])
+    self.assertEqual(list(self.t.FindGaps(30, count = 3)),
+                     ['0.0.0.0/30', '0.0.0.4/30', '0.0.0.8/30'])
+    self.assertEqual(list(self.t.FindGaps(1)), ['128.0.0.0/1'])
+    self.assertEqual(list(self.t.FindGapsFrom('10.0.0.8/29', 30)), [])
+    self.assertEqual(list(self.t.FindGapsFrom('192.168.0.0/16', 30)), [])
+
+  def test_tree_find_gaps_mark_used(self):
+    self.t.Insert('172.16.0.0/12', 'links', mark_used = False)
+    self.t.Insert('172.16.0.4/30', 'link')
+    allocated = list(self.t.FindGapsFrom('172.16.0.0/12', 30, count = 500,
+                                         mark_used = True,
+                                         supplied_data = 'p2p'))
+    self.assertEqual(len(allocated), 500)
+    self.assertEqual(allocated[:3], ['172.16.0.0/30', '172.16.0.8/30',
+                                     '172.16.0.12/30'])
+    self.assertEqual(allocated[-1], '172.16.7.208/30')
+    self.assertEqual(self.t.Lookup(allocated[-1]).GetData(), 'p2p')
+    self.assertEqual(self.t.Lookup(allocated[-1]).used, True)
+    self.assertEqual(self.t.FindGapFrom('172.16.0.0/12', 30), '172.16.7.212/30')
+
+  def test_tree_find_gaps_agrees_with_find_gap(self):
+    for route in random.sample(list(self.t.GenerateForPrefix(8)), 100):
+      self.t.Insert(route, 'random')
+    expected = []
+    scratch = tree.Tree()
+    for route in self.t.IterateNodes():
+      scratch.Insert(route, 'random')
+    gap = scratch.FindGap(8)
+    while gap is not None:
+      expected.append(gap)
+      scratch.Insert(gap, 'filled')
+      gap = scratch.FindGap(8)
+    self.assertEqual(list(self.t.FindGaps(8)), expected)
+    self.assertEqual(list(self.t.FindGapGenerator(8)), expected)
+
   def test_tree_find_gap_from_simple(self):
     self.t.Insert("0.0.0.0/8", 'testFindGapFrom', mark_used = False, 
                   test_none = False)
@@ -534,6 +767,924 @@ class TreeIteration(unittest.TestCase):
                '199.4.140.0/23']
     self.assertEqual(result, result2)
 
+  def test_tree_iterate_nested(self):
+    for route in ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.2.0.0/16',
+                  '192.168.0.0/16']:
+      self.t.Insert(route, route)
+    self.assertEqual(list(self.t.IterateNodes()),
+                     ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24',
+                      '10.2.0.0/16', '192.168.0.0/16'])
+    self.assertEqual(list(self.t.IterateNodes(top_used = True)),
+                     ['10.0.0.0/8', '192.168.0.0/16'])
+    self.assertEqual(list(self.t.IterateNodes(prefix = '10.1.0.0/16')),
+                     ['10.1.0.0/16', '10.1.2.0/24'])
+    for prefix, data in self.t.IterateNodes(return_data = True):
+      self.assertEqual(prefix, data)
+    self.assertEqual(self.t.CountUsedNodes(), 5)
+    self.assertRaises(ValueError, list,
+                      self.t.IterateNodes(prefix = '11.0.0.0/8'))
+
+  def test_tree_iterate_nodes_int(self):
+    self.t.Insert('10.0.0.0/8', 'eight')
+    self.t.Insert('10.1.2.3/32', 'host')
+    self.assertEqual(list(self.t.IterateNodesInt()),
+                     [(0x0a000000, 8), (0x0a010203, 32)])
+    self.assertEqual(list(self.t.IterateNodesInt(return_data = True,
+                                                 top_used = True)),
+                     [(0x0a000000, 8, 'eight')])
+    copy = tree.Tree()
+    copy.BulkInsertInt(self.t.IterateNodesInt(return_data = True))
+    self.assertEqual(list(copy.IterateNodes(return_data = True)),
+                     list(self.t.IterateNodes(return_data = True)))
+
+class TreeLongestMatch(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+
+  def test_tree_longest_match(self):
+    self.t.Insert('10.0.0.0/8', 'eight')
+    self.t.Insert('10.1.0.0/16', 'sixteen')
+    self.t.Insert('10.1.2.0/24', 'twentyfour', mark_used = False)
+    self.assertEqual(self.t.LongestMatch('10.1.2.3').GetData(), 'sixteen')
+    self.assertEqual(self.t.LongestMatch('10.2.2.3').GetData(), 'eight')
+    self.assertEqual(self.t.LongestMatch('10.1.0.0/16').GetData(), 'sixteen')
+    self.assertEqual(self.t.LongestMatch('11.0.0.1'), None)
+    # Lookup's used_check stops at the least specific match instead.
+    self.assertEqual(self.t.Lookup('10.1.2.3', used_check = True).GetData(),
+                     'eight')
+
+  def test_tree_longest_match_default_route(self):
+    self.t.Insert('0.0.0.0/0', 'default', test_dup = False)
+    self.assertEqual(self.t.LongestMatch('192.0.2.1').GetData(), 'default')
+    self.t.Insert('192.0.2.1/32', 'host')
+    self.assertEqual(self.t.LongestMatch('192.0.2.1').GetData(), 'host')
+    self.assertEqual(self.t.LongestMatchInt(0xc0000202).GetData(), 'default')
+
+class PatriciaTreeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.p = tree.PatriciaTree()
+
+  def test_patricia_insert_lookup(self):
+    node = self.p.Insert('10.1.0.0/16', 'sixteen')
+    self.assertEqual(node.GetPrefix(), '10.1.0.0/16')
+    self.assertEqual(self.p.Lookup('10.1.0.0/16'), node)
+    self.assertEqual(self.p.Insert('10.1.0.0/16', 'again'), False)
+    self.p.Insert('10.0.0.0/8', 'eight')
+    self.p.Insert('10.2.0.0/16', 'sixteen-2')
+    self.assertEqual(self.p.Lookup('10.1.0.0/16'), node)
+    self.assertEqual(self.p.Lookup('10.0.0.0/8').GetData(), 'eight')
+    # 10.0.0.0/14 only exists as a branch joining the two /16s.
+    self.assertEqual(self.p.Lookup('10.0.0.0/14'), None)
+    self.assertEqual(self.p.Lookup('10.3.0.0/16'), None)
+    self.assertEqual(self.p.CountUsedNodes(), 3)
+
+  def test_patricia_longest_match(self):
+    self.p.Insert('10.0.0.0/8', 'eight')
+    self.p.Insert('10.1.2.0/24', 'twentyfour')
+    self.p.Insert('10.1.0.0/16', 'sixteen')
+    self.p.Insert('192.0.2.1/32', 'host')
+    self.assertEqual(self.p.LongestMatch('10.1.2.3').GetData(), 'twentyfour')
+    self.assertEqual(self.p.LongestMatch('10.1.3.3').GetData(), 'sixteen')
+    self.assertEqual(self.p.LongestMatch('10.9.3.3').GetData(), 'eight')
+    self.assertEqual(self.p.LongestMatch('192.0.2.1').GetData(), 'host')
+    self.assertEqual(self.p.LongestMatch('192.0.2.2'), None)
+    self.assertEqual(self.p.LongestMatch('10.1.0.0/15').GetData(), 'eight')
+
+  def test_patricia_iterate_in_order(self):
+    routes = ['192.168.1.0/24', '10.0.0.0/8', '10.1.0.0/16', '0.0.0.0/0',
+              '192.168.0.0/16', '172.16.0.0/12']
+    for route in routes:
+      self.p.Insert(route, route)
+    self.assertEqual(list(self.p.IterateNodes()),
+                     ['0.0.0.0/0', '10.0.0.0/8', '10.1.0.0/16',
+                      '172.16.0.0/12', '192.168.0.0/16', '192.168.1.0/24'])
+    for prefix, data in self.p.IterateNodes(return_data = True):
+      self.assertEqual(prefix, data)
+
+  def test_patricia_agrees_with_tree(self):
+    rng = random.Random(5)
+    t = tree.Tree()
+    inserted = set()
+    for i in range(2000):
+      netlen = rng.randint(8, 28)
+      addr = rng.getrandbits(32) & ((0xffffffff << (32 - netlen)) & 0xffffffff)
+      inserted.add((addr, netlen))
+      t.InsertInt(addr, netlen, (addr, netlen), test_dup = False)
+      self.p.InsertInt(addr, netlen, (addr, netlen), test_dup = False)
+    self.assertEqual(list(self.p.IterateNodes()),
+                     [t.IntToRoute(addr, netlen)
+                      for addr, netlen in sorted(inserted)])
+    for i in range(2000):
+      addr = rng.getrandbits(32)
+      expected = t.LongestMatchInt(addr)
+      found = self.p.LongestMatchInt(addr)
+      if expected is None:
+        self.assertEqual(found, None)
+      else:
+        self.assertEqual(found.GetData(), expected.GetData())
+
+class TreeIPv6Test(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree(address_family = 6)
+
+  def test_tree6_new(self):
+    self.assertEqual(self.t.width, 128)
+    self.failUnless(isinstance(self.t.GetRoot(), tree.CompactNode))
+    self.assertRaises(ValueError, tree.Tree, address_family = 5)
+
+  def test_tree6_route_to_int(self):
+    self.assertEqual(self.t.RouteToInt('2001:db8::/32'),
+                     (0x20010db8 << 96, 32))
+    self.assertEqual(self.t.RouteToInt('2001:db8::1'),
+                     ((0x20010db8 << 96) | 1, 128))
+    self.assertEqual(self.t.IntToRoute((0x20010db8 << 96) | 1, 64),
+                     '2001:db8::/64')
+    self.assertEqual(self.t.IntToRoute((0x20010db8 << 96) | 1, 128),
+                     '2001:db8::1')
+    self.assertRaises(ValueError, self.t.RouteToInt, '10.0.0.0/8')
+    self.assertRaises(ValueError, tree.Tree().RouteToInt, '2001:db8::/32')
+
+  def test_tree6_insert_lookup(self):
+    node = self.t.Insert('2001:db8:0:1::/64', 'lan')
+    self.assertEqual(node.GetLevel(), 64)
+    self.assertEqual(self.t.Lookup('2001:db8:0:1::/64'), node)
+    self.assertEqual(self.t.Lookup('2001:db8:0:2::/64'), None)
+    self.assertEqual(self.t.Insert('2001:db8:0:1::/64', 'again'), False)
+    host = self.t.Insert('2001:db8:0:1::1/128', 'loopback')
+    self.assertEqual(self.t.Lookup('2001:db8:0:1::1'), host)
+    self.assertEqual(self.t.Lookup('2001:db8:0:1::1', used_check = True), node)
+    self.assertEqual(self.t.LongestMatch('2001:db8:0:1::1').GetData(),
+                     'loopback')
+    self.assertEqual(self.t.LongestMatch('2001:db8:0:1::2').GetData(), 'lan')
+
+  def test_tree6_iterate_nodes(self):
+    self.t.Insert('2001:db8:0:2::/64', 'two')
+    self.t.Insert('2001:db8:0:1::1/128', 'loopback')
+    self.t.Insert('fe80::/10', 'link-local')
+    self.assertEqual(list(self.t.IterateNodes()),
+                     ['2001:db8:0:1::1', '2001:db8:0:2::/64', 'fe80::/10'])
+
+  def test_tree6_find_gap(self):
+    self.t.Insert('2001:db8::/48', 'site', mark_used = False)
+    self.t.Insert('2001:db8::/64', 'one')
+    self.t.Insert('2001:db8:0:1::/64', 'two')
+    self.assertEqual(self.t.FindGap(64), '::/64')
+    self.assertEqual(self.t.FindGapFrom('2001:db8::/48', 64),
+                     '2001:db8:0:2::/64')
+    self.assertEqual(self.t.FindGapFrom('2001:db8::/48', 128),
+                     '2001:db8:0:2::')
+    self.assertEqual(list(self.t.FindGapsFrom('2001:db8::/48', 64, count = 3,
+                                              mark_used = True)),
+                     ['2001:db8:0:2::/64', '2001:db8:0:3::/64',
+                      '2001:db8:0:4::/64'])
+    self.assertEqual(self.t.FindGapFrom('2001:db8::/48', 64),
+                     '2001:db8:0:5::/64')
+
+  def test_tree6_find_gap_full(self):
+    self.t.Insert('::/0', 'everything', test_dup = False)
+    self.assertEqual(self.t.FindGap(128), None)
+
+  def test_tree6_generate_for_prefix(self):
+    gen = self.t.GenerateForPrefix(64)
+    self.assertEqual([gen.next() for i in range(2)], ['::/64', '0:0:0:1::/64'])
+    gen = self.t.GenerateForPrefixInt(64, 2, seed = 16)
+    next_addr = 0
+    for i in range(100):
+      addr, netlen = gen.next()
+      self.assertEqual(addr, next_addr)
+      next_addr = addr + (1 << (128 - netlen))
+
+  def test_patricia6(self):
+    p = tree.PatriciaTree(address_family = 6)
+    p.Insert('2001:db8::/32', 'allocation')
+    p.Insert('2001:db8:1::/48', 'site')
+    p.Insert('2001:db8:1::1/128', 'host')
+    self.assertEqual(p.LongestMatch('2001:db8:1::1').GetData(), 'host')
+    self.assertEqual(p.LongestMatch('2001:db8:1::2').GetData(), 'site')
+    self.assertEqual(p.LongestMatch('2001:db8:2::2').GetData(), 'allocation')
+    self.assertEqual(p.LongestMatch('2001:db9::'), None)
+    self.assertEqual(list(p.IterateNodes()),
+                     ['2001:db8::/32', '2001:db8:1::/48', '2001:db8:1::1'])
+
+class TreeRemoveTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+
+  def test_remove(self):
+    self.t.Insert('10.0.0.0/8', 'eight')
+    self.t.Insert('10.1.0.0/16', 'sixteen')
+    self.assertEqual(self.t.Remove('10.1.0.0/16'), 'sixteen')
+    self.assertEqual(list(self.t.IterateNodes()), ['10.0.0.0/8'])
+    # Pruned all the way back up to the /8, which is still wanted.
+    self.assertEqual(self.t.Lookup('10.1.0.0/16'), None)
+    self.assertEqual(self.t.Lookup('10.0.0.0/9'), None)
+    self.assertRaises(ValueError, self.t.Remove, '10.1.0.0/16')
+    self.assertRaises(ValueError, self.t.Remove, '10.0.0.0/7')
+    self.t.Insert('10.1.0.0/16', 'again')
+    self.assertEqual(self.t.Lookup('10.1.0.0/16').GetData(), 'again')
+
+  def test_remove_prunes_everything(self):
+    self.t.Insert('10.1.2.0/24', 'lan')
+    self.t.Remove('10.1.2.0/24')
+    root = self.t.GetRoot()
+    self.assertEqual((root.left, root.right), (None, None))
+    self.assertEqual(self.t.FindGap(1), '0.0.0.0/1')
+
+  def test_remove_keeps_unused_inserts(self):
+    self.t.Insert('10.0.0.0/8', 'block', mark_used = False)
+    self.t.Insert('10.1.0.0/16', 'sixteen')
+    self.t.Remove('10.1.0.0/16')
+    self.assertEqual(self.t.Lookup('10.0.0.0/8').GetData(), 'block')
+    self.assertEqual(self.t.Remove('10.0.0.0/8'), 'block')
+    self.assertEqual(self.t.Lookup('10.0.0.0/8'), None)
+
+  def test_remove_unpropagates(self):
+    for route in ['10.0.0.0/9', '10.128.0.0/9', '11.0.0.0/8']:
+      self.t.Insert(route, route, propagate_used = True)
+    self.failUnless(self.t.Lookup('10.0.0.0/7').used)
+    self.assertEqual(self.t.FindGapFrom('10.0.0.0/7', 16), None)
+    self.t.Remove('10.128.0.0/9')
+    self.failIf(self.t.Lookup('10.0.0.0/8').used)
+    self.failIf(self.t.Lookup('10.0.0.0/7').used)
+    self.failUnless(self.t.Lookup('11.0.0.0/8').used)
+    self.assertEqual(self.t.FindGapFrom('10.0.0.0/7', 16), '10.128.0.0/16')
+    self.assertEqual(list(self.t.IterateNodes()), ['10.0.0.0/9', '11.0.0.0/8'])
+
+  def test_remove_unpropagates_root(self):
+    self.t.Insert('0.0.0.0/1', 'low', propagate_used = True)
+    self.t.Insert('128.0.0.0/1', 'high', propagate_used = True)
+    self.failUnless(self.t.GetRoot().used)
+    self.t.Remove('0.0.0.0/1')
+    self.failIf(self.t.GetRoot().used)
+    self.assertEqual(self.t.GetRoot().GetData(), 'Root')
+    self.assertEqual(self.t.FindGap(8), '0.0.0.0/8')
+
+  def test_remove_root(self):
+    self.assertRaises(ValueError, self.t.Remove, '0.0.0.0/0')
+    self.assertEqual(self.t.GetRoot().GetData(), 'Root')
+    self.t.Insert('0.0.0.0/0', 'default', test_dup = False)
+    self.assertEqual(self.t.Remove('0.0.0.0/0'), 'default')
+    self.failIf(self.t.GetRoot().used)
+    self.assertEqual(self.t.GetRoot().GetData(), 'Root')
+    self.assertRaises(ValueError, self.t.Remove, '0.0.0.0/0')
+
+  def test_remove_propagated_only(self):
+    self.t.Insert('10.0.0.0/25', 'low', propagate_used = True)
+    self.t.Insert('10.0.0.128/25', 'high', propagate_used = True)
+    self.failUnless(self.t.Lookup('10.0.0.0/24').used)
+    self.assertRaises(ValueError, self.t.Remove, '10.0.0.0/24')
+    self.failUnless(self.t.Lookup('10.0.0.0/24').used)
+    self.assertEqual(list(self.t.IterateNodes()),
+                     ['10.0.0.0/24', '10.0.0.0/25', '10.0.0.128/25'])
+
+  def test_remove_keeps_inserted_supernet(self):
+    self.t.Insert('10.0.0.0/16', 'mine')
+    self.t.Insert('10.0.0.0/17', 'a', propagate_used = True)
+    self.t.Insert('10.0.128.0/17', 'b', propagate_used = True)
+    self.assertEqual(self.t.Lookup('10.0.0.0/16').GetData(), 'mine')
+    self.t.Remove('10.0.0.0/17')
+    self.failUnless(self.t.Lookup('10.0.0.0/16').used)
+    self.assertEqual(self.t.Remove('10.0.0.0/16'), 'mine')
+    self.t = tree.Tree()
+    self.t.BulkInsert([('10.0.0.0/16', 'mine'), ('10.0.0.0/17', 'a'),
+                       ('10.0.128.0/17', 'b')], propagate_used = True)
+    self.assertEqual(self.t.Lookup('10.0.0.0/16').GetData(), 'mine')
+
+  def test_remove_churn_stays_bounded(self):
+    self.t.Insert('10.0.0.0/16', 'pool', mark_used = False)
+    rng = random.Random(13)
+    allocated = []
+    sizes = []
+    for i in range(2000):
+      if allocated and rng.random() < 0.5:
+        self.t.Remove(allocated.pop(rng.randrange(len(allocated))))
+      else:
+        gap = self.t.FindGapFrom('10.0.0.0/16', rng.randint(24, 30))
+        self.t.Insert(gap, 'allocated')
+        allocated.append(gap)
+    for gap in allocated:
+      self.t.Remove(gap)
+    self.assertEqual(list(self.t.IterateNodes()), [])
+    self.assertEqual(len(list(self.t.IterateNodes(prefix = '10.0.0.0/16'))), 0)
+    self.assertEqual(self.t.Lookup('10.0.0.0/16').GetLeft(), None)
+    self.assertEqual(self.t.Lookup('10.0.0.0/16').GetRight(), None)
+
+  def test_remove_from_snapshot(self):
+    self.t.Insert('10.0.0.0/8', 'eight')
+    self.t.Insert('10.1.0.0/16', 'sixteen')
+    old = self.t.Snapshot()
+    self.t.Remove('10.1.0.0/16')
+    self.assertEqual(self.t.Lookup('10.1.0.0/16'), None)
+    self.assertEqual(old.Lookup('10.1.0.0/16').GetData(), 'sixteen')
+    self.assertEqual(list(self.t.Diff(old)), [('10.1.0.0/16', 'removed')])
+
+class TreeCoverTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+    for route in ['193.0.0.0/8', '193.1.0.0/24', '193.1.7.0/24',
+                  '193.1.7.128/25', '193.2.0.0/16', '10.0.0.0/8']:
+      self.t.Insert(route, route.upper())
+
+  def test_covered(self):
+    self.assertEqual(list(self.t.Covered('193.1.0.0/16')),
+                     ['193.1.0.0/24', '193.1.7.0/24', '193.1.7.128/25'])
+    self.assertEqual(list(self.t.Covered('193.1.0.0/16', top_used = True)),
+                     ['193.1.0.0/24', '193.1.7.0/24'])
+    self.assertEqual(list(self.t.Covered('193.1.7.0/24', return_data = True)),
+                     [('193.1.7.0/24', '193.1.7.0/24'),
+                      ('193.1.7.128/25', '193.1.7.128/25')])
+    self.assertEqual(list(self.t.Covered('193.0.0.0/8', top_used = True)),
+                     ['193.0.0.0/8'])
+
+  def test_covered_absent(self):
+    # Neither prefix is in the tree: IterateNodes would raise.
+    self.assertEqual(list(self.t.Covered('172.16.0.0/12')), [])
+    self.assertEqual(list(self.t.Covered('193.1.7.0/26')), [])
+    self.assertEqual(list(self.t.Covered('0.0.0.0/0', top_used = True)),
+                     ['10.0.0.0/8', '193.0.0.0/8'])
+
+  def test_covering(self):
+    self.assertEqual(list(self.t.Covering('193.1.7.200')),
+                     ['193.0.0.0/8', '193.1.7.0/24', '193.1.7.128/25'])
+    self.assertEqual(list(self.t.Covering('193.1.7.0/24', return_data = True)),
+                     [('193.0.0.0/8', '193.0.0.0/8'),
+                      ('193.1.7.0/24', '193.1.7.0/24')])
+    self.assertEqual(list(self.t.Covering('192.0.0.0/4')), [])
+    self.assertEqual(list(self.t.Covering('11.0.0.1')), [])
+    self.assertEqual(list(self.t.CoveringInt(0x0a000001)), [(0x0a000000, 8)])
+
+  def test_covering_matches_longest_match(self):
+    for address in ['193.1.7.200', '193.1.7.1', '193.2.3.4', '193.9.9.9']:
+      self.assertEqual(list(self.t.Covering(address))[-1].upper(),
+                       self.t.LongestMatch(address).GetData())
+
+  def test_cover_ipv6(self):
+    t = tree.Tree(address_family = 6)
+    t.Insert('2001:db8::/32', 'doc')
+    t.Insert('2001:db8:1::/48', 'site')
+    self.assertEqual(list(t.Covering('2001:db8:1::1')),
+                     ['2001:db8::/32', '2001:db8:1::/48'])
+    self.assertEqual(list(t.Covered('2001:db8::/31')),
+                     ['2001:db8::/32', '2001:db8:1::/48'])
+
+@unittest.skipIf(tree.numpy is None, "numpy is not installed")
+class IntervalTableTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+    for route, data in [('10.0.0.0/8', 'permit'), ('10.1.0.0/16', 'deny'),
+                        ('10.1.2.0/24', 'permit'), ('192.0.2.1/32', 'host'),
+                        ('255.255.255.0/24', 'top')]:
+      self.t.Insert(route, data)
+    self.addresses = tree.numpy.array(
+      [0, 0x0a000000, 0x0a010101, 0x0a010203, 0x0a0102ff, 0x0a010300,
+       0x0a020000, 0x0affffff, 0x0b000000, 0xc0000201, 0xc0000202,
+       0xffffff00, 0xffffffff], dtype = tree.numpy.uint32)
+
+  def test_classify(self):
+    table = tree.IntervalTable(self.t)
+    self.assertEqual([table.prefixes[i][2] if i >= 0 else None
+                      for i in table.Classify(self.addresses)],
+                     [None, 'permit', 'deny', 'permit', 'permit', 'deny',
+                      'permit', 'permit', None, 'host', None, 'top', 'top'])
+    self.assertEqual(list(table.ClassifyNetlen(self.addresses)),
+                     [-1, 8, 16, 24, 24, 16, 8, 8, -1, 32, -1, 24, 24])
+    self.assertEqual(list(table.ClassifyData(self.addresses[:2], 'none')),
+                     ['none', 'permit'])
+
+  def test_classify_matches_longest_match(self):
+    rng = random.Random(15)
+    for i in range(500):
+      netlen = rng.randint(0, 32)
+      addr = rng.getrandbits(32) & ~((1 << (32 - netlen)) - 1) & 0xffffffff
+      self.t.InsertInt(addr, netlen, (addr, netlen), test_dup = False)
+    addresses = [rng.getrandbits(32) for i in range(2000)]
+    table = tree.IntervalTable(self.t)
+    for addr, data in zip(addresses, table.ClassifyData(addresses)):
+      node = self.t.LongestMatchInt(addr)
+      self.assertEqual(data, node and node.GetData())
+
+  def test_classify_empty_and_default(self):
+    self.assertEqual(list(tree.IntervalTable(tree.Tree()).Classify([1, 2])),
+                     [-1, -1])
+    t = tree.Tree()
+    t.Insert('0.0.0.0/0', 'default', test_dup = False)
+    self.assertEqual(list(tree.IntervalTable(t).ClassifyData([0, 2**32 - 1])),
+                     ['default', 'default'])
+
+  def test_classify_ipv6(self):
+    self.assertRaises(ValueError, tree.IntervalTable,
+                      tree.Tree(address_family = 6))
+
+class TreeUtilizationTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+    self.t.Insert('10.0.0.0/8', 'block', mark_used = False)
+    self.t.Insert('10.1.0.0/16', 'site')
+    self.t.Insert('10.1.2.0/24', 'lan')
+    self.t.Insert('10.2.0.0/24', 'lan')
+    self.t.Insert('10.2.1.0/25', 'half')
+
+  def test_utilization(self):
+    self.assertEqual(self.t.Utilization('10.0.0.0/8'),
+                     (65536 + 256 + 128, 2 ** 24 - 65536 - 256 - 128))
+    self.assertEqual(self.t.Utilization('10.1.2.0/24'), (256, 0))
+    # Covered by a used prefix, though not itself in the tree.
+    self.assertEqual(self.t.Utilization('10.1.2.128/26'), (64, 0))
+    self.assertEqual(self.t.Utilization('10.2.1.0/24'), (128, 128))
+    self.assertEqual(self.t.Utilization('11.0.0.0/8'), (0, 2 ** 24))
+    self.assertEqual(self.t.UtilizationInt(0, 0), (65536 + 256 + 128,
+                                                   2 ** 32 - 65536 - 384))
+
+  def test_utilization_follows_changes(self):
+    self.assertEqual(self.t.Utilization('10.2.0.0/16')[0], 384)
+    self.t.Insert('10.2.1.128/25', 'other half')
+    self.assertEqual(self.t.Utilization('10.2.0.0/16')[0], 512)
+    self.t.Remove('10.2.0.0/24')
+    self.assertEqual(self.t.Utilization('10.2.0.0/16')[0], 256)
+    old = self.t.Snapshot()
+    self.t.Insert('10.2.0.0/16', 'all of it', test_dup = False)
+    self.assertEqual(self.t.Utilization('10.0.0.0/8')[0], 65536 * 2)
+    self.assertEqual(old.Utilization('10.0.0.0/8')[0], 65536 + 256)
+
+  def test_utilization_matches_iterate(self):
+    rng = random.Random(18)
+    for i in range(300):
+      netlen = rng.randint(8, 30)
+      addr = rng.getrandbits(32) & ~((1 << (32 - netlen)) - 1) & 0xffffffff
+      self.t.InsertInt(addr, netlen, 'random', test_dup = False)
+      if i % 3 == 0:
+        self.t.FindGapInt(30)
+    for prefix in ['0.0.0.0/0', '0.0.0.0/1', '128.0.0.0/2', '10.0.0.0/8']:
+      addr, netlen = self.t.RouteToInt(prefix)
+      expected = sum(1 << (32 - length) for addr, length in
+                     self.t.CoveredInt(addr, netlen, top_used = True))
+      self.assertEqual(self.t.Utilization(prefix)[0], expected)
+
+  def test_utilization_by_prefix(self):
+    self.assertEqual(list(self.t.UtilizationByPrefix(16)),
+                     [('10.1.0.0/16', 65536, 0), ('10.2.0.0/16', 384, 65152)])
+    self.assertEqual(len(list(self.t.UtilizationByPrefixInt(24))), 256 + 2)
+
+  def test_utilization_histogram(self):
+    self.assertEqual(self.t.UtilizationHistogram(16, buckets = 2),
+                     [65535, 1])
+    self.assertEqual(self.t.UtilizationHistogram(24, buckets = 4),
+                     [2 ** 24 - 258, 0, 1, 257])
+    self.assertEqual(sum(self.t.UtilizationHistogram(20)), 2 ** 20)
+
+  def test_utilization_ipv6(self):
+    t = tree.Tree(address_family = 6)
+    t.Insert('2001:db8::/48', 'site')
+    self.assertEqual(t.Utilization('2001:db8::/32'), (2 ** 80, 2 ** 96 - 2 ** 80))
+
+class PrefixAllocatorTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+    self.t.Insert('10.0.0.0/24', 'pool', mark_used = False)
+
+  def test_allocate_and_release(self):
+    a = self.t.Allocator('10.0.0.0/24')
+    self.assertEqual(a.Allocate(30, 'link'), '10.0.0.0/30')
+    self.assertEqual(a.Allocate(32), '10.0.0.4')
+    self.assertEqual(a.Allocate(30), '10.0.0.8/30')
+    self.assertEqual(self.t.Lookup('10.0.0.0/30').GetData(), 'link')
+    self.assertEqual(a.FreeBlocks(),
+                     ['10.0.0.5', '10.0.0.6/31', '10.0.0.12/30',
+                      '10.0.0.16/28', '10.0.0.32/27', '10.0.0.64/26',
+                      '10.0.0.128/25'])
+    self.assertEqual(a.Release('10.0.0.0/30'), 'link')
+    self.assertEqual(a.Release('10.0.0.4/32'), 'Allocated')
+    self.assertEqual(a.FreeBlocks(), ['10.0.0.0/29', '10.0.0.12/30',
+                                      '10.0.0.16/28', '10.0.0.32/27',
+                                      '10.0.0.64/26', '10.0.0.128/25'])
+    a.Release('10.0.0.8/30')
+    self.assertEqual(a.FreeBlocks(), ['10.0.0.0/24'])
+    self.assertEqual(list(self.t.IterateNodes()), [])
+
+  def test_policies(self):
+    self.t.Insert('10.0.0.0/25', 'taken')
+    self.t.Insert('10.0.0.128/30', 'taken')
+    best = tree.Tree()
+    best.Insert('10.0.0.0/24', 'pool', mark_used = False)
+    best.Insert('10.0.0.4/30', 'taken')
+    a = best.Allocator('10.0.0.0/24', tree.PrefixAllocator.BEST_FIT)
+    # Best fit takes the /30 hole rather than splitting the /25.
+    self.assertEqual(a.Allocate(30), '10.0.0.0/30')
+    self.assertEqual(a.Allocate(29), '10.0.0.8/29')
+    self.assertEqual(a.Allocate(30), '10.0.0.16/30')
+    first = tree.Tree()
+    first.Insert('10.0.0.0/24', 'pool', mark_used = False)
+    first.Insert('10.0.0.0/26', 'taken')
+    first.Insert('10.0.0.68/30', 'taken')
+    a = first.Allocator('10.0.0.0/24', tree.PrefixAllocator.FIRST_FIT)
+    self.assertEqual(a.Allocate(26), '10.0.0.128/26')
+    self.assertEqual(a.Allocate(30), '10.0.0.64/30')
+    b = tree.PrefixAllocator(first, '10.0.0.0/24')
+    self.assertEqual(b.Allocate(30), '10.0.0.72/30')
+    self.assertRaises(ValueError, tree.PrefixAllocator, first, None, 'worst')
+
+  def test_full_pool(self):
+    a = self.t.Allocator('10.0.0.0/24')
+    for i in range(4):
+      self.failIf(a.Allocate(26) is None)
+    self.assertEqual(a.Allocate(32), None)
+    self.assertEqual(a.FreeAddresses(), 0)
+    self.assertRaises(ValueError, a.Allocate, 16)
+    self.assertRaises(ValueError, a.Release, '10.0.1.0/26')
+    self.assertRaises(ValueError, a.Release, '10.0.0.0/25')
+    t = tree.Tree()
+    t.Insert('10.0.0.0/8', 'used')
+    self.assertEqual(t.Allocator('10.0.0.0/24').Allocate(30), None)
+
+  def test_release_with_nested(self):
+    self.t.Insert('10.0.0.0/25', 'outer')
+    self.t.Insert('10.0.0.4/30', 'inner')
+    a = self.t.Allocator('10.0.0.0/24')
+    self.assertEqual(a.Release('10.0.0.0/25'), 'outer')
+    self.assertEqual(a.Allocate(30), '10.0.0.0/30')
+    self.assertEqual(a.Allocate(25), '10.0.0.128/25')
+
+  def test_release_inside_used(self):
+    self.t.Insert('10.0.0.0/25', 'outer')
+    self.t.Insert('10.0.0.0/28', 'inner')
+    a = self.t.Allocator('10.0.0.0/24')
+    self.assertEqual(a.Release('10.0.0.0/28'), 'inner')
+    self.assertEqual(a.FreeBlocks(), ['10.0.0.128/25'])
+    self.assertEqual(a.FreeAddresses(), 128)
+    self.assertEqual(a.Allocate(28), '10.0.0.128/28')
+
+  def test_allocate_whole_pool(self):
+    a = self.t.Allocator('10.0.0.0/24')
+    self.assertEqual(a.Allocate(24, 'everything'), '10.0.0.0/24')
+    self.assertEqual(a.FreeBlocks(), [])
+    self.assertEqual(a.Release('10.0.0.0/24'), 'everything')
+    pool = self.t.Lookup('10.0.0.0/24')
+    self.failIf(pool is None)
+    self.failIf(pool.used)
+    self.assertEqual(pool.GetData(), 'pool')
+    self.assertEqual(self.t.FindGapFrom('10.0.0.0/24', 26), '10.0.0.0/26')
+    self.assertEqual(a.FreeBlocks(), ['10.0.0.0/24'])
+    self.assertEqual(a.Allocate(26), '10.0.0.0/26')
+
+  def test_churn_matches_tree(self):
+    self.t.Insert('10.0.0.64/28', 'existing')
+    for policy in (tree.PrefixAllocator.BEST_FIT,
+                   tree.PrefixAllocator.FIRST_FIT):
+      a = self.t.Allocator('10.0.0.0/24', policy)
+      rng = random.Random(19)
+      allocated = []
+      for i in range(500):
+        if allocated and rng.random() < 0.45:
+          a.Release(allocated.pop(rng.randrange(len(allocated))))
+        else:
+          route = a.Allocate(rng.choice([28, 30, 31, 32]))
+          if route is not None:
+            allocated.append(route)
+        fresh = tree.PrefixAllocator(self.t, '10.0.0.0/24')
+        self.assertEqual(a.FreeBlocks(), fresh.FreeBlocks())
+        self.assertEqual(a.FreeAddresses(),
+                         self.t.Utilization('10.0.0.0/24')[1])
+      for route in allocated:
+        a.Release(route)
+      self.assertEqual(list(self.t.IterateNodes()), ['10.0.0.64/28'])
+
+class TreeSummarizeTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+
+  def test_summarize(self):
+    for route in ['10.0.0.0/24', '10.0.1.0/24', '10.0.2.0/24', '10.0.3.0/25',
+                  '10.0.3.128/25', '10.0.3.5/32', '192.168.0.0/24']:
+      self.t.Insert(route, 'summarize')
+    self.assertEqual(self.t.Summarize(), ['10.0.0.0/22', '192.168.0.0/24'])
+    # The tree itself is left alone.
+    self.failIf(self.t.Lookup('10.0.0.0/22').used)
+
+  def test_summarize_empty_and_full(self):
+    self.assertEqual(self.t.Summarize(), [])
+    self.assertEqual(self.t.Summarize(max_extra = 2 ** 32), [])
+    self.t.Insert('0.0.0.0/1', 'half')
+    self.t.Insert('128.0.0.0/1', 'half')
+    self.assertEqual(self.t.Summarize(), ['0.0.0.0/0'])
+    self.assertEqual(self.t.SummarizeInt(), [(0, 0)])
+
+  def test_summarize_max_extra(self):
+    for route in ['192.168.0.0/26', '192.168.0.64/26', '192.168.0.192/26',
+                  '192.168.1.0/32']:
+      self.t.Insert(route, 'summarize')
+    self.assertEqual(self.t.Summarize(),
+                     ['192.168.0.0/25', '192.168.0.192/26', '192.168.1.0'])
+    # The host route can grow until it takes in 63 spare addresses...
+    self.assertEqual(self.t.Summarize(max_extra = 63),
+                     ['192.168.0.0/25', '192.168.0.192/26', '192.168.1.0/26'])
+    # ...and the /24 needs 64.
+    self.assertEqual(self.t.Summarize(max_extra = 64),
+                     ['192.168.0.0/24', '192.168.1.0/26'])
+    self.assertEqual(self.t.Summarize(max_extra = 255 + 64),
+                     ['192.168.0.0/23'])
+
+  def test_summarize_matches_addresses(self):
+    rng = random.Random(12)
+    for i in range(300):
+      netlen = rng.randint(18, 28)
+      self.t.InsertInt(0x0a000000 | (rng.getrandbits(16) << 8), netlen,
+                       'random', test_dup = False)
+    summary = self.t.SummarizeInt()
+    check = tree.Tree()
+    for addr, netlen in summary:
+      check.InsertInt(addr, netlen, 'summary')
+    self.assertEqual(check, self.t)
+    # Minimal: nothing nested, no two halves of the same supernet.
+    for (addr, netlen), (next_addr, next_len) in zip(summary, summary[1:]):
+      self.failUnless(next_addr >= addr + 2 ** (32 - netlen))
+      self.failIf(netlen == next_len and
+                  addr >> (33 - netlen) == next_addr >> (33 - netlen))
+
+  def test_summarize_ipv6(self):
+    t6 = tree.Tree(address_family = 6)
+    t6.Insert('2001:db8::/33', 'half')
+    t6.Insert('2001:db8:8000::/33', 'half')
+    t6.Insert('2001:db9::1', 'host')
+    self.assertEqual(t6.Summarize(), ['2001:db8::/32', '2001:db9::1'])
+
+class TreeSnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+    for route in ['10.0.0.0/8', '10.1.0.0/16', '172.16.0.0/12',
+                  '192.168.0.0/16']:
+      self.t.Insert(route, route)
+
+  def Nodes(self, t):
+    """Every node of tree t, by identity."""
+    nodes = set()
+    stack = [t.GetRoot()]
+    while stack:
+      node = stack.pop()
+      nodes.add(id(node))
+      for child in (node.left, node.right):
+        if child is not None:
+          stack.append(child)
+    return nodes
+
+  def test_snapshot_is_independent(self):
+    old = self.t.Snapshot()
+    self.t.Insert('10.2.0.0/16', 'new')
+    self.t.Insert('10.1.0.0/16', 'replaced', test_dup = False)
+    old.Insert('11.0.0.0/8', 'old only')
+    self.assertEqual(list(self.t.IterateNodes()),
+                     ['10.0.0.0/8', '10.1.0.0/16', '10.2.0.0/16',
+                      '172.16.0.0/12', '192.168.0.0/16'])
+    self.assertEqual(list(old.IterateNodes()),
+                     ['10.0.0.0/8', '10.1.0.0/16', '11.0.0.0/8',
+                      '172.16.0.0/12', '192.168.0.0/16'])
+    self.assertEqual(old.Lookup('10.1.0.0/16').GetData(), '10.1.0.0/16')
+    self.assertEqual(self.t.Lookup('10.1.0.0/16').GetData(), 'replaced')
+
+  def test_snapshot_copies_only_the_path(self):
+    old = self.t.Snapshot()
+    self.assertEqual(self.Nodes(old), self.Nodes(self.t))
+    self.t.Insert('10.1.2.0/24', 'new')
+    new_nodes = self.Nodes(self.t) - self.Nodes(old)
+    # The root, the 24 nodes down to the /24, and nothing else.
+    self.assertEqual(len(new_nodes), 25)
+    # Once copied, nodes are changed in place.
+    self.t.Insert('10.1.2.0/25', 'newer')
+    self.assertEqual(len(self.Nodes(self.t) - self.Nodes(old)), 26)
+
+  def test_snapshot_find_gap(self):
+    t = tree.Tree()
+    t.Insert('192.168.0.0/24', 'lan', mark_used = False)
+    old = t.Snapshot()
+    self.assertEqual(list(t.FindGapsFrom('192.168.0.0/24', 26,
+                                         mark_used = True)),
+                     ['192.168.0.0/26', '192.168.0.64/26', '192.168.0.128/26',
+                      '192.168.0.192/26'])
+    self.assertEqual(t.FindGapFrom('192.168.0.0/24', 26), None)
+    self.assertEqual(old.FindGapFrom('192.168.0.0/24', 26), '192.168.0.0/26')
+    old.Insert('192.168.0.0/25', 'half', propagate_used = True)
+    old.Insert('192.168.0.128/25', 'half', propagate_used = True)
+    self.failUnless(old.Lookup('192.168.0.0/24').used)
+    self.failIf(t.Lookup('192.168.0.0/24').used)
+
+  def test_snapshot_shared_nodes_are_read_only(self):
+    self.t.Insert('100.64.0.0/24', 'free', mark_used = False)
+    old = self.t.Snapshot()
+    self.t.Insert('100.64.1.0/24', 'new')
+    for t in (self.t, old):
+      node = t.Lookup('100.64.0.0/24')
+      self.assertRaises(ValueError, node.SetData, 'changed')
+      self.assertRaises(ValueError, setattr, node, 'used', True)
+      self.assertRaises(ValueError, node.SetLeft, None)
+      self.assertEqual(node.GetData(), 'free')
+    self.assertEqual(self.t.FindGapFrom('100.64.0.0/16', 24), '100.64.0.0/24')
+    self.assertEqual(old.FindGapFrom('100.64.0.0/16', 24), '100.64.0.0/24')
+    # Nodes each tree has copied, or made, since are its own to change.
+    node = self.t.Lookup('100.64.1.0/24')
+    node.used = False
+    node.SetData('freed')
+    self.assertEqual(self.t.FindGapFrom('100.64.1.0/24', 24), '100.64.1.0/24')
+    self.assertEqual(old.Lookup('100.64.1.0/24'), None)
+    self.t.Insert('100.64.0.0/24', 'mine', test_dup = False)
+    self.t.Lookup('100.64.0.0/24').SetData('changed')
+    self.assertEqual(old.Lookup('100.64.0.0/24').GetData(), 'free')
+
+  def test_snapshot_bulk_insert(self):
+    old = self.t.Snapshot()
+    self.t.BulkInsert(['10.1.0.0/17', '10.1.128.0/17'], 'bulk',
+                      propagate_used = True)
+    self.assertEqual(self.t.Lookup('10.1.0.0/17').GetData(), 'bulk')
+    self.assertEqual(old.Lookup('10.1.0.0/17'), None)
+
+  def test_diff(self):
+    old = self.t.Snapshot()
+    self.assertEqual(list(self.t.Diff(old)), [])
+    self.t.Insert('10.2.0.0/16', 'new')
+    self.t.Insert('172.16.0.0/12', 'changed', test_dup = False)
+    old.Insert('192.168.1.0/24', 'gone')
+    self.assertEqual(list(self.t.Diff(old)),
+                     [('10.2.0.0/16', 'added'), ('172.16.0.0/12', 'changed'),
+                      ('192.168.1.0/24', 'removed')])
+    self.assertEqual(list(old.Diff(self.t)),
+                     [('10.2.0.0/16', 'removed'), ('172.16.0.0/12', 'changed'),
+                      ('192.168.1.0/24', 'added')])
+
+  def test_diff_unrelated_trees(self):
+    other = tree.Tree()
+    other.Insert('10.0.0.0/8', '10.0.0.0/8')
+    other.Insert('10.1.0.0/16', '10.1.0.0/16')
+    other.Insert('10.0.0.0/9', '10.0.0.0/9')
+    self.assertEqual(list(self.t.DiffInt(other)),
+                     [(0x0a000000, 9, 'removed'),
+                      (0xac100000, 12, 'added'),
+                      (0xc0a80000, 16, 'added')])
+
+  def test_diff_skips_matching_subtrees(self):
+    # Trees built separately share no nodes, but once hashed, matching
+    # subtrees are still recognised by their hashes, data and all.
+    self.t._comparisons = tree._WALKS_BEFORE_HASHING
+    other = tree.Tree()
+    other._comparisons = tree._WALKS_BEFORE_HASHING
+    for route in ['10.0.0.0/8', '10.1.0.0/16', '172.16.0.0/12',
+                  '192.168.0.0/16']:
+      other.Insert(route, route)
+    self.assertEqual(list(self.t.Diff(other)), [])
+    other.Lookup('10.1.0.0/16').SetData('changed')
+    self.assertEqual(list(self.t.Diff(other)), [('10.1.0.0/16', 'changed')])
+    other.Lookup('10.1.0.0/16').SetData('10.1.0.0/16')
+    other.Insert('10.1.2.0/24', 'nested')
+    self.assertEqual(list(other.Diff(self.t)), [('10.1.2.0/24', 'added')])
+    self.t.Insert('10.1.2.0/24', [])
+    other.Remove('10.1.2.0/24')
+    other.Insert('10.1.2.0/24', [])
+    # Data hashed by identity never matches other data by hash, but is
+    # still compared properly.
+    self.assertEqual(list(other.Diff(self.t)), [])
+    other.Lookup('10.1.2.0/24').GetData().append('changed')
+    self.assertEqual(list(other.Diff(self.t)), [('10.1.2.0/24', 'changed')])
+
+  def test_diff_ignores_builtin_hash_collisions(self):
+    # hash(-1) == hash(-2), but the digests must still tell them apart.
+    other = tree.Tree()
+    self.t.Insert('10.9.0.0/24', -1)
+    other.Insert('10.9.0.0/24', -2)
+    self.t.Remove('10.0.0.0/8')
+    for route in ['10.1.0.0/16', '172.16.0.0/12', '192.168.0.0/16']:
+      other.Insert(route, route)
+    for i in range(tree._WALKS_BEFORE_HASHING + 2):
+      self.assertEqual(list(self.t.Diff(other)),
+                       [('10.9.0.0/24', 'changed')])
+    self.failIf(self.t.GetRoot()._hash is None)
+
+  def test_hashes_encode_data_by_value(self):
+    for data in [('10.0.0.0/8', 8), frozenset(['a', 'b', 'c']), 0.5,
+                 (None, (1L, u'x'))]:
+      one = tree.Tree()
+      other = tree.Tree()
+      one.Insert('10.0.0.0/8', data)
+      other.Insert('10.0.0.0/8', copy.deepcopy(data))
+      one._UpdateHashes()
+      other._UpdateHashes()
+      self.assertEqual(one.GetRoot()._hash, other.GetRoot()._hash)
+    for data, other_data in [(('ab',), ('a', 'b')), ((1,), ('1',)),
+                             ({'a': 1}, {'a': 1})]:
+      self.assertNotEqual(tree._EncodeData(data),
+                          tree._EncodeData(other_data))
+
+  def test_diff_host_routes(self):
+    other = tree.Tree()
+    self.t.Insert('10.1.2.3/32', 'host')
+    other.Insert('10.1.2.3/32', 'other host')
+    other.Insert('10.1.2.4/32', 'host')
+    self.assertEqual(list(self.t.DiffInt(other)),
+                     [(0x0a000000, 8, 'added'), (0x0a010000, 16, 'added'),
+                      (0x0a010203, 32, 'changed'), (0x0a010204, 32, 'removed'),
+                      (0xac100000, 12, 'added'), (0xc0a80000, 16, 'added')])
+
+  def test_snapshot_compact_nodes(self):
+    t = tree.Tree(node_class = tree.CompactNode)
+    t.Insert('10.0.0.0/8', 'eight')
+    old = t.Snapshot()
+    t.Insert('10.1.0.0/16', 'sixteen')
+    self.assertEqual(list(t.Diff(old)), [('10.1.0.0/16', 'added')])
+    self.assertEqual(old.Lookup('10.1.0.0/16'), None)
+
+class TreeSaveLoadTest(unittest.TestCase):
+
+  def setUp(self):
+    self.t = tree.Tree()
+    self.t.Insert('10.0.0.0/8', 'eight')
+    self.t.Insert('10.1.0.0/16', {'site': 'dub'})
+    self.t.Insert('10.1.2.3/32', 1)
+    self.t.Insert('10.1.2.4/32', True)
+    self.t.Insert('192.168.0.0/16', 'unused', mark_used = False)
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'tree.bin')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_save_load(self):
+    self.t.Save(self.path)
+    loaded = tree.Tree.Load(self.path)
+    self.assertEqual(list(loaded.IterateNodes(return_data = True)),
+                     list(self.t.IterateNodes(return_data = True)))
+    self.assertEqual(loaded.Lookup('10.1.2.3').GetData(), 1)
+    self.assertEqual(loaded.Lookup('10.1.2.4').GetData(), True)
+    self.assertEqual(loaded.Lookup('10.1.2.3').GetLevel(), 32)
+    unused = loaded.Lookup('192.168.0.0/16')
+    self.assertEqual(unused.GetData(), 'unused')
+    self.failIf(unused.used)
+    self.assertEqual(loaded.GetRoot().GetData(), 'Root')
+    self.assertEqual(loaded.FindGap(8), self.t.FindGap(8))
+    # A loaded tree is an ordinary one.
+    loaded.Insert('10.2.0.0/16', 'new')
+    self.assertEqual(loaded.FindGapFrom('192.168.0.0/16', 24),
+                     '192.168.0.0/24')
+
+  def test_save_load_compact_ipv6(self):
+    t6 = tree.Tree(address_family = 6)
+    t6.Insert('2001:db8::/32', 'allocation')
+    t6.Insert('2001:db8:1::1/128', 'host')
+    t6.Save(self.path)
+    loaded = tree.Tree.Load(self.path)
+    self.assertEqual(loaded.address_family, 6)
+    self.failUnless(isinstance(loaded.GetRoot(), tree.CompactNode))
+    self.assertEqual(loaded, t6)
+    self.assertEqual(loaded.Lookup('2001:db8:1::1').GetData(), 'host')
+
+  def test_load_not_a_tree(self):
+    garbage = open(self.path, 'wb')
+    garbage.write('not a tree at all')
+    garbage.close()
+    self.assertRaises(ValueError, tree.Tree.Load, self.path)
+    self.assertRaises(ValueError, tree.MappedTree, self.path)
+
+  def test_mapped_tree(self):
+    self.t.Save(self.path)
+    mapped = tree.MappedTree(self.path)
+    self.assertEqual(mapped.Lookup('10.1.0.0/16').GetData(), {'site': 'dub'})
+    self.assertEqual(mapped.Lookup('10.1.2.3', used_check = True).GetLevel(),
+                     8)
+    self.assertEqual(mapped.Lookup('10.2.0.0/16'), None)
+    self.failIf(mapped.Lookup('192.168.0.0/16').used)
+    self.assertEqual(mapped.LongestMatch('10.1.2.3').GetData(), 1)
+    self.assertEqual(mapped.LongestMatch('10.1.2.5').GetData(),
+                     {'site': 'dub'})
+    self.assertEqual(mapped.LongestMatch('11.0.0.0'), None)
+    self.assertEqual(list(mapped.IterateNodes(return_data = True)),
+                     list(self.t.IterateNodes(return_data = True)))
+    self.assertEqual(list(mapped.IterateNodesInt(top_used = True)),
+                     list(self.t.IterateNodesInt(top_used = True)))
+    self.assertEqual(mapped.CountUsedNodes(), 4)
+    mapped.Close()
+
+  def test_mapped_tree_agrees_with_tree(self):
+    rng = random.Random(11)
+    for i in range(2000):
+      netlen = rng.randint(8, 32)
+      self.t.InsertInt(rng.getrandbits(32), netlen, netlen, test_dup = False)
+    self.t.Save(self.path)
+    mapped = tree.MappedTree(self.path)
+    for i in range(2000):
+      addr = rng.getrandbits(32)
+      expected = self.t.LongestMatchInt(addr)
+      found = mapped.LongestMatchInt(addr)
+      if expected is None:
+        self.assertEqual(found, None)
+      else:
+        self.assertEqual(found.GetData(), expected.GetData())
+    mapped.Close()
+
 class TreeSlowTests(unittest.TestCase):
 
   def setUp(self):
@@ -553,6 +1704,35 @@ class TreeSlowTests(unittest.TestCase):
       self.t.Insert(route, "find_gap_exhaust_large")
       route = self.t.FindGap(7)
 
+class CompactNodeTest(NodeTest):
+  """Run the Node tests against the __slots__ storage backend."""
+
+  def setUp(self):
+    self.n = tree.CompactNode(supplied_data = "Test")
+    self.n2 = tree.CompactNode(supplied_data = "Test2")
+    self.n3 = tree.CompactNode(supplied_data = "Test3")
+    self.n4 = tree.CompactNode(supplied_data = "Test4")
+    self.n5 = tree.CompactNode(supplied_data = "Test5")
+
+  def test_node_has_no_dict(self):
+    self.assertFalse(hasattr(self.n, '__dict__'))
+
+class CompactTreeTestGaps(TreeTestGaps):
+
+  def setUp(self):
+    self.t = tree.Tree(node_class = tree.CompactNode)
+
+  def test_tree_compact_nodes_used(self):
+    obj = self.t.Insert('10.0.0.0/8', 'compact')
+    self.failUnless(isinstance(obj, tree.CompactNode))
+    self.failUnless(isinstance(obj.GetParent(), tree.CompactNode))
+    self.failUnless(isinstance(self.t.GetRoot(), tree.CompactNode))
+
+class CompactTreeIteration(TreeIteration):
+
+  def setUp(self):
+    self.t = tree.Tree(node_class = tree.CompactNode)
+
 class TreeComparisonTests(unittest.TestCase):
 
   def setUp(self):
@@ -580,6 +1760,155 @@ class TreeComparisonTests(unittest.TestCase):
 
   def test_compare_tree_3(self):
     pass
+
+  def test_compare_tree_without_propagation(self):
+    # Equality is about the addresses covered, not how they were inserted.
+    self.t2 = tree.Tree()
+    self.t.Insert('192.168.0.0/23', 'reason1')
+    self.t2.Insert('192.168.0.0/24', 'reason2')
+    self.t2.Insert('192.168.1.0/24', 'reason3')
+    self.assertEqual(self.t, self.t2)
+    self.t2.Insert('192.168.2.0/24', 'reason4')
+    self.assertNotEqual(self.t, self.t2)
+    self.failIf(self.t == tree.Tree())
+    self.failIf(self.t == tree.Tree(address_family = 6))
+
+  def test_compare_tree_subset(self):
+    self.t2 = tree.Tree()
+    self.t.Insert('10.0.0.0/8', 'eight')
+    self.t2.Insert('10.1.0.0/16', 'sixteen')
+    self.t2.Insert('10.2.0.0/16', 'sixteen')
+    self.failUnless(self.t2.IsSubset(self.t))
+    self.failIf(self.t.IsSubset(self.t2))
+    self.failUnless(self.t2 < self.t)
+    self.failUnless(self.t2 <= self.t)
+    self.failUnless(self.t > self.t2)
+    self.failUnless(self.t >= self.t2)
+    self.failIf(self.t < self.t)
+    self.failUnless(self.t <= self.t)
+    self.t2.Insert('11.0.0.0/16', 'sixteen')
+    self.failIf(self.t2 <= self.t)
+    self.failUnless(tree.Tree() <= self.t)
+
+  def test_union(self):
+    self.t2 = tree.Tree()
+    self.t.Insert('10.0.0.0/9', 'a')
+    self.t.Insert('10.1.0.0/16', 'a')
+    self.t2.Insert('10.128.0.0/9', 'b')
+    self.t2.Insert('192.168.0.0/16', 'b')
+    union = self.t.Union(self.t2)
+    self.assertEqual(list(union.IterateNodes(top_used = True)),
+                     ['10.0.0.0/8', '192.168.0.0/16'])
+    self.assertEqual(union.Lookup('10.0.0.0/8').GetData(),
+                     "Set by CheckRecursivelyUsed")
+    self.assertEqual(union.Lookup('192.168.0.0/16').GetData(), 'Union')
+    self.assertEqual(self.t | self.t2, union)
+    # The operands are left alone.
+    self.assertEqual(list(self.t.IterateNodes(top_used = True)),
+                     ['10.0.0.0/9'])
+
+  def test_intersection(self):
+    self.t2 = tree.Tree()
+    self.t.Insert('10.0.0.0/8', 'a')
+    self.t.Insert('172.16.0.0/12', 'a')
+    self.t2.Insert('10.1.0.0/16', 'b')
+    self.t2.Insert('10.2.3.0/24', 'b')
+    self.t2.Insert('172.0.0.0/8', 'b')
+    self.t2.Insert('192.168.0.0/16', 'b')
+    self.assertEqual(list((self.t & self.t2).IterateNodes(top_used = True)),
+                     ['10.1.0.0/16', '10.2.3.0/24', '172.16.0.0/12'])
+    self.assertEqual(self.t.Intersection(tree.Tree()), tree.Tree())
+
+  def test_difference(self):
+    self.t2 = tree.Tree()
+    self.t.Insert('10.0.0.0/8', 'a')
+    self.t2.Insert('10.0.0.0/9', 'b')
+    self.t2.Insert('10.192.0.0/10', 'b')
+    self.assertEqual(list(self.t.Difference(self.t2).IterateNodes()),
+                     ['10.128.0.0/10'])
+    self.assertEqual(list((self.t2 - self.t).IterateNodes()), [])
+    whole = tree.Tree()
+    whole.Insert('0.0.0.0/0', 'everything', test_dup = False)
+    self.assertEqual(whole - tree.Tree(), whole)
+    self.assertEqual((whole - self.t) | self.t, whole)
+
+  def test_compare_tree_follows_changes(self):
+    # Walking the trees, and (below) comparing the roots' hashes, which
+    # must keep up with every change.
+    self.compare_tree_follows_changes(0)
+
+  def test_compare_tree_follows_changes_hashed(self):
+    self.t = tree.Tree()
+    self.compare_tree_follows_changes(tree._WALKS_BEFORE_HASHING)
+
+  def compare_tree_follows_changes(self, comparisons):
+    self.t._comparisons = comparisons
+    self.t2 = tree.Tree()
+    self.t2._comparisons = comparisons
+    self.t.Insert('10.0.0.0/8', 'a')
+    self.t2.Insert('10.0.0.0/8', 'b')
+    self.assertEqual(self.t, self.t2)
+    self.t2.Insert('10.1.0.0/16', 'b')
+    self.assertEqual(self.t, self.t2)
+    self.t2.Remove('10.0.0.0/8')
+    self.assertNotEqual(self.t, self.t2)
+    self.t2.Insert('10.0.0.0/8', 'b')
+    self.assertEqual(self.t, self.t2)
+    snapshot = self.t2.Snapshot()
+    snapshot._comparisons = comparisons
+    snapshot.Insert('11.0.0.0/8', 'c')
+    self.assertEqual(self.t, self.t2)
+    self.assertNotEqual(self.t, snapshot)
+    self.t.BulkInsert(['11.0.0.0/9', '11.128.0.0/9'], 'd')
+    self.assertEqual(self.t, snapshot)
+
+  def test_compare_tree_matches_lockstep(self):
+    random.seed(20)
+    for trial in xrange(20):
+      self.t = tree.Tree()
+      t2 = tree.Tree()
+      for prefix in xrange(20):
+        addr = random.randrange(0, 16) << 28
+        netlen = random.randrange(1, 7)
+        addr &= ~((1 << (32 - netlen)) - 1) & 0xffffffff
+        for t in random.choice([(self.t,), (t2,), (self.t, t2)]):
+          t.InsertInt(addr, netlen, 'x', test_dup = False)
+      expected = not list(self.t._IterateLockstep(
+          t2, tree._SYMMETRIC_DIFFERENCE))
+      self.assertEqual(self.t == t2, expected)
+      self.t._UpdateHashes()
+      t2._UpdateHashes()
+      self.assertEqual(self.t == t2, expected)
+      self.assertEqual(self.t.IsSubset(t2),
+                       not list((self.t - t2).IterateNodes()))
+
+  def test_first_compares_walk(self):
+    # A tree compared only a few times is walked, not hashed; after
+    # that, its hashes are kept up to date.
+    self.t2 = tree.Tree()
+    self.t.Insert('10.0.0.0/8', 'a')
+    self.t2.Insert('10.0.0.0/9', 'b')
+    self.t2.Insert('10.128.0.0/9', 'b')
+    for i in range(tree._WALKS_BEFORE_HASHING):
+      self.assertEqual(self.t, self.t2)
+    self.assertEqual(self.t.GetRoot()._hash, None)
+    self.assertEqual(self.t, self.t2)
+    self.failIf(self.t.GetRoot()._hash is None)
+    self.failIf(self.t2.GetRoot()._hash is None)
+    self.t2.Insert('11.0.0.0/8', 'b')
+    self.assertNotEqual(self.t, self.t2)
+    self.failUnless(self.t <= self.t2)
+    self.failIf(self.t2 <= self.t)
+    self.assertEqual(list((self.t2 - self.t).IterateNodes()), ['11.0.0.0/8'])
+
+  def test_set_operations_ipv6(self):
+    t6 = tree.Tree(address_family = 6)
+    t6.Insert('2001:db8::/32', 'a')
+    other = tree.Tree(address_family = 6)
+    other.Insert('2001:db8:1::/48', 'b')
+    self.assertEqual(list((t6 & other).IterateNodes()), ['2001:db8:1::/48'])
+    self.failUnless(other <= t6)
+    self.assertRaises(ValueError, t6.Union, self.t)
   
 if __name__ == '__main__':
   unittest.main()
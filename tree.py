@@ -2,11 +2,12 @@
 # encoding: utf-8
 # Niall Richard Murphy <niallm@gmail.com>
 
-"""tree.py - IPv4 prefix storage with fast lookup and find gap operations.
+"""tree.py - IPv4 and IPv6 prefix storage with fast lookup and find gap
+operations.
 
 We use a structure that borrows somewhat from radix trees, patricia tries,
 and plain old binary trees. (Think of it as a binary tree of depth 32,
-with used portions being marked as such.)
+or 128 for IPv6, with used portions being marked as such.)
 
 Although the primitive operations of the tree (insert, find) are obviously
 necssary to implement, the most important operation from the point of view
@@ -27,30 +28,227 @@ already been used, and optionally bomb out. (If not, we mark it used, and
 check whether or not our peer at the same level is also used, in which case
 we mark the parent used.)
 
-To find an unallocated space of LEN X we begin at the root node and proceed 
-first down the left branch until we hit either the level associated with the 
-LEN in question, or hit a marked-as-used ancestor node on the way, or hit a 
-leaf node before LEN depth. If we hit the level associated with the LEN in 
-question and we've not encountered a marked as used component on the path, 
-hooray! We're done. If we have, then back-track and try the right hand branch 
-immediately upwards of the left hand branch that was occupied. Follow again,
-retracing our steps upwards as necessary. This amounts to a pre-order traversal.
+To find an unallocated space of LEN X quickly, every node carries a summary
+of the free space beneath it: how far below the node the largest entirely
+free block sits (0 if the node itself is entirely free, None if nothing
+beneath it is free). A missing child counts as entirely free. We begin at the
+root and, at each node, take the left branch if its summary says a free block
+of LEN X (or larger) exists there, otherwise the right. This is a single
+descent; there is no back-tracking.
+
+Summaries are not recomputed on every change. Anything that changes a node
+(Insert, marking it used, attaching children) instead flags it and all of its
+ancestors as dirty, and the next operation that needs the summaries brings
+the dirty nodes up to date, bottom-up, in one pass.
+
+The same pass also counts how many addresses are in use at or beneath each
+node, so that Utilization can answer for any prefix in one descent.
+
+Each node also carries two Merkle hashes (SHA-1 digests) of its subtree:
+one of the addresses in use (whichever prefixes cover them), which makes ==
+a comparison of roots, and one of the used prefixes and their data, which
+lets Diff skip every subtree that is the same in both trees. They are kept
+the same way, except that the summary pass only marks the dirty nodes'
+hashes out of date, and only a tree that is compared again and again has
+them recomputed (see Tree._HashesWanted): hashing all of a tree costs
+several times more than walking it, so a tree compared only a few times is
+walked instead, and FindGap and the rest never pay for hashes at all.
+Until they are up to date, comparisons walk the trees side by side.
+
+Snapshot copies a tree in constant time by sharing all of its nodes. After
+that, each tree copies a node (and the path from the root down to it)
+before changing it, so the two versions can then be diffed by walking only
+the parts they no longer share. Nodes the two share refuse to be changed
+directly (by SetData and the like), since that would change both.
 
 Created by Niall Murphy on 2007-07-25.
 """
 
+import array
 import constants
+import cPickle
 import fileinput
+import gc
+import hashlib
+import heapq
 import IPy
+import itertools
+import mmap
+import random
 import re
 import string
+import struct
 import sys
+# NumPy is needed only by IntervalTable; everything else does without it.
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 IPy.check_addr_prefixlen = False
 
-class Node:
-  """This is a node on the tree, which stores the address prefix by virtue
-  of its position, but must keep track of its children and parent."""
+# The data given to nodes that exist only because Insert passed through them.
+_CREATED_BY_INSERT = "CREATED BY INSERT"
+# The data given to nodes marked used because both their children are.
+_SET_BY_PROPAGATION = "Set by CheckRecursivelyUsed"
+# The data of the root, until 0.0.0.0/0 (or ::/0) is inserted.
+_ROOT_DATA = "Root"
+
+# The _set_hash of a node all of whose addresses are in use, and of one
+# with none in use, which is also the _hash of the latter; see _Hash. They
+# are the length of a SHA-1 digest, like every other node's hashes.
+_ALL_ADDRESSES = "\xff" * 20
+_NO_ADDRESSES = "\x00" * 20
+# How many times a tree is compared with others before its hashes are
+# kept up to date; see Tree._HashesWanted.
+_WALKS_BEFORE_HASHING = 6
+
+def _SetHash(node):
+  """The _set_hash of node, which may also be None or _COVERED, or None
+  if that is not up to date."""
+  if node is None:
+    return _NO_ADDRESSES
+  if node is _COVERED:
+    return _ALL_ADDRESSES
+  if node._dirty or node._hash is None:
+    return None
+  return node._set_hash
+
+def _EncodeData(data):
+  """Encode a node's data for its _hash, such that data that are not
+  equal are never encoded alike. Strings, numbers, None, and tuples and
+  frozensets of them are encoded by value. Anything else is encoded by
+  identity, so it only ever matches itself: neither its hash() (which
+  collides) nor its repr (which may leave things out) would tell us that
+  two of them are equal."""
+  kind = type(data)
+  if kind is str:
+    return "s" + data
+  if kind is unicode:
+    return "u" + data.encode("utf-8")
+  if kind is int or kind is long or kind is bool:
+    return "i%d" % data
+  if kind is float:
+    return "f" + repr(data)
+  if data is None:
+    return "n"
+  if kind is tuple:
+    return "t" + "".join(["%d:%s" % (len(encoded), encoded)
+                          for encoded in map(_EncodeData, data)])
+  if kind is frozenset:
+    # Equal frozensets may iterate in different orders.
+    return "z" + "".join(["%d:%s" % (len(encoded), encoded)
+                          for encoded in sorted(map(_EncodeData, data))])
+  return "o%d" % id(data)
+
+# Address width in bits, by address family.
+_WIDTHS = {4: 32, 6: 128}
+
+def _Mask(netlen, width = 32):
+  """The netmask for a prefix of length netlen, as an integer."""
+  return (((1 << width) - 1) << (width - netlen)) & ((1 << width) - 1)
+
+def _RouteToInt(route, width = 32):
+  """See Tree.RouteToInt. Plain dotted quads are converted by hand, since
+  this is on the path of every Insert and Lookup; anything else is handed
+  to IPy. Raises ValueError if route is not of the family that width
+  implies."""
+  if width == 32:
+    address, _, netlen = route.partition('/')
+    octets = address.split('.')
+    if len(octets) == 4 and (netlen == '' or netlen.isdigit()):
+      try:
+        value = 0
+        for octet in octets:
+          octet = int(octet)
+          if octet < 0 or octet > 255:
+            raise ValueError
+          value = (value << 8) | octet
+        if netlen == '':
+          return (value, 32)
+        if int(netlen) <= 32:
+          return (value, int(netlen))
+      except ValueError:
+        pass
+  ip = IPy.IP(route, make_net = True)
+  if _WIDTHS[ip.version()] != width:
+    raise ValueError("%s is not a %d-bit prefix" % (route, width))
+  return (ip.int(), ip.prefixlen())
+
+def _IntToRoute(addr, netlen, width = 32):
+  """See Tree.IntToRoute."""
+  addr &= _Mask(netlen, width)
+  if width == 128:
+    return IPy.IP(addr, ipversion = 6).make_net(netlen).strCompressed(1)
+  if netlen == 32:
+    return "%d.%d.%d.%d" % (addr >> 24, (addr >> 16) & 255,
+                            (addr >> 8) & 255, addr & 255)
+  return "%d.%d.%d.%d/%d" % (addr >> 24, (addr >> 16) & 255,
+                             (addr >> 8) & 255, addr & 255, netlen)
+
+# Saved trees (see Tree.Save) start with this header: magic number,
+# address family, node count.
+_SAVE_MAGIC = "PYVTREE\x01"
+_SAVE_HEADER = struct.Struct("<8sB3xI")
+# Bits in the per-node flags byte of a saved tree.
+_SAVED_USED, _SAVED_LEFT, _SAVED_RIGHT = 1, 2, 4
+# array type code for the 32-bit columns of a saved tree.
+_SAVE_INT = 'I'
+if array.array('I').itemsize != 4:
+  _SAVE_INT = 'L'
+
+# The set operations on trees walk two trees together, classifying the
+# node met on each side as _NONE_USED (there is no node), _ALL_USED (it or
+# an ancestor is used) or _SOME_USED (anything else: we have to look at
+# its children to know). _COVERED stands in for the children of a used
+# node, which may or may not actually be there.
+_NONE_USED, _SOME_USED, _ALL_USED = 0, 1, 2
+_COVERED = object()
+
+# What to do with each pair, indexed by state in this tree * 3 + state in
+# the other: 'S'kip it, 'E'mit it as part of the result, or 'R'ecurse
+# into the children. The pairs are, in order:
+#   (none, none) (none, some) (none, all)
+#   (some, none) (some, some) (some, all)
+#   (all, none)  (all, some)  (all, all)
+_UNION = "SRERREEEE"
+_INTERSECTION = "SSSSRRSRE"
+_DIFFERENCE = "SSSRRSERS"
+_SYMMETRIC_DIFFERENCE = "SRERRRERS"
+
+def _SavedLayout(saved, path):
+  """Check the header of saved, the contents of the tree file path (see
+  Tree.Save), and return (address family, node count, offset of flags,
+  of data indexes, of right children, of the data table). Raises
+  ValueError if it is not a saved tree."""
+  if len(saved) < _SAVE_HEADER.size:
+    raise ValueError("%s is not a saved tree" % path)
+  magic, address_family, count = _SAVE_HEADER.unpack_from(saved, 0)
+  if magic != _SAVE_MAGIC or address_family not in _WIDTHS:
+    raise ValueError("%s is not a saved tree" % path)
+  flags_at = _SAVE_HEADER.size
+  data_at = flags_at + count
+  right_at = data_at + 4 * count
+  table_at = right_at + 4 * count
+  if len(saved) <= table_at:
+    raise ValueError("%s is truncated" % path)
+  return (address_family, count, flags_at, data_at, right_at, table_at)
+
+class _Owner(object):
+  """The _owner of the nodes a tree may change in place; see
+  Tree.Snapshot. Once shared is set, the tree has been snapshotted, so its
+  nodes from before then belong to both trees and must not be changed
+  directly."""
+
+  def __init__(self):
+    self.shared = False
+
+class _NodeBase(object):
+  """The behaviour shared by Node and CompactNode. This holds no state of
+  its own (hence the empty __slots__); the subclasses decide how the
+  per-node members are stored."""
+
+  __slots__ = ()
 
   def __init__(self,
                supplied_parent = None,
@@ -63,8 +261,18 @@ class Node:
     self.right = supplied_right
     self.parent = supplied_parent
     self.data = supplied_data
-    self.used = supplied_used
+    self._used = supplied_used
     self.level = None
+    # Free-space summary, used-address count and hashes; see the module
+    # docstring. A new node has not been summarised yet, so starts out
+    # dirty.
+    self._free = None
+    self._count = 0
+    self._hash = None
+    self._set_hash = _NO_ADDRESSES
+    self._dirty = True
+    # The tree that may change this node in place; see Tree.Snapshot.
+    self._owner = None
 
   def GetData(self):
     """Return the per-node 'user data' (essentially anything you could
@@ -73,7 +281,9 @@ class Node:
 
   def SetData(self, supplied_data = None):
     """Change the per-node 'user data' to the supplied anything."""
+    self._CheckWritable()
     self.data = supplied_data
+    self._MarkDirty()
 
   def GetParent(self):
     """What object is my parent? Returns Node or None."""
@@ -81,6 +291,7 @@ class Node:
 
   def SetParent(self, supplied_parent = None):
     """Change my parent to be a Node object or None."""
+    self._CheckWritable()
     self.parent = supplied_parent
 
   def GetLeft(self):
@@ -89,7 +300,9 @@ class Node:
 
   def SetLeft(self, supplied_left = None):
     """Change my left-hand object to be Node or None."""
+    self._CheckWritable()
     self.left = supplied_left
+    self._MarkDirty()
 
   def GetRight(self):
     """What's to my right? Returns Node or None."""
@@ -97,7 +310,37 @@ class Node:
 
   def SetRight(self, supplied_right = None):
     """Change my right-hand object to be Node or None."""
+    self._CheckWritable()
     self.right = supplied_right
+    self._MarkDirty()
+
+  def _GetUsed(self):
+    return self._used
+
+  def _SetUsed(self, supplied_used):
+    self._CheckWritable()
+    self._used = supplied_used
+    self._MarkDirty()
+
+  def _CheckWritable(self):
+    """Raise ValueError if I am shared between a tree and its snapshot.
+    Changing me in place would change both trees, and my ancestors (whose
+    summaries would then be marked dirty) may belong to either."""
+    owner = self._owner
+    if owner is not None and owner.shared:
+      raise ValueError("Node is shared with a snapshot; change it through "
+                       "the tree (Insert, Remove and so on) instead")
+
+  def _MarkDirty(self):
+    """Flag my free-space summary, and those of my ancestors, as needing
+    to be recomputed. We can stop at the first ancestor already flagged,
+    since its own ancestors must have been flagged along with it."""
+    current = self
+    while current is not None and not current._dirty:
+      current._dirty = True
+      current = current.parent
+
+  used = property(_GetUsed, _SetUsed)
 
   def _GetLevel(self):
     """Get level caching implementation."""
@@ -171,8 +414,9 @@ class Node:
       current = current.GetParent()
     return binary[::-1]
 
-  def AboutMe(self):
-    """A misc debugging function that prints stuff about the node."""
+  def AboutMe(self, width = 32):
+    """A misc debugging function that prints stuff about the node. width
+    is that of the tree's addresses: 32 for IPv4, 128 for IPv6."""
     if self.AmRoot():
       print "\tI am the root"
     if self.used:
@@ -183,9 +427,9 @@ class Node:
     print "\tData: ", self.GetData()
     binstr = self.GetPath()
     print "\tPath: ", binstr
-    complete_addr = self.binstring_to_hex(binstr)
+    complete_addr = self.binstring_to_hex(binstr, width)
     print "\tComplete Addr: ", complete_addr
-    print "Prefix: ", self.hex_to_cidr(complete_addr)
+    print "Prefix: ", self.hex_to_cidr(complete_addr, width)
     if self.AmLeft():
       print "\tI am left child of ", self.GetParent().GetPath()
     if self.AmRight():
@@ -199,27 +443,95 @@ class Node:
     else:
       print "\tDON'T have a right child "
 
-  def binstring_to_hex(self, binstr):
+  def binstring_to_hex(self, binstr, width = 32):
     q = len(binstr)
-    for count in range(q, 32):
+    for count in range(q, width):
       binstr += "0"
-    iphex = hex(int(binstr,2))
+    iphex = "%#x" % int(binstr,2)
     complete_addr = iphex + "/" + str(self.GetLevel())
     return complete_addr
 
-  def hex_to_cidr(self, hex):
+  def hex_to_cidr(self, hex, width = 32):
+    if width == 128:
+      return IPy.IP(hex, ipversion = 6).strCompressed(1)
     return IPy.IP(hex).strNormal(1)
 
+class Node(_NodeBase):
+  """This is a node on the tree, which stores the address prefix by virtue
+  of its position, but must keep track of its children and parent.
+
+  Members live in an ordinary per-instance __dict__, so callers are free
+  to hang extra attributes off a node."""
+
+  def _Copy(self, owner):
+    """Return a copy of me, belonging to owner (see Tree.Snapshot). The
+    copy shares my children rather than copying them."""
+    new = Node.__new__(self.__class__)
+    new.__dict__.update(self.__dict__)
+    new._owner = owner
+    return new
+
+class CompactNode(_NodeBase):
+  """A Node whose members are kept in __slots__ rather than a __dict__.
+
+  Behaviour is identical, but each node is several times smaller, which
+  matters once a tree holds a full routing table. Select it with
+  Tree(node_class = CompactNode)."""
+
+  __slots__ = ('left', 'right', 'parent', 'data', '_used', 'level',
+               '_free', '_count', '_hash', '_set_hash', '_dirty', '_owner')
+
+  def _Copy(self, owner):
+    """See Node._Copy."""
+    new = CompactNode.__new__(self.__class__)
+    new.left = self.left
+    new.right = self.right
+    new.parent = self.parent
+    new.data = self.data
+    new._used = self._used
+    new.level = self.level
+    new._free = self._free
+    new._count = self._count
+    new._hash = self._hash
+    new._set_hash = self._set_hash
+    new._dirty = self._dirty
+    new._owner = owner
+    return new
+
 class Tree:
   """A Tree consists of nodes and a number of important methods.
   The root node is a root node, obviously. Import methods include
   insert, lookup and FindGap."""
 
-  def __init__(self, supplied_debug = 0):
+  def __init__(self, supplied_debug = 0, node_class = None,
+               address_family = 4):
+    """address_family is 4 or 6; a tree holds prefixes of one family
+    only, and everything else (Insert, Lookup, FindGap...) behaves the
+    same for both. node_class chooses how nodes are stored: Node, or
+    CompactNode for large trees where memory is a concern. IPv6 trees
+    default to CompactNode, since their paths are four times longer."""
+    if address_family not in _WIDTHS:
+      raise ValueError("address_family must be 4 or 6, not %s" %
+                       address_family)
+    if node_class is None:
+      if address_family == 6:
+        node_class = CompactNode
+      else:
+        node_class = Node
     # initializes the root member
     self.total_unusable_prefixes = 0
-    self.root = Node(supplied_data = "Root")
+    self.address_family = address_family
+    self.width = _WIDTHS[address_family]
+    self.node_class = node_class
     self.debug = supplied_debug
+    # Nodes with this _owner are ours to change in place; any others are
+    # shared with a snapshot and must be copied first. See Snapshot.
+    self._owner = _Owner()
+    self.root = node_class(supplied_data = _ROOT_DATA)
+    self.root._owner = self._owner
+    # How many times we have been compared with another tree; see
+    # _HashesWanted.
+    self._comparisons = 0
 
   def __str__(self):
     for prefix, data in self.IterateNodes(return_data = True):
@@ -244,38 +556,65 @@ class Tree:
         have filled in all children of a parent.
     
     Otherwise return the node that we just inserted."""
-    ip = IPy.IP(route)
-    binary = ip.strBin()
-    netlen = ip.prefixlen()
-    current = self.root
+    addr, netlen = self.RouteToInt(route)
+    return self.InsertInt(addr, netlen, supplied_data, mark_used = mark_used,
+                          test_used = test_used, test_none = test_none,
+                          test_dup = test_dup, propagate_used = propagate_used)
+
+  def InsertInt(self, addr, netlen, supplied_data, mark_used = True,
+                test_used = False, test_none = False, test_dup = True,
+                propagate_used = False):
+    """Insert the prefix addr/netlen, where addr is an integer, with
+    supplied_data into the tree. Flags and return values are as for Insert.
+
+    This is the real implementation behind Insert: rather than stepping
+    through a binary string we pick the branch for each level by shifting
+    addr, so host bits beyond netlen are simply never looked at."""
     if self.debug >= 2:
-      print "Binary is [%s], [%s] char is [%s]" % (binary, netlen, binary[netlen])
-    for x in binary[:netlen]:
-      if current.used and test_used == True:
+      print "InsertInt of [%s/%s]" % (addr, netlen)
+    test_used = (test_used == True)
+    test_none = (test_none == True)
+    node_class = self.node_class
+    owner = self._owner
+    current = self._OwnRoot()
+    level = 0
+    for shift in xrange(self.width - 1, self.width - 1 - netlen, -1):
+      if test_used and current._used:
         return False
-      if x == '0':
-        if current.GetLeft() == None and test_none == False:
-          current.SetLeft(Node(current))
-          current.GetLeft().used = False
-          current.GetLeft().SetData("CREATED BY INSERT")
-        elif current.GetLeft() == None and test_none == True:
-          return False
-        current = current.GetLeft()
-      elif x == '1':
-        if current.GetRight() == None and test_none == False:
-          current.SetRight(Node(current))
-          current.GetRight().used = False
-          current.GetRight().SetData("CREATED BY INSERT")
-        elif current.right == None and test_none == True:
-          return False
-        current = current.GetRight()
+      current._dirty = True
+      level += 1
+      if (addr >> shift) & 1:
+        child = current.right
+        if child is None:
+          if test_none:
+            return False
+          child = node_class(current, None, None, _CREATED_BY_INSERT)
+          child.level = level
+          child._owner = owner
+          current.right = child
+        elif child._owner is not owner:
+          child = child._Copy(owner)
+          child.parent = current
+          current.right = child
       else:
-        """Don't understand how this could come about."""
-        raise ValueException
-    if test_dup == True and current.GetData() != "CREATED BY INSERT":
+        child = current.left
+        if child is None:
+          if test_none:
+            return False
+          child = node_class(current, None, None, _CREATED_BY_INSERT)
+          child.level = level
+          child._owner = owner
+          current.left = child
+        elif child._owner is not owner:
+          child = child._Copy(owner)
+          child.parent = current
+          current.left = child
+      current = child
+    current._dirty = True
+    if test_dup == True and current.GetData() != _CREATED_BY_INSERT:
       return False
     if mark_used == True:
-      current.used = True
+      current._used = True
     current.SetData(supplied_data)
     if propagate_used is True:
       self.CheckRecursivelyUsed(current)
@@ -283,308 +622,994 @@ class Tree:
 
   def CheckRecursivelyUsed(self, node):
     """Given a node, mark it used if both its children are used,
-    and recurse upwards."""
-    if node.GetLeft() is not None and node.GetRight() is not None:
+    and recurse upwards. A node that is used already, such as one
+    inserted in its own right, is left as it is."""
+    if (not node.used and node.GetLeft() is not None and
+        node.GetRight() is not None):
       if node.GetLeft().used and node.GetRight().used:
         node.used = True
-        node.SetData("Set by CheckRecursivelyUsed")
+        node.SetData(_SET_BY_PROPAGATION)
     if node is self.root:
         return
     self.CheckRecursivelyUsed(node.GetParent())
 
+  @classmethod
+  def FromSorted(cls, routes, supplied_data = None, propagate_used = False,
+                 supplied_debug = 0, node_class = None, address_family = 4):
+    """Build a new tree from routes in one pass; see BulkInsert for what
+    routes may contain. The remaining arguments are as for Tree()."""
+    new_tree = cls(supplied_debug = supplied_debug, node_class = node_class,
+                   address_family = address_family)
+    new_tree.BulkInsert(routes, supplied_data,
+                        propagate_used = propagate_used)
+    return new_tree
+
+  def BulkInsert(self, routes, supplied_data = None, mark_used = True,
+                 test_dup = True, propagate_used = False):
+    """Insert many routes at once. Each element of routes is either a
+    route in CIDR format, which gets supplied_data, or a (route, data)
+    pair. Flags are as for Insert. Returns the number of routes inserted
+    (duplicates skipped because of test_dup are not counted).
+
+    routes must be sorted by address, and a route must come before any
+    it covers: the order of a route dump, IterateNodes or
+    GenerateForPrefix. We raise ValueError at the first one that is out
+    of order, leaving those before it inserted."""
+    route_to_int = self.RouteToInt
+    def Prefixes():
+      for item in routes:
+        if isinstance(item, basestring):
+          addr, netlen = route_to_int(item)
+          yield (addr, netlen, supplied_data)
+        else:
+          addr, netlen = route_to_int(item[0])
+          yield (addr, netlen, item[1])
+    return self.BulkInsertInt(Prefixes(), supplied_data, mark_used = mark_used,
+                              test_dup = test_dup,
+                              propagate_used = propagate_used)
+
+  def BulkInsertInt(self, prefixes, supplied_data = None, mark_used = True,
+                    test_dup = True, propagate_used = False):
+    """As BulkInsert, where each element of prefixes is an (integer
+    address, prefix length) pair, which gets supplied_data, or an
+    (integer address, prefix length, data) triple.
+
+    Rather than descending from the root for every prefix, we keep the
+    path to the previous one and only walk the part of the new prefix
+    that differs from it, which is usually only a couple of nodes. With
+    propagate_used, each node is checked once, as the walk leaves it for
+    good, instead of CheckRecursivelyUsed climbing all the way to the
+    root after every insert. Both rely on the input being sorted.
+
+    The cyclic garbage collector is switched off for the duration: a
+    load allocates millions of nodes, none of which become garbage, and
+    the collector would otherwise keep stopping to scan them all."""
+    width = self.width
+    node_class = self.node_class
+    owner = self._owner
+    propagate_used = (propagate_used == True)
+    test_dup = (test_dup == True)
+    mark_used = (mark_used == True)
+    # path[i] is the node at depth i on the way to the previous prefix.
+    path = [self._OwnRoot()]
+    self.root._dirty = True
+    previous = 0
+    previous_len = 0
+    inserted = 0
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+      for item in prefixes:
+        if len(item) == 3:
+          addr, netlen, data = item
+        else:
+          addr, netlen = item
+          data = supplied_data
+        addr &= _Mask(netlen, width)
+        if addr < previous or (addr == previous and netlen < previous_len):
+          raise ValueError("%s follows %s; input must be sorted" %
+                           (self.IntToRoute(addr, netlen),
+                            self.IntToRoute(previous, previous_len)))
+        # Keep the part of the path that this prefix shares.
+        common = min(width - (addr ^ previous).bit_length(), netlen,
+                     len(path) - 1)
+        if propagate_used:
+          for level in xrange(len(path) - 1, common, -1):
+            self._PropagateUsed(path[level])
+        del path[common + 1:]
+        current = path[common]
+        for level in xrange(common + 1, netlen + 1):
+          if (addr >> (width - level)) & 1:
+            child = current.right
+            if child is None:
+              child = node_class(current, None, None, _CREATED_BY_INSERT)
+              child.level = level
+              child._owner = owner
+              current.right = child
+            elif child._owner is not owner:
+              child = child._Copy(owner)
+              child.parent = current
+              current.right = child
+          else:
+            child = current.left
+            if child is None:
+              child = node_class(current, None, None, _CREATED_BY_INSERT)
+              child.level = level
+              child._owner = owner
+              current.left = child
+            elif child._owner is not owner:
+              child = child._Copy(owner)
+              child.parent = current
+              current.left = child
+          child._dirty = True
+          path.append(child)
+          current = child
+        previous = addr
+        previous_len = netlen
+        if test_dup and current.data != _CREATED_BY_INSERT:
+          continue
+        if mark_used:
+          current._used = True
+        current.data = data
+        inserted += 1
+    finally:
+      # Whatever we managed to insert gets propagated, even if we are
+      # bailing out on unsorted input.
+      if propagate_used:
+        for level in xrange(len(path) - 1, -1, -1):
+          self._PropagateUsed(path[level])
+      if gc_was_enabled:
+        gc.enable()
+    return inserted
+
+  def _PropagateUsed(self, node):
+    """CheckRecursivelyUsed for node alone, without the climb upwards."""
+    left = node.left
+    right = node.right
+    if (not node._used and left is not None and right is not None and
+        left._used and right._used):
+      node._used = True
+      node.data = _SET_BY_PROPAGATION
+
   def Lookup(self, route, used_check = False):
     """Look up the route supplied in CIDR format and return it if
     present in the tree. Otherwise return None. used_check returns
     True if we hit a marked_as_used node on the way down to our
     lookup (in other words, a covering subnet has been registered.)"""
-    ip = IPy.IP(route)
-    binary = ip.strBin()
-    netlen = ip.prefixlen()
-    level = 0
+    addr, netlen = self.RouteToInt(route)
+    return self.LookupInt(addr, netlen, used_check = used_check)
+
+  def LookupInt(self, addr, netlen, used_check = False):
+    """Look up the prefix addr/netlen, where addr is an integer, and
+    return its node if present in the tree, otherwise None. used_check
+    is as for Lookup."""
+    used_check = (used_check == True)
     current = self.root
-    for x in binary[:netlen]:
-      if current.used == True and used_check == True:
+    for shift in xrange(self.width - 1, self.width - 1 - netlen, -1):
+      if used_check and current.used == True:
         return current
-      if x == '0':
-        current = current.GetLeft()
-      elif x == '1':
-        current = current.GetRight()
-      if current == None:
+      if (addr >> shift) & 1:
+        current = current.right
+      else:
+        current = current.left
+      if current is None:
         return None
     return current
 
+  def LongestMatch(self, route):
+    """Return the most specific used node covering route (an address or
+    a prefix in CIDR format), or None if nothing covers it. Unlike
+    Lookup with used_check, which stops at the first (least specific)
+    used node, this is a proper longest-prefix match."""
+    addr, netlen = self.RouteToInt(route)
+    return self.LongestMatchInt(addr, netlen)
+
+  def LongestMatchInt(self, addr, netlen = None):
+    """As LongestMatch, for an integer address (and prefix length; by
+    default, that of a host route)."""
+    if netlen is None:
+      netlen = self.width
+    best = None
+    current = self.root
+    for shift in xrange(self.width - 1, self.width - 1 - netlen, -1):
+      if current._used:
+        best = current
+      if (addr >> shift) & 1:
+        current = current.right
+      else:
+        current = current.left
+      if current is None:
+        return best
+    if current._used:
+      best = current
+    return best
+
   def Remove(self, route):
-    if self.Lookup(route) != None:
-      """Mark current node un-used. TODO(niallm): Is this sufficient?"""
-      current.used = False
+    """Remove route, inserted earlier, from the tree, and return the data
+    it was inserted with. Raises ValueError if route was never inserted.
+
+    Any ancestors marked used only because their children were (see
+    CheckRecursivelyUsed) are un-marked, since that no longer holds, and
+    nodes left with neither children nor anything else to keep them are
+    pruned, so a tree that sees as many removals as inserts does not
+    keep on growing."""
+    addr, netlen = self.RouteToInt(route)
+    return self.RemoveInt(addr, netlen)
+
+  def RemoveInt(self, addr, netlen):
+    """As Remove, for an integer address and prefix length."""
+    node = self.LookupInt(addr, netlen)
+    if node is self.root:
+      blank = _ROOT_DATA
     else:
-      raise ValueException
+      blank = _CREATED_BY_INSERT
+    # Nodes only passed through, and those marked used only because their
+    # children are, were never inserted.
+    if (node is None or node.data == _SET_BY_PROPAGATION or
+        (not node._used and node.data == blank)):
+      raise ValueError("%s not present in tree" %
+                       self.IntToRoute(addr, netlen))
+    path = self._WritablePath(addr, netlen)
+    node = path[-1]
+    data = node.data
+    node._used = False
+    node.data = blank
+    for ancestor in path:
+      ancestor._dirty = True
+    for ancestor in reversed(path[:-1]):
+      if not ancestor._used or ancestor.data != _SET_BY_PROPAGATION:
+        break
+      ancestor._used = False
+      if ancestor is self.root:
+        ancestor.data = _ROOT_DATA
+      else:
+        ancestor.data = _CREATED_BY_INSERT
+    for level in xrange(len(path) - 1, 0, -1):
+      node = path[level]
+      if (node._used or node.data != _CREATED_BY_INSERT or
+          node.left is not None or node.right is not None):
+        break
+      parent = path[level - 1]
+      if parent.left is node:
+        parent.left = None
+      else:
+        parent.right = None
+    return data
+
+  def _WritablePath(self, addr, netlen):
+    """Return the nodes from the root down to addr/netlen, which must be
+    present, copying any that are shared with a snapshot (as InsertInt
+    does) so that they may be changed."""
+    owner = self._owner
+    current = self._OwnRoot()
+    path = [current]
+    for shift in xrange(self.width - 1, self.width - 1 - netlen, -1):
+      if (addr >> shift) & 1:
+        child = current.right
+        if child._owner is not owner:
+          child = child._Copy(owner)
+          child.parent = current
+          current.right = child
+      else:
+        child = current.left
+        if child._owner is not owner:
+          child = child._Copy(owner)
+          child.parent = current
+          current.left = child
+      path.append(child)
+      current = child
+    return path
 
   def IterateNodes(self, prefix=None, return_data = False, top_used = False):
-    """Generator for nodes marked used in the current tree,
-    rooted at the supplied prefix."""
+    """Generator for nodes marked used in the current tree, rooted at the
+    supplied prefix, in address order (a prefix comes before those it
+    covers). Yields each prefix in CIDR format, or (prefix, data) with
+    return_data. top_used yields only the topmost used nodes, not the
+    used nodes beneath them. Raises ValueError if prefix is not present."""
+    int_to_route = self.IntToRoute
+    if return_data:
+      for addr, netlen, data in self.IterateNodesInt(prefix, True, top_used):
+        yield (int_to_route(addr, netlen), data)
+    else:
+      for addr, netlen in self.IterateNodesInt(prefix, False, top_used):
+        yield int_to_route(addr, netlen)
+
+  def IterateNodesInt(self, prefix = None, return_data = False,
+                      top_used = False):
+    """As IterateNodes, but yield (integer address, prefix length) pairs,
+    or (integer address, prefix length, data) triples with return_data;
+    the latter can be fed straight to BulkInsertInt.
+
+    The walk carries each node's address down with it, so nothing is
+    worked out afresh per node (as GetPath would, by climbing back to the
+    root) and no strings are made."""
     if prefix is not None:
-      node = self.Lookup(prefix)
-      if node == None:
-        raise "Node Not Present"
-      else:
-        original = node
-        current = node
-        next_node = node
-        previous = node
+      addr, level = self.RouteToInt(prefix)
+      node = self.LookupInt(addr, level)
+      if node is None:
+        raise ValueError("%s not present in tree" % prefix)
+      addr &= _Mask(level, self.width)
     else:
-      original = self.root
-      current = self.root
-      next_node = self.root
-      previous = self.root    
-    while (current != None):
-      if self.debug > 2:
-        print "Previous path: ", (previous.GetPath(), 
-                                  self.PathToDotQuad(previous.GetPath(), 
-                                                        previous.GetLevel()))
-        print "Current path: ", (current.GetPath(), 
-                                 self.PathToDotQuad(current.GetPath(), 
-                                                       current.GetLevel()))
-        print "ITERATE", current.AboutMe()
-      if current.used == True:
-        if self.debug >= 2:
-          print "*** GET USED OK FOR", current.GetPath()
-        binstr = current.GetPath()
-        prefix = self.PathToDotQuad(binstr, current.GetLevel())
+      node, addr, level = self.root, 0, 0
+    return self._IterateBelow(node, addr, level, return_data, top_used)
+
+  def _IterateBelow(self, node, addr, level, return_data, top_used):
+    """Generator for the used nodes at and beneath node, which is the
+    prefix addr/level, as for IterateNodesInt."""
+    top = self.width - 1
+    debug = self.debug
+    stack = [(node, addr, level)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+      node, addr, level = pop()
+      if node._used:
+        if debug >= 2:
+          print "*** GET USED OK FOR", self.IntToRoute(addr, level)
         if return_data:
-          yield (prefix, current.GetData())
+          yield (addr, level, node.data)
         else:
-          yield prefix
-        if top_used is True:
-          next_node = current.GetParent()
-          previous = current
-          current = next_node
+          yield (addr, level)
+        if top_used:
           continue
-      if previous == current.GetParent() or (previous == original and current == original):
-        if self.debug >= 2:
-          print "Came from parent, therefore try to go left."
-        if current.GetLeft() == None:
-          if current.GetRight() == None:
-            next_node = current.GetParent()
-          else:
-            next_node = current.GetRight()
-        else:
-          next_node = current.GetLeft()
-      elif previous == current.GetLeft():
-        if self.debug >= 2:
-          print "Came from my left child, therefore try to go right."
-        if current.GetRight() == None:
-          next_node = current.GetParent()
+      # Right first, so that left comes off the stack first.
+      if node.right is not None:
+        push((node.right, addr | (1 << (top - level)), level + 1))
+      if node.left is not None:
+        push((node.left, addr, level + 1))
+
+  def Covered(self, prefix, return_data = False, top_used = False):
+    """Generator for the used prefixes that fall within prefix (given in
+    CIDR format), prefix itself included, in address order: say, all the
+    interface subnets inside 193.1.0.0/16. Yields CIDR strings, or
+    (prefix, data) with return_data; top_used is as for IterateNodes.
+
+    Unlike IterateNodes(prefix = ...), prefix need not be in the tree;
+    if nothing was inserted within it, nothing is yielded."""
+    int_to_route = self.IntToRoute
+    addr, netlen = self.RouteToInt(prefix)
+    if return_data:
+      for addr, netlen, data in self.CoveredInt(addr, netlen, True, top_used):
+        yield (int_to_route(addr, netlen), data)
+    else:
+      for addr, netlen in self.CoveredInt(addr, netlen, False, top_used):
+        yield int_to_route(addr, netlen)
+
+  def CoveredInt(self, addr, netlen, return_data = False, top_used = False):
+    """As Covered, for an integer address and prefix length, yielding
+    (integer address, prefix length) pairs, or triples with data."""
+    node = self.LookupInt(addr, netlen)
+    if node is None:
+      return iter(())
+    return self._IterateBelow(node, addr & _Mask(netlen, self.width), netlen,
+                              return_data, top_used)
+
+  def Covering(self, route, return_data = False):
+    """Generator for the used prefixes that contain route (an address or
+    a prefix in CIDR format), route itself included, from the least to
+    the most specific, which is also address order. The last one yielded
+    is what LongestMatch would return. Yields CIDR strings, or (prefix,
+    data) with return_data."""
+    int_to_route = self.IntToRoute
+    addr, netlen = self.RouteToInt(route)
+    if return_data:
+      for addr, netlen, data in self.CoveringInt(addr, netlen, True):
+        yield (int_to_route(addr, netlen), data)
+    else:
+      for addr, netlen in self.CoveringInt(addr, netlen):
+        yield int_to_route(addr, netlen)
+
+  def CoveringInt(self, addr, netlen = None, return_data = False):
+    """As Covering, for an integer address (and prefix length; by
+    default, that of a host route), yielding (integer address, prefix
+    length) pairs, or triples with data."""
+    width = self.width
+    if netlen is None:
+      netlen = width
+    current = self.root
+    level = 0
+    while True:
+      if current._used:
+        prefix = addr & _Mask(level, width)
+        if return_data:
+          yield (prefix, level, current.data)
         else:
-          next_node = current.GetRight()
-      elif previous == current.GetRight():
-        if self.debug >= 2: 
-          print "Came from my right child, therefore try to go up."
-        next_node = current.GetParent()
-      if next_node == original.GetParent():
+          yield (prefix, level)
+      if level == netlen:
         return
-      previous = current
-      current = next_node
-    if self.debug >= 2:
-      print "FALL OUT BOTTOM"
+      if (addr >> (width - 1 - level)) & 1:
+        current = current.right
+      else:
+        current = current.left
+      if current is None:
+        return
+      level += 1
 
   def PrintIterableNodes(self):
     if self.debug >= 2:
       print "tree PrintIterableNodes has:"
-    for prefix_data in self.IterateNodes(True):
+    for prefix_data in self.IterateNodes(return_data = True):
       print prefix_data
 
   def CountUsedNodes(self):
     """Count the inserted nodes in the tree; i.e., the ones marked as
     used."""
     count = 0
-    for node in self.IterateNodes():
+    for node in self.IterateNodesInt():
       count += 1
     return count
 
+  def Utilization(self, prefix):
+    """Return (used, free): how many of the addresses in prefix (CIDR
+    format) are covered by used prefixes, and how many are not. prefix
+    need not be in the tree. Each node keeps a count of the addresses in
+    use beneath it, so this is a single descent, once the counts are up
+    to date (see the module docstring)."""
+    addr, netlen = self.RouteToInt(prefix)
+    return self.UtilizationInt(addr, netlen)
+
+  def UtilizationInt(self, addr, netlen):
+    """As Utilization, for an integer address and prefix length."""
+    if self.root._dirty:
+      self._Summarise(self.root)
+    total = 1 << (self.width - netlen)
+    current = self.root
+    for shift in xrange(self.width - 1, self.width - 1 - netlen, -1):
+      if current._used:
+        return (total, 0)
+      if (addr >> shift) & 1:
+        current = current.right
+      else:
+        current = current.left
+      if current is None:
+        return (0, total)
+    return (current._count, total - current._count)
+
+  def UtilizationByPrefix(self, netlen):
+    """Generator for (prefix, used, free), in address order, for every
+    prefix of length netlen with any addresses in use: a capacity report
+    of, say, every /16, from one walk of the tree. Prefixes are in CIDR
+    format."""
+    int_to_route = self.IntToRoute
+    for addr, length, used, free in self.UtilizationByPrefixInt(netlen):
+      yield (int_to_route(addr, length), used, free)
+
+  def UtilizationByPrefixInt(self, netlen):
+    """As UtilizationByPrefix, but yield (integer address, prefix length,
+    used, free) tuples."""
+    if self.root._dirty:
+      self._Summarise(self.root)
+    width = self.width
+    total = 1 << (width - netlen)
+    stack = [(self.root, 0, 0)]
+    while stack:
+      node, addr, level = stack.pop()
+      if node._used and level < netlen:
+        # Every prefix of length netlen under here is full.
+        step = 1 << (width - netlen)
+        end = addr + (1 << (width - level))
+        while addr < end:
+          yield (addr, netlen, total, 0)
+          addr += step
+        continue
+      if level == netlen:
+        if node._count:
+          yield (addr, netlen, node._count, total - node._count)
+        continue
+      if node.right is not None and node.right._count:
+        stack.append((node.right, addr | (1 << (width - 1 - level)),
+                      level + 1))
+      if node.left is not None and node.left._count:
+        stack.append((node.left, addr, level + 1))
+
+  def UtilizationHistogram(self, netlen, buckets = 10):
+    """Return a list of buckets counts: how many of all the prefixes of
+    length netlen are less than 1/buckets used, how many from 1/buckets
+    up to 2/buckets, and so on, the last bucket also taking those that are
+    entirely used. Prefixes with nothing in use at all (which
+    UtilizationByPrefix leaves out) are counted in the first bucket, and
+    used prefixes shorter than netlen are counted in bulk, not one by
+    one."""
+    if self.root._dirty:
+      self._Summarise(self.root)
+    width = self.width
+    total = 1 << (width - netlen)
+    histogram = [0] * buckets
+    counted = 0
+    stack = [(self.root, 0)]
+    while stack:
+      node, level = stack.pop()
+      if node._used:
+        full = 1 << (netlen - min(level, netlen))
+        histogram[-1] += full
+        counted += full
+        continue
+      if level == netlen:
+        histogram[min(node._count * buckets / total, buckets - 1)] += 1
+        counted += 1
+        continue
+      for child in (node.left, node.right):
+        if child is not None and child._count:
+          stack.append((child, level + 1))
+    histogram[0] += (1 << netlen) - counted
+    return histogram
+
+  def Summarize(self, max_extra = 0):
+    """Return the shortest list of prefixes, in CIDR format and address
+    order, that covers exactly the addresses in use: used prefixes that
+    together fill a supernet are replaced by it, and prefixes beneath a
+    used one are left out.
+
+    With max_extra, each prefix returned may also take in up to max_extra
+    addresses that are not in use, so that, say, three used /26s can be
+    advertised as their /24 with max_extra = 64."""
+    int_to_route = self.IntToRoute
+    return [int_to_route(addr, netlen)
+            for addr, netlen in self.SummarizeInt(max_extra)]
+
+  def SummarizeInt(self, max_extra = 0):
+    """As Summarize, but return (integer address, prefix length) pairs."""
+    result = []
+    self._SummarizeBelow(self.root, 0, 0, max_extra, result)
+    return result
+
+  def _SummarizeBelow(self, node, addr, level, max_extra, result):
+    """Append the summary of node, which is addr/level, to result, and
+    return how many addresses beneath it are in use. This is a single
+    bottom-up pass: the summaries of the children are appended first,
+    then replaced by node itself if it turns out to qualify."""
+    size = 1 << (self.width - level)
+    if node._used:
+      result.append((addr, level))
+      return size
+    start = len(result)
+    used = 0
+    if node.left is not None:
+      used += self._SummarizeBelow(node.left, addr, level + 1, max_extra,
+                                   result)
+    if node.right is not None:
+      used += self._SummarizeBelow(node.right,
+                                   addr | (1 << (self.width - level - 1)),
+                                   level + 1, max_extra, result)
+    if used and size - used <= max_extra:
+      del result[start:]
+      result.append((addr, level))
+    return used
+
   def FindGap(self, size, strict = True, start_from = None,
                test_blank = False):
-    """Find a gap of prefixlen size, by following algorithm above. FIXME - move
-    that down. strict = True implies we will return a string of exactly the size
+    """Find the first (lowest-addressed) free prefix of prefixlen size and
+    return it as a string, or None if there is no such gap. See the module
+    docstring for how; it costs one descent from the top of the tree.
+
+    strict = True implies we will return a string of exactly the size
     you are looking for - e.g. if 128.0.0.0/1 is free and you ask for first /8,
     you will get 128.0.0.0/8. With strict off you get 128.0.0.0/1. 
-    start_from is the node we'll start from.
-    test_blank = True implies we will bomb out if at any stage
-    we find ourselves heading onto a node which is neither marked used
-    or indeed present."""
-    if start_from == None:
-      current = self.root
-      next_node = self.root
-      previous = self.root
-    else:
-      current = start_from
-      next_node = None
-      previous = current.GetParent()
+    start_from is the node we'll start from; only gaps beneath it count.
+    test_blank = True implies we will bomb out (return None) if the gap
+    we find is not a node present in the tree."""
+    result = self.FindGapInt(size, strict = strict, start_from = start_from,
+                             test_blank = test_blank)
+    if result is None:
+      return None
+    return self.IntToRoute(result[0], result[1])
+
+  def FindGapInt(self, size, strict = True, start_from = None,
+                 test_blank = False):
+    """As FindGap, but return the gap as an (integer address, prefix
+    length) tuple."""
     if self.debug >= 1:
       print "Called Tree.FindGap(%s)" % size
-    while (current != None and current.GetLevel() <= size):
+    if start_from is None:
+      return self._FindGapBelow(self.root, 0, 0, size, strict, test_blank)
+    level = start_from.GetLevel()
+    addr = 0
+    if level > 0:
+      addr = int(start_from.GetPath(), 2) << (self.width - level)
+    return self._FindGapBelow(start_from, addr, level, size, strict,
+                              test_blank)
+
+  def _FindGapBelow(self, node, addr, level, size, strict, test_blank):
+    """Descend from node (which is addr/level) to the lowest-addressed
+    free block that can hold a /size. Returns (addr, len) or None."""
+    if self.root._dirty:
+      self._Summarise(self.root)
+    if node._dirty:
+      self._Summarise(node, level)
+    if node._free is None or level + node._free > size:
       if self.debug >= 2:
-        print "Tree.FindGap examines node (%s)." % \
-          (self.PathToDotQuad(current.GetPath(), current.GetLevel()))
-      if previous == current.GetParent() or (previous == self.root 
-                                              and current == self.root):
-        if current.used:
-          if self.debug >= 3:
-            print "Tree.FindGap finds current node used; ergo go to previous."
-          next_node = previous
-        elif current.GetLevel() == size and start_from == None:
-          if self.debug >= 3:
-            print "Tree.FindGap finds current level at size limit; ergo go up."
-          next_node = current.GetParent()
-        else:
-          if self.debug >= 3:
-            print "Tree.FindGap goes left from parent..."
-          if current.GetLeft() == None and test_blank == False:
-            binstr = current.GetPath() + "0"
-            if self.debug >= 3:
-              print "...and finds a blank."
-            if strict:
-              return self.PathToDotQuad(binstr, size)
-            else:
-              return self.PathToDotQuad(binstr, depth)
-          elif current.GetLevel() == size and start_from != self.root:
-            next_node = current.GetParent()
-          elif current.GetLeft() == None and test_blank == True:
-            if self.debug >= 3:
-              print "Tree.FindGap has a left of None and test_blank of True."
-            return None
-          else:
-            if self.debug >= 3:
-              print "Tree.FindGap just goes left."
-            next_node = current.GetLeft()
-      elif previous == current.GetLeft():
-        if self.debug >= 3:
-          print "Tree.FindGap came from my left child; ergo go right."
-        if current.used:
-          if self.debug >= 3:
-            print "Tree.FindGap finds current node used; ergo go to previous."
-          next_node = previous
-        elif current.GetLevel() == size:
-          if self.debug >= 3:
-            print "Tree.FindGap finds current level at size limit; ergo go up."
-          next_node = previous
-        else:
-          if self.debug >= 3:
-            print "Tree.FindGap goes right from left child..."
-          if current.GetRight() == None and test_blank == False:
-            binstr = current.GetPath() + "1"
-            if self.debug >= 3:
-              print "...and finds a blank."
-            if strict:
-              return self.PathToDotQuad(binstr, size)
-            else:
-              return self.PathToDotQuad(binstr, depth)
-          elif current.GetRight() == None and test_blank == True:
-            return None
-          else:
-            next_node = current.GetRight()
-      elif previous == current.GetRight():
-        if self.debug >= 3:
-          print "Tree.FindGap came from my right child; ergo go to parent."
-        # I can't go above where I started if I'm in FindGapFrom mode.
-        if start_from == None:
-          next_node = current.GetParent()
-        elif start_from != None:
-          if current.GetParent().GetLevel() < start_from.GetLevel():
-            return None
-          else:
-            next_node = current.GetParent()
-      previous = current
-      current = next_node
-      if current != None and previous != None:
-        if current.used and previous.used:
-          if self.debug >= 2:
-            print "Tree.FindGap returns a None because of special used case."
-          return None
+        print "Tree.FindGap finds no free /%s below level %s." % (size, level)
+      return None
+    present = True
+    while node._free != 0:
+      # The summary promises a big enough block below us, so level < size.
+      # Prefer the left child; a missing child is entirely free.
+      child = node.left
+      if child is None:
+        level += 1
+        present = False
+        break
+      if child._free is not None and level + 1 + child._free <= size:
+        node = child
+        level += 1
+        continue
+      addr |= 1 << (self.width - 1 - level)
+      child = node.right
+      level += 1
+      if child is None:
+        present = False
+        break
+      node = child
     if self.debug >= 2:
-      print "Tree.FindGap returns a None because of invariant violation."
-    return None
+      print "Tree.FindGap finds free block %s." % self.IntToRoute(addr, level)
+    if test_blank and not present:
+      return None
+    if strict:
+      return (addr, size)
+    return (addr, level)
+
+  def _Summarise(self, node, level = 0):
+    """Recompute the free-space summary and used-address count of a dirty
+    node at depth level, first doing the same for any dirty nodes beneath
+    it. Its hashes are only marked out of date; see _Hash."""
+    left = node.left
+    right = node.right
+    if left is not None and left._dirty:
+      self._Summarise(left, level + 1)
+    if right is not None and right._dirty:
+      self._Summarise(right, level + 1)
+    if node._used:
+      free = None
+      count = 1 << (self.width - level)
+    elif left is None and right is None:
+      free = 0
+      count = 0
+    else:
+      if left is None:
+        left_free = 1
+        count = 0
+      else:
+        count = left._count
+        left_free = left._free
+        if left_free is not None:
+          left_free += 1
+      if right is None:
+        right_free = 1
+      else:
+        count += right._count
+        right_free = right._free
+        if right_free is not None:
+          right_free += 1
+      if left_free == 1 and right_free == 1:
+        free = 0
+      elif left_free is None:
+        free = right_free
+      elif right_free is None or left_free < right_free:
+        free = left_free
+      else:
+        free = right_free
+    node._free = free
+    node._count = count
+    node._hash = None
+    node._dirty = False
+
+  def _Hash(self, node):
+    """Recompute the hashes of a node that _Summarise has marked out of
+    date, first doing the same for any such nodes beneath it.
+
+    A node's _set_hash is _ALL_ADDRESSES if all of its addresses are in
+    use, _NO_ADDRESSES if none are, and otherwise the digest of its
+    children's, so that any two subtrees covering the same addresses have
+    the same one. Its _hash is the digest of whether it is used, its
+    children's and, if used, its data. Both are SHA-1, so subtrees with
+    equal hashes can be taken to be equal."""
+    sha1 = hashlib.sha1
+    left = node.left
+    right = node.right
+    if left is None:
+      left_hash = left_set_hash = _NO_ADDRESSES
+    else:
+      if left._hash is None:
+        self._Hash(left)
+      left_hash = left._hash
+      left_set_hash = left._set_hash
+    if right is None:
+      right_hash = right_set_hash = _NO_ADDRESSES
+    else:
+      if right._hash is None:
+        self._Hash(right)
+      right_hash = right._hash
+      right_set_hash = right._set_hash
+    if node._used:
+      node._set_hash = _ALL_ADDRESSES
+      node._hash = sha1("U" + left_hash + right_hash +
+                        _EncodeData(node.data)).digest()
+    elif left_set_hash != _NO_ADDRESSES or right_set_hash != _NO_ADDRESSES:
+      if left_set_hash == right_set_hash == _ALL_ADDRESSES:
+        node._set_hash = _ALL_ADDRESSES
+      else:
+        node._set_hash = sha1(left_set_hash + right_set_hash).digest()
+      node._hash = sha1("N" + left_hash + right_hash).digest()
+    else:
+      node._set_hash = _NO_ADDRESSES
+      node._hash = _NO_ADDRESSES
+
+  def _UpdateHashes(self):
+    """Bring the hashes of every node up to date; see _Hash."""
+    root = self.root
+    if root._dirty:
+      self._Summarise(root)
+    if root._hash is None:
+      self._Hash(root)
+
+  def _HashesWanted(self):
+    """Called for each comparison of this tree with another (==, Diff and
+    the like), before it starts: bring our hashes up to date if we have
+    already been compared _WALKS_BEFORE_HASHING times. Hashing a whole
+    tree costs about as much as walking it that many times, so a tree
+    compared only a few times, such as one of a fleet of ACLs checked
+    against a template, is just walked, and one compared again and again
+    never pays much more than twice what hashing it from the start would
+    have cost. After that, each change re-hashes only its own path.
+    That path is re-hashed when the tree is next compared, not by Insert
+    and Remove themselves: re-hashing it on every change would more than
+    double what they cost, for trees that may never be compared at all.
+
+    Comparisons use the hashes of a node only if it is not dirty and they
+    are not out of date. Either way, the result is the same."""
+    if self._Hashing():
+      self._UpdateHashes()
+    else:
+      self._comparisons += 1
+
+  def _Hashing(self):
+    """Whether our hashes are up to date, or kept so for comparisons; if
+    not, comparisons don't look at them, which saves time on every
+    node."""
+    root = self.root
+    return (self._comparisons >= _WALKS_BEFORE_HASHING or
+            (not root._dirty and root._hash is not None))
 
   def FindGapGenerator(self, size):
-    yield self.FindGap(size)
+    """Generator for every free prefix of prefixlen size, in address
+    order; see FindGaps."""
+    for gap in self.FindGaps(size):
+      yield gap
+
+  def FindGaps(self, size, count = None, mark_used = False,
+               supplied_data = "FindGaps"):
+    """Generator for successive free prefixes of prefixlen size, lowest
+    address first, as strings. The tree is walked once, however many
+    we take, rather than once per gap as with repeated FindGap calls.
+
+    Args:
+      count: stop after this many gaps (default: carry on until the
+        tree is full).
+      mark_used: Insert each gap, with supplied_data, before yielding
+        it, so the caller gets an allocation rather than a candidate.
+
+    Without mark_used the caller may Insert each gap itself as it is
+    yielded; nothing else should change the tree mid-iteration."""
+    for addr, netlen in self.FindGapsInt(size, count = count,
+                                         mark_used = mark_used,
+                                         supplied_data = supplied_data):
+      yield self.IntToRoute(addr, netlen)
+
+  def FindGapsInt(self, size, count = None, mark_used = False,
+                  supplied_data = "FindGaps"):
+    """As FindGaps, but yield (integer address, prefix length) tuples."""
+    return self._IterateGapsBelow(self.root, 0, 0, size, count, mark_used,
+                                  supplied_data)
+
+  def FindGapsFrom(self, prefix, size, count = None, mark_used = False,
+                   supplied_data = "FindGaps"):
+    """As FindGaps, but only for gaps underneath prefix. As with
+    FindGapFrom, there are none if prefix is not present in the tree or
+    is (or is covered by) a used node."""
+    for addr, netlen in self.FindGapsFromInt(prefix, size, count = count,
+                                             mark_used = mark_used,
+                                             supplied_data = supplied_data):
+      yield self.IntToRoute(addr, netlen)
+
+  def FindGapsFromInt(self, prefix, size, count = None, mark_used = False,
+                      supplied_data = "FindGaps"):
+    """As FindGapsFrom, but yield (integer address, prefix length)
+    tuples."""
+    addr, netlen = self.RouteToInt(prefix)
+    result = self.LookupInt(addr, netlen, used_check = True)
+    if result is None or result.used:
+      return iter(())
+    return self._IterateGapsBelow(result, addr & _Mask(netlen, self.width),
+                                  netlen, size, count, mark_used,
+                                  supplied_data)
+
+  def _IterateGapsBelow(self, node, addr, level, size, count, mark_used,
+                        supplied_data):
+    """The engine behind FindGaps: a depth-first walk from node (which is
+    addr/level) that skips every subtree whose summary says it cannot
+    hold a /size, and carves each free block it does find into /sizes."""
+    if self.root._dirty:
+      self._Summarise(self.root)
+    if node._dirty:
+      self._Summarise(node, level)
+    width = self.width
+    found = 0
+    if count is not None and count <= 0:
+      return
+    # The stack holds (node, addr, level); a node of None stands for a
+    # missing, hence entirely free, child.
+    stack = [(node, addr, level)]
+    while stack:
+      node, addr, level = stack.pop()
+      if node is not None:
+        if node._free is None or level + node._free > size:
+          continue
+        if node._free != 0:
+          bit = 1 << (width - 1 - level)
+          stack.append((node.right, addr | bit, level + 1))
+          stack.append((node.left, addr, level + 1))
+          continue
+      # addr/level is entirely free; hand it out a /size at a time. (Not
+      # with xrange, which cannot count in IPv6-sized integers.)
+      step = 1 << (width - size)
+      gap = addr
+      end = addr + (1 << (width - level))
+      while gap < end:
+        if mark_used:
+          self.InsertInt(gap, size, supplied_data, test_dup = False)
+        yield (gap, size)
+        found += 1
+        if found == count:
+          return
+        gap += step
+
+  def Allocator(self, pool = None, policy = None):
+    """Return a PrefixAllocator handing out prefixes from pool (by
+    default, the whole address space) of this tree; see PrefixAllocator
+    for policy. For allocating and releasing many small prefixes, that
+    is cheaper than repeated FindGapFrom and Insert."""
+    return PrefixAllocator(self, pool, policy)
 
   def FindGapFrom(self, prefix, size, strict = True, do_test_none = False):
-    """Find a gap underneath a particular prefix. 
-    First we look up the path to the prefix. If it does not exist, we insert it,
-    on the basis that we might be the IANA.
-    If we assume we are starting with an empty tree, we can safely 
-    build un-used nodes on the way to the prefix.
-    TODO(niallm): Fix those docs."""
-    result = self.Lookup(prefix)
-    if result == False:
+    """Find a gap underneath a particular prefix, which must already be
+    present in the tree. If it is not, or it (or anything covering it)
+    is marked used, there is no gap and we return None."""
+    addr, netlen = self.RouteToInt(prefix)
+    result = self.LookupInt(addr, netlen, used_check = True)
+    if result is None or result.used:
       if self.debug >= 2:
-        print "Tree.FindGapFrom did not find [%s] via lookup; inserting" % prefix
-      result = self.insert(prefix, 'FindGapFrom', mark_used = False, 
-                           test_used = True, test_none = True)
-      if result == False or result == None:
-        return None
-    else:
-      pass # here for debugging
-    if result == None:
+        print "Tree.FindGapFrom finds [%s] absent or used" % prefix
       return None
-    else:
-      return self.FindGap(size, strict = True, start_from = result)
+    gap = self._FindGapBelow(result, addr & _Mask(netlen, self.width), netlen,
+                             size, strict, False)
+    if gap is None:
+      return None
+    return self.IntToRoute(gap[0], gap[1])
 
   def GetRoot(self):
     return self.root
 
   def SetRoot(self, new_root):
     self.root = new_root
+    new_root._MarkDirty()
+
+  def _OwnRoot(self):
+    """Return the root, first replacing it with a copy of our own if it
+    is shared with a snapshot."""
+    if self.root._owner is not self._owner:
+      self.root = self.root._Copy(self._owner)
+    return self.root
+
+  def RouteToInt(self, route):
+    """Given a route in CIDR format (or as address/netmask, or a bare
+    address, which is taken to be a host route) return the tuple
+    (integer address, prefix length). Raises ValueError for a route of
+    the wrong address family."""
+    return _RouteToInt(route, self.width)
+
+  def IntToRoute(self, addr, netlen):
+    """The reverse of RouteToInt: format an (integer address, prefix
+    length) pair the way PathToDotQuad does. Host bits are masked off."""
+    return _IntToRoute(addr, netlen, self.width)
 
   def PathToDotQuad(self, binstr, depth):
     """Given a binary string and a 'depth' (netmask), return the
-    dotted quad for it."""
+    dotted quad (or, in an IPv6 tree, the compressed IPv6 notation)
+    for it."""
     q = len(binstr)
-    for count in range(q, 32):
+    for count in range(q, self.width):
       binstr += "0"
-    iphex = hex(int(binstr,2))
-    complete_addr = iphex + "/" + str(depth)
-    return IPy.IP(complete_addr).strNormal(1)
+    return self.IntToRoute(int(binstr, 2), depth)
 
-  def GenerateForPrefix(self, count, variance = 0):
+  def GenerateForPrefix(self, count, variance = 0, seed = None):
     """Generate a list of all possible prefixes at depth 'count'.
     For example, 8 provides 0.0.0.0/8, 1.0.0.0/8, 2.0.0.0/8 ... and so on.
     If 'variance' is set to a number, then (randomly) some subset of
-    the routes returned will be aggregated or deaggregated to 'variance'
-    prefixlengths away. For example, a variance of 1 with a count of
-    8 might provide 0.0.0.0/7, 2.0.0.0/9, 2.128.0.0/9, ... and so on."""
-    total_span = 2 ** 32
-    divisor = 2 ** count
-    for x in range(0,total_span,total_span/divisor):
-      if variance == 0:
-        complete_addr = hex(x)  + "/" + str(count)
-        yield IPy.IP(complete_addr).strNormal(1)
-      else:
-        # (De)aggregation should happen to roughly half the routes.
-        if random.randint(0,1) == 0:
-          # Should I aggregate or deaggregate?
-          aggregation_condition == False
-          if random.randint(0,1) == 0 and aggregation_condition:
-            # If I aggregate, I produce a route which is the supernet
-            # of this and the next, and advance the counter past the
-            # space covered. Note - cannot do this safely on the right_half
-            # of a route.
-            complete_addr = hex(x) + "/" + str(count + 1)
-            yield IPy.IP(complete_addr).strNormal(1)
-            x += total_span/divisor
-          else:
-            # If I deaggregate, I produce the two relevant subroutes
-            # and yield them twice.
-            half_step = 0
-            half_step = x + (total_span/divisor)/2
-            complete_addr = hex(x) + "/" + str(count - 1)
-            yield IPy.IP(complete_addr).strNormal(1)
-            complete_addr = hex(x + half_step) + "/" + str(count - 1)
-            yield IPy.IP(complete_addr).strNormal(1)
-        else: # Route is untouched
-          complete_addr = hex(x) + "/" + str(count)
-          yield IPy.IP(complete_addr).strNormal(1)
+    the routes returned will be aggregated or deaggregated to up to
+    'variance' prefixlengths away. For example, a variance of 1 with a
+    count of 8 might provide 0.0.0.0/7, 2.0.0.0/9, 2.128.0.0/9, ... and so
+    on. Either way the prefixes come in address order, do not overlap and
+    between them cover the whole address space, so they can be fed
+    straight to BulkInsert. 'seed' makes the variance repeatable."""
+    int_to_route = self.IntToRoute
+    for addr, netlen in self.GenerateForPrefixInt(count, variance, seed):
+      yield int_to_route(addr, netlen)
+
+  def GenerateForPrefixInt(self, count, variance = 0, seed = None):
+    """As GenerateForPrefix, but yield (integer address, prefix length)
+    pairs. Without variance, and for IPv4, the pairs are made entirely by
+    xrange and itertools, so no Python code runs per prefix."""
+    width = self.width
+    total_span = 1 << width
+    step = 1 << (width - count)
+    if variance == 0:
+      if total_span <= sys.maxint:
+        return itertools.izip(xrange(0, total_span, step),
+                              itertools.repeat(count))
+      # xrange cannot count that high.
+      return ((addr, count) for addr in self._Count(0, total_span, step))
+    return self._GenerateWithVariance(count, variance, random.Random(seed))
 
+  def _Count(self, start, stop, step):
+    """xrange, for numbers too big for xrange."""
+    while start < stop:
+      yield start
+      start += step
+
+  def _GenerateWithVariance(self, count, variance, rng):
+    """The variance half of GenerateForPrefixInt. Roughly half the routes
+    are left alone; the rest are, with equal chance, aggregated (as far
+    as the address allows: only an aligned route can start a supernet)
+    or split, by between 1 and variance prefixlengths."""
+    width = self.width
+    total_span = 1 << width
+    addr = 0
+    while addr < total_span:
+      netlen = count
+      if rng.randint(0, 1) == 0:
+        distance = rng.randint(1, variance)
+        if rng.randint(0, 1) == 0:
+          # Aggregate, by as much of distance as this address is aligned
+          # for.
+          while distance and netlen > 0 and not (
+              addr & ((1 << (width - netlen + 1)) - 1)):
+            netlen -= 1
+            distance -= 1
+        else:
+          # Deaggregate, yielding all the subroutes of this one.
+          sub_netlen = min(count + distance, width)
+          sub_step = 1 << (width - sub_netlen)
+          stop = addr + (1 << (width - count))
+          while addr < stop:
+            yield (addr, sub_netlen)
+            addr += sub_step
+          continue
+      yield (addr, netlen)
+      addr += 1 << (width - netlen)
+
+  def GenerateForPrefixArrays(self, count, variance = 0, seed = None):
+    """As GenerateForPrefixInt, but return the prefixes as two NumPy
+    arrays: addresses (uint32) and prefix lengths (uint8). IPv4 only, and
+    numpy is required. Without variance the arrays are built by NumPy
+    itself, so all 16M /24s take well under a second."""
+    if numpy is None:
+      raise ImportError("GenerateForPrefixArrays needs numpy")
+    if self.width != 32:
+      raise ValueError("GenerateForPrefixArrays supports IPv4 trees only")
+    if variance == 0:
+      addresses = numpy.arange(1 << count, dtype = numpy.uint64)
+      addresses <<= 32 - count
+      netlens = numpy.empty(1 << count, dtype = numpy.uint8)
+      netlens.fill(count)
+      return addresses.astype(numpy.uint32), netlens
+    addresses = array.array(_SAVE_INT)
+    netlens = array.array('B')
+    for addr, netlen in self._GenerateWithVariance(count, variance,
+                                                   random.Random(seed)):
+      addresses.append(addr)
+      netlens.append(netlen)
+    return (numpy.frombuffer(addresses, dtype = numpy.uint32).copy(),
+            numpy.frombuffer(netlens, dtype = numpy.uint8).copy())
 
   def SubtractCantUse(self, do_forbidden = True, do_reserved = True):
     """Subtract RFC 1918 spaces and other structurally unusable spaces from the
@@ -604,26 +1629,1045 @@ class Tree:
     reserved and impossible."""
     return self.total_unusable_prefixes
 
+  def Save(self, path):
+    """Write the tree to the file path, in a compact binary form that Load
+    can read back, or MappedTree can search where it lies.
+
+    After a short header come three columns, with one entry per node in
+    preorder (a node, then everything to its left, then everything to its
+    right): a flags byte (used, has a left child, has a right child); a
+    4-byte index into the data table; and the 4-byte position of the
+    right child, since the left child, if any, always comes next. The
+    data table follows, pickled, with each distinct piece of data stored
+    once. Nothing else is stored: a node's prefix follows from its
+    position, and free-space summaries are rebuilt when needed."""
+    flags = array.array('B')
+    data_index = array.array(_SAVE_INT)
+    right = array.array(_SAVE_INT)
+    table = []
+    seen = {}
+    # The stack holds nodes, and the positions of right children to be
+    # filled in once we get to them.
+    stack = [self.root]
+    while stack:
+      node = stack.pop()
+      if not isinstance(node, _NodeBase):
+        right[node] = len(flags)
+        continue
+      position = len(flags)
+      node_flags = 0
+      if node._used:
+        node_flags |= _SAVED_USED
+      # The type is part of the key so that, say, 1 and True stay apart.
+      key = (node.data.__class__, node.data)
+      try:
+        index = seen.get(key)
+      except TypeError:
+        # Unhashable data can't be shared; it is stored once per node.
+        key = None
+        index = None
+      if index is None:
+        index = len(table)
+        table.append(node.data)
+        if key is not None:
+          seen[key] = index
+      flags.append(node_flags)
+      data_index.append(index)
+      right.append(0)
+      if node.right is not None:
+        flags[position] |= _SAVED_RIGHT
+        stack.append(node.right)
+        stack.append(position)
+      if node.left is not None:
+        flags[position] |= _SAVED_LEFT
+        stack.append(node.left)
+    if sys.byteorder != 'little':
+      data_index.byteswap()
+      right.byteswap()
+    output = open(path, 'wb')
+    try:
+      output.write(_SAVE_HEADER.pack(_SAVE_MAGIC, self.address_family,
+                                     len(flags)))
+      output.write(flags.tostring())
+      output.write(data_index.tostring())
+      output.write(right.tostring())
+      cPickle.dump(table, output, 2)
+    finally:
+      output.close()
+
+  @classmethod
+  def Load(cls, path, supplied_debug = 0, node_class = None):
+    """Read a tree written by Save. Only load files you trust: the data
+    table is a pickle. See MappedTree for searching a saved tree without
+    loading it."""
+    saved = open(path, 'rb')
+    try:
+      contents = saved.read()
+    finally:
+      saved.close()
+    address_family, count, flags_at, data_at, right_at, table_at = (
+      _SavedLayout(contents, path))
+    flags = array.array('B', contents[flags_at:data_at])
+    data_index = array.array(_SAVE_INT, contents[data_at:right_at])
+    right = array.array(_SAVE_INT, contents[right_at:table_at])
+    if sys.byteorder != 'little':
+      data_index.byteswap()
+      right.byteswap()
+    table = cPickle.loads(contents[table_at:])
+    new_tree = cls(supplied_debug = supplied_debug, node_class = node_class,
+                   address_family = address_family)
+    node_class = new_tree.node_class
+    owner = new_tree._owner
+    root = new_tree.root
+    root.data = table[data_index[0]]
+    root._used = bool(flags[0] & _SAVED_USED)
+    # Every node is created by its parent, so is waiting here by the time
+    # the loop reaches it. As in BulkInsertInt, the collector would only
+    # slow us down.
+    nodes = [None] * count
+    nodes[0] = root
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+      for position in xrange(count):
+        node = nodes[position]
+        node_flags = flags[position]
+        level = node.level
+        if level is None:
+          level = 0
+        if node_flags & _SAVED_LEFT:
+          child_flags = flags[position + 1]
+          child = node_class(node, None, None,
+                             table[data_index[position + 1]],
+                             bool(child_flags & _SAVED_USED))
+          child.level = level + 1
+          child._owner = owner
+          node.left = child
+          nodes[position + 1] = child
+        if node_flags & _SAVED_RIGHT:
+          child_position = right[position]
+          child_flags = flags[child_position]
+          child = node_class(node, None, None,
+                             table[data_index[child_position]],
+                             bool(child_flags & _SAVED_USED))
+          child.level = level + 1
+          child._owner = owner
+          node.right = child
+          nodes[child_position] = child
+        nodes[position] = None
+    finally:
+      if gc_was_enabled:
+        gc.enable()
+    return new_tree
+
+  def Snapshot(self):
+    """Return a copy of the tree, in constant time.
+
+    The copy shares every node with this tree. From then on each tree
+    copies a node before changing it, along with the path from the root
+    down to it, so an Insert into either costs at most one extra node per
+    level, and the other tree never sees the change. Nodes returned by
+    Lookup and friends may be shared, so change them through the tree's
+    own methods (Insert and so on): changing a shared node directly
+    (SetData, used and the like) raises ValueError."""
+    snapshot = Tree(supplied_debug = self.debug, node_class = self.node_class,
+                    address_family = self.address_family)
+    snapshot.root = self.root
+    snapshot.total_unusable_prefixes = self.total_unusable_prefixes
+    # Fresh owners all round, so neither tree may change any existing
+    # node in place.
+    if self._owner is not None:
+      self._owner.shared = True
+    self._owner = _Owner()
+    snapshot._owner = _Owner()
+    return snapshot
+
+  def Diff(self, other):
+    """Generator for how this tree differs from other (an earlier
+    snapshot of it, say): yields (prefix, change), in address order,
+    where change is 'added' if prefix is used here but not in other,
+    'removed' if the reverse, or 'changed' if it is used in both but its
+    data differs. Unlike the set operations, this is about prefixes, not
+    addresses: a /23 and its two /24s are all different."""
+    int_to_route = self.IntToRoute
+    for addr, netlen, change in self.DiffInt(other):
+      yield (int_to_route(addr, netlen), change)
+
+  def DiffInt(self, other):
+    """As Diff, but yield (integer address, prefix length, change) triples.
+
+    The two trees are walked side by side, and any subtree they share
+    (after a Snapshot) or that is the same in both (by its hash; see the
+    module docstring) is skipped unvisited. So comparing two trees costs
+    time in proportion to how much they differ, not to their size."""
+    if self.width != other.width:
+      raise ValueError("Cannot compare IPv%d and IPv%d trees" %
+                       (self.address_family, other.address_family))
+    self._HashesWanted()
+    other._HashesWanted()
+    use_hashes = self._Hashing() and other._Hashing()
+    top = self.width - 1
+    stack = [(self.root, other.root, 0, 0)]
+    while stack:
+      a, b, addr, level = stack.pop()
+      if a is b:
+        continue
+      if use_hashes:
+        if a is None:
+          a_hash = _NO_ADDRESSES
+        elif a._dirty:
+          a_hash = None
+        else:
+          a_hash = a._hash
+        if b is None:
+          b_hash = _NO_ADDRESSES
+        elif b._dirty:
+          b_hash = None
+        else:
+          b_hash = b._hash
+        if a_hash is not None and a_hash == b_hash:
+          continue
+      a_used = a is not None and a._used
+      b_used = b is not None and b._used
+      if a_used and not b_used:
+        yield (addr, level, 'added')
+      elif b_used and not a_used:
+        yield (addr, level, 'removed')
+      elif a_used and a.data != b.data:
+        yield (addr, level, 'changed')
+      if a is None:
+        a_left = a_right = None
+      else:
+        a_left, a_right = a.left, a.right
+      if b is None:
+        b_left = b_right = None
+      else:
+        b_left, b_right = b.left, b.right
+      # Host routes have no children to push, nor room for the shift.
+      if a_right is not b_right:
+        stack.append((a_right, b_right, addr | (1 << (top - level)),
+                      level + 1))
+      if a_left is not b_left:
+        stack.append((a_left, b_left, addr, level + 1))
+
+  def Union(self, other, supplied_data = "Union"):
+    """Return a new tree covering every address that either this tree or
+    other covers. As for the other set operations, a used node stands
+    for all the addresses beneath it, the result has supplied_data on
+    each of its prefixes, and adjacent prefixes are merged into their
+    supernet (as with propagate_used)."""
+    return self._TreeFromLockstep(other, _UNION, supplied_data)
+
+  def Intersection(self, other, supplied_data = "Intersection"):
+    """Return a new tree covering the addresses covered by both this tree
+    and other."""
+    return self._TreeFromLockstep(other, _INTERSECTION, supplied_data)
+
+  def Difference(self, other, supplied_data = "Difference"):
+    """Return a new tree covering the addresses this tree covers but
+    other does not."""
+    self._HashesWanted()
+    other._HashesWanted()
+    return self._TreeFromLockstep(other, _DIFFERENCE, supplied_data)
+
+  def IsSubset(self, other):
+    """Is every address this tree covers also covered by other? Stops at
+    the first counterexample."""
+    self._HashesWanted()
+    other._HashesWanted()
+    for prefix in self._IterateLockstep(other, _DIFFERENCE):
+      return False
+    return True
+
+  def _TreeFromLockstep(self, other, rules, supplied_data):
+    """Build a tree, like this one, from what _IterateLockstep yields."""
+    result = Tree(supplied_debug = self.debug, node_class = self.node_class,
+                  address_family = self.address_family)
+    # Not test_dup, which would refuse to mark the root (0.0.0.0/0) used.
+    result.BulkInsertInt(self._IterateLockstep(other, rules), supplied_data,
+                         test_dup = False, propagate_used = True)
+    return result
+
+  def _IterateLockstep(self, other, rules):
+    """Walk this tree and other side by side, and yield, in address
+    order, the (integer address, prefix length) of each block that rules
+    (see _UNION) puts in the result. Subtrees that rules can settle
+    without looking further, e.g. anything under a used node when taking
+    a union, are not walked."""
+    if self.width != other.width:
+      raise ValueError("Cannot combine IPv%d and IPv%d trees" %
+                       (self.address_family, other.address_family))
+    width = self.width
+    # Subtrees covering the same addresses (shared ones, and those with
+    # the same _set_hash, where that is up to date; see the module
+    # docstring) can't be part of a difference.
+    skip_same = rules in (_DIFFERENCE, _SYMMETRIC_DIFFERENCE)
+    use_hashes = skip_same and self._Hashing() and other._Hashing()
+    # Each entry is (node in self, node in other, addr, level); a node is
+    # None where there is nothing, or _COVERED beneath a used node.
+    stack = [(self.root, other.root, 0, 0)]
+    while stack:
+      a, b, addr, level = stack.pop()
+      if skip_same and a is b:
+        continue
+      if use_hashes:
+        a_hash = _SetHash(a)
+        if a_hash is not None and a_hash == _SetHash(b):
+          continue
+      if a is None:
+        a_state = _NONE_USED
+      elif a is _COVERED or a._used:
+        a_state = _ALL_USED
+      else:
+        a_state = _SOME_USED
+      if b is None:
+        b_state = _NONE_USED
+      elif b is _COVERED or b._used:
+        b_state = _ALL_USED
+      else:
+        b_state = _SOME_USED
+      action = rules[a_state * 3 + b_state]
+      if action == 'S':
+        continue
+      if action == 'E':
+        yield (addr, level)
+        continue
+      if a_state == _SOME_USED:
+        a_left, a_right = a.left, a.right
+      elif a_state == _ALL_USED:
+        a_left = a_right = _COVERED
+      else:
+        a_left = a_right = None
+      if b_state == _SOME_USED:
+        b_left, b_right = b.left, b.right
+      elif b_state == _ALL_USED:
+        b_left = b_right = _COVERED
+      else:
+        b_left = b_right = None
+      level += 1
+      stack.append((a_right, b_right, addr | (1 << (width - level)), level))
+      stack.append((a_left, b_left, addr, level))
+
+  def __or__(self, other):
+    return self.Union(other)
+
+  def __and__(self, other):
+    return self.Intersection(other)
+
+  def __sub__(self, other):
+    return self.Difference(other)
+
   def __lt__(self, other):
-    pass
-  
+    return self.IsSubset(other) and not self == other
+
   def __le__(self, other):
-    pass
-  
+    return self.IsSubset(other)
+
   def __eq__(self, other):
-    original_set = set()
-    other_set = set()
-    for node in self.IterateNodes(None, top_used=True):
-      original_set.add(node)
-    for node in other.IterateNodes(None, top_used=True):
-      other_set.add(node)
-    return original_set == other_set
-  
+    """Trees are equal if they cover the same addresses, however those
+    are broken up into prefixes. That is what the roots' _set_hash sums
+    up (see the module docstring), so once both trees' hashes are up to
+    date this is a single comparison; until then, the trees are walked
+    side by side, skipping what they share."""
+    if not isinstance(other, Tree):
+      return NotImplemented
+    if self.width != other.width:
+      return False
+    self._HashesWanted()
+    other._HashesWanted()
+    root = self.root
+    other_root = other.root
+    if (not root._dirty and root._hash is not None and
+        not other_root._dirty and other_root._hash is not None):
+      return root._set_hash == other_root._set_hash
+    for prefix in self._IterateLockstep(other, _SYMMETRIC_DIFFERENCE):
+      return False
+    return True
+
   def __ne__(self, other):
-    pass
-  
+    result = self.__eq__(other)
+    if result is NotImplemented:
+      return result
+    return not result
+
   def __gt__(self, other):
-    pass
-  
+    return other < self
+
   def __ge__(self, other):
-    pass
+    return other.IsSubset(self)
+
+
+class PatriciaNode(object):
+  """A node of a PatriciaTree. Unlike a Node, it records its own prefix,
+  since path compression means its position no longer implies it. Nodes
+  that are not used exist only to join two branches together."""
+
+  __slots__ = ('addr', 'netlen', 'left', 'right', 'data', 'used')
+
+  # The width of the addresses, in bits.
+  width = 32
+
+  def __init__(self, addr, netlen, supplied_data = None,
+               supplied_used = False):
+    self.addr = addr
+    self.netlen = netlen
+    self.left = None
+    self.right = None
+    self.data = supplied_data
+    self.used = supplied_used
+
+  def GetData(self):
+    """Return the per-node 'user data' associated with this node."""
+    return self.data
+
+  def SetData(self, supplied_data = None):
+    """Change the per-node 'user data' to the supplied anything."""
+    self.data = supplied_data
+
+  def GetLeft(self):
+    return self.left
+
+  def GetRight(self):
+    return self.right
+
+  def GetPrefix(self):
+    """Return the prefix this node stands for, in CIDR format."""
+    return _IntToRoute(self.addr, self.netlen, self.width)
+
+
+class PatriciaNode6(PatriciaNode):
+  """A PatriciaNode holding an IPv6 prefix."""
+
+  __slots__ = ()
+
+  width = 128
+
+
+class PatriciaTree(object):
+  """A path-compressed variant of Tree, for lookups over large route
+  tables.
+
+  Chains of single-child nodes are collapsed, so a lookup touches one
+  node per branching point rather than one per bit, and a table of n
+  prefixes needs fewer than 2n nodes. In exchange there is no per-bit
+  structure to hang free-space bookkeeping off, so FindGap and friends
+  stay with Tree."""
+
+  def __init__(self, supplied_debug = 0, address_family = 4):
+    """address_family is 4 or 6, as for Tree."""
+    if address_family not in _WIDTHS:
+      raise ValueError("address_family must be 4 or 6, not %s" %
+                       address_family)
+    self.root = None
+    self.debug = supplied_debug
+    self.address_family = address_family
+    self.width = _WIDTHS[address_family]
+    if address_family == 6:
+      self.node_class = PatriciaNode6
+    else:
+      self.node_class = PatriciaNode
+
+  def GetRoot(self):
+    return self.root
+
+  def RouteToInt(self, route):
+    """See Tree.RouteToInt."""
+    return _RouteToInt(route, self.width)
+
+  def IntToRoute(self, addr, netlen):
+    """See Tree.IntToRoute."""
+    return _IntToRoute(addr, netlen, self.width)
+
+  def Insert(self, route, supplied_data, test_dup = True):
+    """Insert route with supplied_data into the tree. Returns the node,
+    or False if test_dup is set and route was already present."""
+    addr, netlen = self.RouteToInt(route)
+    return self.InsertInt(addr, netlen, supplied_data, test_dup = test_dup)
+
+  def InsertInt(self, addr, netlen, supplied_data, test_dup = True):
+    """As Insert, for an integer address and prefix length."""
+    width = self.width
+    addr &= _Mask(netlen, width)
+    parent = None
+    current = self.root
+    common = 0
+    while current is not None:
+      diff = addr ^ current.addr
+      common = min(width - diff.bit_length(), netlen, current.netlen)
+      if common < current.netlen:
+        # We part company with current part-way along its prefix.
+        break
+      if current.netlen == netlen:
+        if test_dup and current.used:
+          return False
+        current.used = True
+        current.data = supplied_data
+        return current
+      parent = current
+      if (addr >> (width - 1 - current.netlen)) & 1:
+        current = current.right
+      else:
+        current = current.left
+    node = self.node_class(addr, netlen, supplied_data, True)
+    if current is None:
+      self._Attach(parent, node)
+      return node
+    if common == netlen:
+      # The new prefix covers current, so slots in above it.
+      self._Attach(node, current)
+      self._Replace(parent, current, node)
+    else:
+      # Neither covers the other; join them under a branch node.
+      branch = self.node_class(addr & _Mask(common, width), common)
+      self._Attach(branch, node)
+      self._Attach(branch, current)
+      self._Replace(parent, current, branch)
+    return node
+
+  def _Attach(self, parent, child):
+    """Hang child off the appropriate side of parent (or make it the
+    root, if parent is None)."""
+    if parent is None:
+      self.root = child
+    elif (child.addr >> (self.width - 1 - parent.netlen)) & 1:
+      parent.right = child
+    else:
+      parent.left = child
+
+  def _Replace(self, parent, old, new):
+    """Put new where old used to hang off parent."""
+    if parent is None:
+      self.root = new
+    elif parent.left is old:
+      parent.left = new
+    else:
+      parent.right = new
+
+  def Lookup(self, route):
+    """Return the node for exactly route, or None if it was never
+    inserted."""
+    addr, netlen = self.RouteToInt(route)
+    return self.LookupInt(addr, netlen)
+
+  def LookupInt(self, addr, netlen):
+    """As Lookup, for an integer address and prefix length."""
+    width = self.width
+    addr &= _Mask(netlen, width)
+    current = self.root
+    while current is not None and current.netlen <= netlen:
+      if (addr ^ current.addr) >> (width - current.netlen):
+        return None
+      if current.netlen == netlen:
+        if current.used:
+          return current
+        return None
+      if (addr >> (width - 1 - current.netlen)) & 1:
+        current = current.right
+      else:
+        current = current.left
+    return None
+
+  def LongestMatch(self, route):
+    """Return the node for the most specific prefix covering route (an
+    address or a prefix in CIDR format), or None if nothing does."""
+    addr, netlen = self.RouteToInt(route)
+    return self.LongestMatchInt(addr, netlen)
+
+  def LongestMatchInt(self, addr, netlen = None):
+    """As LongestMatch, for an integer address (and prefix length; by
+    default, that of a host route)."""
+    width = self.width
+    if netlen is None:
+      netlen = width
+    best = None
+    current = self.root
+    while current is not None and current.netlen <= netlen:
+      if (addr ^ current.addr) >> (width - current.netlen):
+        break
+      if current.used:
+        best = current
+      if current.netlen == width:
+        break
+      if (addr >> (width - 1 - current.netlen)) & 1:
+        current = current.right
+      else:
+        current = current.left
+    return best
+
+  def IterateNodes(self, return_data = False):
+    """Generator for the prefixes in the tree, in address order (a
+    prefix comes before those it covers)."""
+    stack = [self.root]
+    while stack:
+      node = stack.pop()
+      if node is None:
+        continue
+      if node.used:
+        if return_data:
+          yield (node.GetPrefix(), node.data)
+        else:
+          yield node.GetPrefix()
+      stack.append(node.right)
+      stack.append(node.left)
+
+  def CountUsedNodes(self):
+    """Count the prefixes inserted into the tree."""
+    count = 0
+    for node in self.IterateNodes():
+      count += 1
+    return count
+
+
+class MappedNode(object):
+  """A node of a MappedTree. It only records where the node is in the
+  file; everything else is read from there on demand."""
+
+  __slots__ = ('mapped_tree', 'position', 'level')
+
+  def __init__(self, mapped_tree, position, level):
+    self.mapped_tree = mapped_tree
+    self.position = position
+    self.level = level
+
+  def GetData(self):
+    """Return the per-node 'user data' associated with this node."""
+    return self.mapped_tree._Data(self.position)
+
+  def GetLevel(self):
+    return self.level
+
+  def _GetUsed(self):
+    return bool(self.mapped_tree._Flags(self.position) & _SAVED_USED)
+
+  used = property(_GetUsed)
+
+
+class MappedTree(object):
+  """A read-only tree, searched in place in a file written by Tree.Save.
+
+  The file is mapped into memory rather than read, so opening even a full
+  table costs no more than unpickling its data table, and the operating
+  system shares the pages between every process that maps the same file.
+  Lookup, LongestMatch and IterateNodes work as for Tree; for anything
+  that changes the tree, Tree.Load it instead."""
+
+  _INT = struct.Struct("<I")
+
+  def __init__(self, path, supplied_debug = 0):
+    saved = open(path, 'rb')
+    try:
+      # mmap keeps its own handle on the file.
+      self.map = mmap.mmap(saved.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+      saved.close()
+    (self.address_family, self.count, self.flags_at, self.data_at,
+     self.right_at, table_at) = _SavedLayout(self.map, path)
+    self.width = _WIDTHS[self.address_family]
+    self.table = cPickle.loads(self.map[table_at:])
+    self.debug = supplied_debug
+
+  def Close(self):
+    """Unmap the file. The tree can't be used afterwards."""
+    self.map.close()
+
+  def _Flags(self, position):
+    return ord(self.map[self.flags_at + position])
+
+  def _Right(self, position):
+    return self._INT.unpack_from(self.map, self.right_at + 4 * position)[0]
+
+  def _Data(self, position):
+    return self.table[
+      self._INT.unpack_from(self.map, self.data_at + 4 * position)[0]]
+
+  def GetRoot(self):
+    return MappedNode(self, 0, 0)
+
+  def RouteToInt(self, route):
+    """See Tree.RouteToInt."""
+    return _RouteToInt(route, self.width)
+
+  def IntToRoute(self, addr, netlen):
+    """See Tree.IntToRoute."""
+    return _IntToRoute(addr, netlen, self.width)
+
+  def Lookup(self, route, used_check = False):
+    """See Tree.Lookup."""
+    addr, netlen = self.RouteToInt(route)
+    return self.LookupInt(addr, netlen, used_check = used_check)
+
+  def LookupInt(self, addr, netlen, used_check = False):
+    """See Tree.LookupInt."""
+    the_map = self.map
+    flags_at = self.flags_at
+    position = 0
+    level = 0
+    for shift in xrange(self.width - 1, self.width - 1 - netlen, -1):
+      flags = ord(the_map[flags_at + position])
+      if used_check and flags & _SAVED_USED:
+        return MappedNode(self, position, level)
+      if (addr >> shift) & 1:
+        if not flags & _SAVED_RIGHT:
+          return None
+        position = self._Right(position)
+      else:
+        if not flags & _SAVED_LEFT:
+          return None
+        position += 1
+      level += 1
+    return MappedNode(self, position, level)
+
+  def LongestMatch(self, route):
+    """See Tree.LongestMatch."""
+    addr, netlen = self.RouteToInt(route)
+    return self.LongestMatchInt(addr, netlen)
+
+  def LongestMatchInt(self, addr, netlen = None):
+    """See Tree.LongestMatchInt."""
+    if netlen is None:
+      netlen = self.width
+    the_map = self.map
+    flags_at = self.flags_at
+    best = None
+    position = 0
+    level = 0
+    for shift in xrange(self.width - 1, self.width - 1 - netlen, -1):
+      flags = ord(the_map[flags_at + position])
+      if flags & _SAVED_USED:
+        best = (position, level)
+      if (addr >> shift) & 1:
+        if not flags & _SAVED_RIGHT:
+          break
+        position = self._Right(position)
+      else:
+        if not flags & _SAVED_LEFT:
+          break
+        position += 1
+      level += 1
+    else:
+      if ord(the_map[flags_at + position]) & _SAVED_USED:
+        best = (position, level)
+    if best is None:
+      return None
+    return MappedNode(self, best[0], best[1])
+
+  def IterateNodes(self, return_data = False, top_used = False):
+    """See Tree.IterateNodes (though always from the root)."""
+    int_to_route = self.IntToRoute
+    if return_data:
+      for addr, netlen, data in self.IterateNodesInt(True, top_used):
+        yield (int_to_route(addr, netlen), data)
+    else:
+      for addr, netlen in self.IterateNodesInt(False, top_used):
+        yield int_to_route(addr, netlen)
+
+  def IterateNodesInt(self, return_data = False, top_used = False):
+    """See Tree.IterateNodesInt (though always from the root)."""
+    the_map = self.map
+    flags_at = self.flags_at
+    top = self.width - 1
+    stack = [(0, 0, 0)]
+    while stack:
+      position, addr, level = stack.pop()
+      flags = ord(the_map[flags_at + position])
+      if flags & _SAVED_USED:
+        if return_data:
+          yield (addr, level, self._Data(position))
+        else:
+          yield (addr, level)
+        if top_used:
+          continue
+      if flags & _SAVED_RIGHT:
+        stack.append((self._Right(position), addr | (1 << (top - level)),
+                      level + 1))
+      if flags & _SAVED_LEFT:
+        stack.append((position + 1, addr, level + 1))
+
+  def CountUsedNodes(self):
+    """Count the nodes marked used, straight from the flags column."""
+    flags = self.map[self.flags_at:self.data_at]
+    count = 0
+    for value in xrange(256):
+      if value & _SAVED_USED:
+        count += flags.count(chr(value))
+    return count
+
+
+class IntervalTable(object):
+  """A tree flattened, for classifying addresses in bulk, into a sorted
+  table of the disjoint address ranges its prefixes carve out, each
+  labelled with the most specific used prefix covering it (if any). A
+  whole NumPy array of addresses is then classified with one
+  searchsorted, rather than a LongestMatch per address from Python.
+
+  The table is a copy: changes to the tree after it is built are not
+  seen. IPv4 trees (Tree or MappedTree) only, and NumPy is required.
+
+  Prefixes are numbered in the order IterateNodesInt yields them, and
+  self.prefixes holds the (integer address, prefix length, data) of each
+  by number."""
+
+  def __init__(self, supplied_tree):
+    if numpy is None:
+      raise ImportError("IntervalTable needs numpy")
+    if supplied_tree.width != 32:
+      raise ValueError("IntervalTable supports IPv4 trees only")
+    self.prefixes = list(supplied_tree.IterateNodesInt(return_data = True))
+    starts = [0]
+    labels = [-1]
+    # The prefixes still open at this point in the walk, innermost last,
+    # as (first address beyond it, its number).
+    open_prefixes = []
+
+    def Start(addr, label):
+      if starts[-1] == addr:
+        labels[-1] = label
+      elif labels[-1] != label:
+        starts.append(addr)
+        labels.append(label)
+
+    def CloseUpTo(addr):
+      while open_prefixes and open_prefixes[-1][0] <= addr:
+        end = open_prefixes.pop()[0]
+        if end < 1 << 32:
+          if open_prefixes:
+            Start(end, open_prefixes[-1][1])
+          else:
+            Start(end, -1)
+
+    for label, (addr, netlen, data) in enumerate(self.prefixes):
+      CloseUpTo(addr)
+      Start(addr, label)
+      open_prefixes.append((addr + (1 << (32 - netlen)), label))
+    CloseUpTo(1 << 32)
+    self.starts = numpy.array(starts, dtype = numpy.uint32)
+    self.labels = numpy.array(labels, dtype = numpy.int32)
+    # One entry per prefix, plus one for "no match" that a label of -1
+    # picks out.
+    netlens = numpy.array([netlen for addr, netlen, data in self.prefixes] +
+                          [-1], dtype = numpy.int8)
+    self.netlens = netlens[self.labels]
+    self.data = numpy.empty(len(self.prefixes) + 1, dtype = object)
+    self.data[:-1] = [data for addr, netlen, data in self.prefixes]
+
+  def __len__(self):
+    """The number of ranges in the table."""
+    return len(self.starts)
+
+  def _Ranges(self, addresses):
+    """The index of the range each address (an array of integers) is in."""
+    addresses = numpy.asarray(addresses, dtype = numpy.uint32)
+    return numpy.searchsorted(self.starts, addresses, side = 'right') - 1
+
+  def Classify(self, addresses):
+    """Return an int32 array giving, for each of addresses (a NumPy
+    uint32 array, or anything that converts to one), the number of the
+    most specific used prefix covering it, or -1 if there is none."""
+    return self.labels[self._Ranges(addresses)]
+
+  def ClassifyNetlen(self, addresses):
+    """As Classify, but give the matching prefix's length (-1 for none)."""
+    return self.netlens[self._Ranges(addresses)]
+
+  def ClassifyData(self, addresses, default = None):
+    """As Classify, but give the matching prefix's data (default for
+    none), as an object array: for an ACL, its actions."""
+    self.data[-1] = default
+    return self.data[self.Classify(addresses)]
+
+
+class PrefixAllocator(object):
+  """A buddy allocator for the free space in a pool (a prefix) of a tree.
+
+  The free space is kept as lists of the maximal free blocks, one per
+  prefix length. Allocating a /size takes a free block of that length,
+  or failing that splits a larger one in halves, putting the unused
+  halves on their lists; releasing a prefix puts it back, merging it with
+  its buddy (the other half of its supernet) for as long as that is free
+  too. Neither has to search the tree, as FindGapFrom does.
+
+  Allocated prefixes are inserted into (and released ones removed from)
+  the tree, which is otherwise left to the allocator: prefixes inserted
+  into or removed from the pool behind its back are not seen.
+
+  policy is BEST_FIT (the default), which splits the smallest free block
+  that will do, keeping large blocks whole for as long as possible, or
+  FIRST_FIT, which takes the lowest-addressed free space, keeping
+  allocations packed towards the start of the pool. Either way, among
+  blocks of the same length the lowest-addressed is used first."""
+
+  BEST_FIT = "best-fit"
+  FIRST_FIT = "first-fit"
+
+  def __init__(self, supplied_tree, pool = None, policy = None):
+    if policy is None:
+      policy = self.BEST_FIT
+    if policy not in (self.BEST_FIT, self.FIRST_FIT):
+      raise ValueError("Unknown allocation policy %s" % policy)
+    self.tree = supplied_tree
+    self.policy = policy
+    self.width = supplied_tree.width
+    if pool is None:
+      self.pool_addr, self.pool_len = 0, 0
+    else:
+      addr, netlen = supplied_tree.RouteToInt(pool)
+      self.pool_addr, self.pool_len = addr & _Mask(netlen, self.width), netlen
+    # By prefix length, the free blocks' addresses: a set, which is the
+    # truth, and a heap for finding the lowest, which may also hold
+    # addresses since taken (they are skipped when they surface).
+    self._free = [set() for i in xrange(self.width + 1)]
+    self._heaps = [[] for i in xrange(self.width + 1)]
+    # The data of nodes, such as the pool's own, that an allocation
+    # landed on, by (addr, netlen), to be put back when it is released.
+    self._displaced = {}
+    node = supplied_tree.LookupInt(self.pool_addr, self.pool_len,
+                                   used_check = True)
+    # Unless the pool is used, or covered by something that is.
+    if node is None or not node._used:
+      for addr, netlen in self._FreeBlocksBelow(node, self.pool_addr,
+                                                self.pool_len):
+        self._AddFree(addr, netlen)
+
+  def _FreeBlocksBelow(self, node, addr, level):
+    """The maximal free blocks at and beneath node (which is addr/level,
+    and may be None if that is not in the tree), as the tree has it."""
+    t = self.tree
+    if t.root._dirty:
+      t._Summarise(t.root)
+    width = self.width
+    stack = [(node, addr, level)]
+    while stack:
+      node, addr, level = stack.pop()
+      if node is None or node._count == 0:
+        yield (addr, level)
+      elif not node._used:
+        stack.append((node.right, addr | (1 << (width - 1 - level)),
+                      level + 1))
+        stack.append((node.left, addr, level + 1))
+
+  def _AddFree(self, addr, netlen):
+    self._free[netlen].add(addr)
+    heap = self._heaps[netlen]
+    heapq.heappush(heap, addr)
+    if len(heap) > 2 * len(self._free[netlen]) + 16:
+      # Mostly stale: start again from the set.
+      heap[:] = sorted(self._free[netlen])
+
+  def _Lowest(self, netlen):
+    """The lowest-addressed free /netlen block, or None; it stays free."""
+    free = self._free[netlen]
+    heap = self._heaps[netlen]
+    while heap:
+      if heap[0] in free:
+        return heap[0]
+      heapq.heappop(heap)
+    return None
+
+  def Allocate(self, size, supplied_data = "Allocated"):
+    """Allocate a /size from the pool, insert it into the tree with
+    supplied_data, and return it in CIDR format; or None if the pool has
+    no room for one."""
+    result = self.AllocateInt(size, supplied_data)
+    if result is None:
+      return None
+    return self.tree.IntToRoute(*result)
+
+  def AllocateInt(self, size, supplied_data = "Allocated"):
+    """As Allocate, but return an (integer address, prefix length) tuple."""
+    if size < self.pool_len or size > self.width:
+      raise ValueError("Cannot allocate a /%s from a /%s pool" %
+                       (size, self.pool_len))
+    found = None
+    if self.policy == self.BEST_FIT:
+      for netlen in xrange(size, self.pool_len - 1, -1):
+        if self._free[netlen]:
+          found = (self._Lowest(netlen), netlen)
+          break
+    else:
+      for netlen in xrange(size, self.pool_len - 1, -1):
+        if self._free[netlen]:
+          addr = self._Lowest(netlen)
+          if found is None or addr < found[0]:
+            found = (addr, netlen)
+    if found is None:
+      return None
+    addr, netlen = found
+    self._free[netlen].discard(addr)
+    # Split down to size, freeing the upper half at each step.
+    while netlen < size:
+      netlen += 1
+      self._AddFree(addr | (1 << (self.width - netlen)), netlen)
+    node = self.tree.LookupInt(addr, size)
+    if node is not None:
+      if node is self.tree.root:
+        blank = _ROOT_DATA
+      else:
+        blank = _CREATED_BY_INSERT
+      if node.data != blank:
+        self._displaced[(addr, size)] = node.data
+    self.tree.InsertInt(addr, size, supplied_data, test_dup = False)
+    return (addr, size)
+
+  def Release(self, route):
+    """Release route, allocated earlier (or inserted into the pool before
+    the allocator was made), back to the pool, and return its data.
+    Raises ValueError if it is not in use or not in the pool."""
+    addr, netlen = self.tree.RouteToInt(route)
+    return self.ReleaseInt(addr, netlen)
+
+  def ReleaseInt(self, addr, netlen):
+    """As Release, for an integer address and prefix length."""
+    width = self.width
+    if (netlen < self.pool_len or
+        (addr ^ self.pool_addr) & _Mask(self.pool_len, width)):
+      raise ValueError("%s is not in the pool" %
+                       self.tree.IntToRoute(addr, netlen))
+    node = self.tree.LookupInt(addr, netlen)
+    if node is None or not node._used:
+      raise ValueError("%s is not in use" % self.tree.IntToRoute(addr, netlen))
+    data = self.tree.RemoveInt(addr, netlen)
+    addr &= _Mask(netlen, width)
+    if (addr, netlen) in self._displaced:
+      self.tree.InsertInt(addr, netlen, self._displaced.pop((addr, netlen)),
+                          mark_used = False, test_dup = False)
+    node = self.tree.LookupInt(addr, netlen, used_check = True)
+    if node is not None and node._used:
+      # Still covered by a used prefix, so none of it is free.
+      return data
+    # Usually Remove has pruned it, and it is all free.
+    blocks = [(addr, netlen)]
+    if node is not None:
+      blocks = list(self._FreeBlocksBelow(node, addr, netlen))
+    if blocks != [(addr, netlen)]:
+      # Something beneath it is still in use, so it has no buddy to merge
+      # with; just the space around that is free.
+      for block_addr, block_netlen in blocks:
+        self._AddFree(block_addr, block_netlen)
+      return data
+    # Merge with the buddy for as long as it is free.
+    while netlen > self.pool_len:
+      buddy = addr ^ (1 << (width - netlen))
+      if buddy not in self._free[netlen]:
+        break
+      self._free[netlen].discard(buddy)
+      addr &= ~(1 << (width - netlen))
+      netlen -= 1
+    self._AddFree(addr, netlen)
+    return data
+
+  def FreeBlocks(self):
+    """Return the free blocks in the pool, in CIDR format and address
+    order."""
+    int_to_route = self.tree.IntToRoute
+    return [int_to_route(addr, netlen)
+            for addr, netlen in self.FreeBlocksInt()]
+
+  def FreeBlocksInt(self):
+    """As FreeBlocks, but as (integer address, prefix length) tuples."""
+    return sorted((addr, netlen) for netlen in xrange(self.width + 1)
+                  for addr in self._free[netlen])
+
+  def FreeAddresses(self):
+    """How many addresses in the pool are free."""
+    return sum(len(self._free[netlen]) << (self.width - netlen)
+               for netlen in xrange(self.width + 1))